@@ -7,8 +7,18 @@ import logging
 import os
 import utils
 import mimetypes
+import stat
+import zlib
+import storage
+from datetime import datetime
+from cache import LRUCache
 
 from webapp2_extras import jinja2
+from webob.datetime_utils import UTC
+
+dbm = storage.backend()
+
+mimetypes.add_type('application/x-ndjson', '.ndjson')
 
 HTTP_URLS = {
   'website': config.WEBSITE_APP_ROOT_URL,
@@ -23,6 +33,7 @@ error_codes = {
   103: 'Object doesn\'t exist',
   104: 'Object has not property',
   105: 'Comment API error',
+  106: 'Server is busy',
   300: 'Permission error',
   301: 'Authentication error',
 }
@@ -31,6 +42,9 @@ def restapi(func):
   """ Decorator to handle json result."""
   def decorated(self, *args, **kwargs):
     result = func(self, *args, **kwargs)
+    if self.response.status_int == 304:
+      # client has the current version, see BaseHandler.not_modified
+      return
     # Convert to json
     self.response.headers['Content-Type'] = 'application/json'
     if result is not None:
@@ -81,6 +95,13 @@ class BaseHandler(webapp2.RedirectHandler):
       logging.info('Request: %r', [(arg, self.request.get(arg))
                                    for arg in self.request.arguments()])
 
+  def dispatch(self):
+    try:
+      super(BaseHandler, self).dispatch()
+    finally:
+      # give pooled connections back for the next request
+      dbm.release()
+
   @property
   def urls(self):
     return HTTP_URLS
@@ -99,8 +120,9 @@ class BaseHandler(webapp2.RedirectHandler):
     return self.request.headers.get('X-Api-User-Id') or self.request.get('viewer_id')
 
   @property
-  def page(self):
-    return int(self.request.get('page', 0) or 0)
+  def page_cursor(self):
+    """ Opaque keyset pagination cursor of requested page."""
+    return self.request.get('cursor') or None
 
   def render_response(self, template_name, **context):
     # Renders a template and writes the result to the response.
@@ -108,6 +130,63 @@ class BaseHandler(webapp2.RedirectHandler):
     rv = self.jinja2.render_template(template_name, **context)
     self.response.write(rv)
 
+  def render_fragment(self, template_name, **context):
+    """ Render template to unicode string, e.g. a part of page."""
+    context = self.update_context(template_name, context)
+    return self.jinja2.render_template(template_name, **context)
+
+  def stream_response(self, template_name, **context):
+    """ Render template by parts and send them while rendering.
+
+    Context may hold generators, they are consumed by the template when the
+    response is sent, so database cursors stay open until the page ends and
+    pooled connections are released after the last chunk.
+    """
+    context = self.update_context(template_name, context)
+    template = self.jinja2.environment.get_template(template_name)
+
+    def chunks():
+      try:
+        parts = []
+        size = 0
+        for part in template.generate(**context):
+          parts.append(part)
+          size += len(part)
+          if size >= config.STREAM_CHUNK_SIZE:
+            yield u''.join(parts).encode('utf-8')
+            parts = []
+            size = 0
+
+        if parts:
+          yield u''.join(parts).encode('utf-8')
+      finally:
+        dbm.release()
+
+    self.response.app_iter = chunks()
+
+  def not_modified(self, version, updated=None):
+    """ Set ETag and Last-Modified of resource by its version (see
+    StorageBackend.get_object_version) and check request conditions. Call it
+    before the resource is read, so ETag is never newer than the data.
+
+    @param version: resource version.
+    @param updated: date of the last change (database format) or None.
+    @return: True if client has the current version, response status is set
+      to 304 and the resource does not have to be read.
+    """
+    etag = str(version)
+    self.response.etag = etag
+    # clients revalidate every time, the check costs one version lookup
+    self.response.cache_control = 'no-cache'
+    if updated:
+      updated = utils.parse_dbdate(updated).replace(tzinfo=UTC)
+      self.response.last_modified = updated
+
+    current = is_current(self.request, etag, updated)
+    if current:
+      self.response.status_int = 304
+    return current
+
   def error_result(self, code, message=''):
     assert code in error_codes
     self.error(406)
@@ -117,18 +196,189 @@ class BaseHandler(webapp2.RedirectHandler):
       'message': message
     }
 
+def is_current(request, etag, last_modified=None):
+  """ Check if client copy of resource is current: If-None-Match has its
+  etag or, without If-None-Match, it is not modified since If-Modified-Since.
+  @param last_modified: datetime with UTC tzinfo or None.
+  """
+  if 'If-None-Match' in request.headers:
+    return etag in request.if_none_match
+
+  since = request.if_modified_since
+  return bool(last_modified and since and last_modified <= since)
+
+def file_chunks(f, size=None, length=None):
+  """ Read file by parts of `size` bytes (STATIC_CHUNK_SIZE) from its
+  current position, at most `length` bytes (to the end by default), close
+  it at the end."""
+  size = size or config.STATIC_CHUNK_SIZE
+  try:
+    while length is None or length > 0:
+      data = f.read(size if length is None else min(size, length))
+      if not data:
+        break
+      if length is not None:
+        length -= len(data)
+      yield data
+  finally:
+    f.close()
+
+def gunzip_chunks(chunks):
+  """ Decompress chunks of gzip data, several members (RFC 1952) are joined
+  like gzip module reads them. Closes chunks at the end."""
+  try:
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for data in chunks:
+      while data:
+        result = decompressor.decompress(data)
+        if result:
+          yield result
+        # data after the end of member is the next member
+        data = decompressor.unused_data
+        if data:
+          decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    result = decompressor.flush()
+    if result:
+      yield result
+  finally:
+    chunks.close()
+
+# file types and (size, mtime) of static files by path
+_type_cache = LRUCache(config.STATIC_CACHE_SIZE)
+_stat_cache = LRUCache(config.STATIC_CACHE_SIZE, config.STATIC_STAT_TTL)
+
+def file_type(path):
+  """ Return (content type, encoding) of file by its name."""
+  result = _type_cache.get(path)
+  if result is None:
+    result = mimetypes.guess_type(path)
+    _type_cache.set(path, result)
+  return result
+
+def file_stat(path):
+  """ Return (size, mtime) of regular file or None. Results are used for
+  STATIC_STAT_TTL seconds, so a replaced file may be seen a bit later.
+  StaticFileHandler finds files by it, headers come from the opened file."""
+  result = _stat_cache.get(path)
+  if result is None:
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+    if not stat.S_ISREG(st.st_mode):
+      return None
+    result = (st.st_size, int(st.st_mtime))
+    _stat_cache.set(path, result)
+  return result
+
 class StaticFileHandler(webapp2.RequestHandler):
-  """Handler to serve static files."""
+  """Handler to serve static files.
+
+  Files are sent by parts, with wsgi.file_wrapper of the server if it has
+  one. ETag, Last-Modified and length come from fstat of the opened file,
+  so they describe the sent content even if the file is being replaced.
+  A single byte range is sent with 206 status, If-Range makes it
+  conditional for resumed downloads. HEAD gets headers of GET.
+
+  If file is not found but its gzip compressed version (name.gz) is, it is
+  sent as is with Content-Encoding: gzip to clients accepting it and
+  decompressed on the fly to others (without Content-Length and ranges).
+  Reports are several gzip members (appended rows, joined parts) which some
+  clients cut off with Content-Encoding, they are always decompressed; the
+  .gz file itself is downloaded as application/gzip.
+  """
 
   def get(self, path):
     abs_path = os.path.abspath(os.path.join(config.STATIC_ROOT_URL, path))
     if os.path.isdir(abs_path) or abs_path.find(os.getcwd()) != 0:
       self.error(403)
       return
+
+    content_type, encoding = file_type(abs_path)
+    report = abs_path.startswith(os.path.abspath(config.REPORTS_DIR) + os.sep)
+    variant = ''
+    decompress = False
+    if encoding == 'gzip':
+      # compressed file itself is requested
+      content_type = 'application/gzip'
+    elif file_stat(abs_path) is None and file_stat(abs_path + '.gz'):
+      abs_path += '.gz'
+      if report:
+        decompress = True
+      else:
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        if 'Accept-Encoding' in self.request.headers and \
+           'gzip' in self.request.accept_encoding:
+          self.response.headers['Content-Encoding'] = 'gzip'
+          variant = '-gzip'
+        else:
+          decompress = True
+
     try:
-      f = open(abs_path, 'r')
-      self.response.headers.add_header('Content-Type', mimetypes.guess_type(abs_path)[0])
-      self.response.out.write(f.read())
+      f = open(abs_path, 'rb')
+    except IOError:
+      self.error(404)
+      return
+
+    st = os.fstat(f.fileno())
+    if not stat.S_ISREG(st.st_mode):
       f.close()
-    except:
-      self.error(404)
\ No newline at end of file
+      self.error(404)
+      return
+
+    size, mtime = st.st_size, int(st.st_mtime)
+    response = self.response
+    response.headers['Content-Type'] = content_type or 'application/octet-stream'
+    response.etag = '%x-%x%s' % (mtime, size, variant)
+    response.last_modified = datetime.fromtimestamp(mtime, UTC)
+    if report:
+      # report is written again to the same file on restart
+      response.cache_control = 'private, no-cache'
+    else:
+      response.cache_control = 'public, max-age=%d' % config.STATIC_MAX_AGE
+
+    if is_current(self.request, response.etag, response.last_modified):
+      f.close()
+      response.status_int = 304
+      return
+
+    head = self.request.method == 'HEAD'
+    if decompress:
+      if head:
+        f.close()
+      else:
+        response.app_iter = gunzip_chunks(file_chunks(f))
+      return
+
+    response.headers['Accept-Ranges'] = 'bytes'
+    start, stop = 0, size
+    byte_range = self.request.range
+    if (byte_range is not None and not ',' in self.request.headers['Range'] and
+        response in self.request.if_range):
+      bounds = byte_range.range_for_length(size)
+      if bounds is None:
+        f.close()
+        response.status_int = 416
+        response.headers['Content-Range'] = 'bytes */%d' % size
+        return
+      start, stop = bounds
+      response.status_int = 206
+      response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+
+    if head:
+      # webob sends headers without body
+      f.close()
+      response.content_length = stop - start
+      return
+
+    f.seek(start)
+    file_wrapper = self.request.environ.get('wsgi.file_wrapper')
+    if file_wrapper and stop == size:
+      # server may send the file with sendfile
+      response.app_iter = file_wrapper(f, config.STATIC_CHUNK_SIZE)
+    else:
+      response.app_iter = file_chunks(f, length=stop - start)
+    response.content_length = stop - start
+
+  def head(self, path):
+    return self.get(path)
@@ -0,0 +1,160 @@
+""" Microbenchmarks for the storage layer.
+
+Usage: python benchmarks.py [benchmark ...]
+"""
+__author__ = 'okoneshnikov'
+import os
+import sys
+import time
+import shutil
+import tempfile
+from datetime import datetime
+
+import scheme
+import storage
+import utils
+from cache import LRUCache
+from comments import DbManager as dbm
+
+
+def rate(func, count):
+  """ Run func(count) and return operations per second."""
+  start = time.time()
+  func(count)
+  return count / (time.time() - start)
+
+
+class BenchDb(object):
+  """ Fresh database in a temp directory, connected to DbManager."""
+
+  def __enter__(self):
+    self.dir = tempfile.mkdtemp()
+    self.dbname = os.path.join(self.dir, 'bench.db')
+    scheme.create_scheme(self.dbname)
+    dbm.connect(self.dbname)
+    return self.dbname
+
+  def __exit__(self, *args):
+    dbm.close()
+    shutil.rmtree(self.dir)
+
+
+def bench_statements(count=20000):
+  """ String formatted SQL against bound parameters with cached statements."""
+  now = utils.dbdate(datetime.utcnow())
+
+  def formatted_inserts(n):
+    c = dbm.cursor()
+    for i in xrange(n):
+      c.execute("INSERT INTO COMMENTS VALUES (NULL,'%s','%s','%s','%s','%s',NULL,'%s')" %
+                (now, now, 'Post', 'id%d' % (i % 10), 'u%d' % (i % 7), 'comment %d' % i))
+      if i % 1000 == 0:
+        dbm.commit()
+    dbm.commit()
+
+  def bound_inserts(n):
+    c = dbm.cursor()
+    for i in xrange(n):
+      dbm.insert('COMMENTS', dict(created_date=now, updated_date=now,
+                                  obj_type='Post', obj_id='id%d' % (i % 10),
+                                  user_id='u%d' % (i % 7),
+                                  comment='comment %d' % i), cursor=c)
+      if i % 1000 == 0:
+        dbm.commit()
+    dbm.commit()
+
+  def formatted_selects(n):
+    c = dbm.cursor(readonly=True)
+    for i in xrange(n):
+      c.execute("SELECT * FROM COMMENTS WHERE ID=%s" % (i + 1))
+      c.fetchone()
+
+  def bound_selects(n):
+    for i in xrange(n):
+      dbm.get('COMMENTS', i + 1)
+
+  results = []
+  with BenchDb():
+    results.append(('inserts/sec formatted', rate(formatted_inserts, count)))
+    results.append(('selects/sec formatted', rate(formatted_selects, count)))
+  with BenchDb():
+    results.append(('inserts/sec bound', rate(bound_inserts, count)))
+    results.append(('selects/sec bound', rate(bound_selects, count)))
+  return results
+
+
+def bench_backends(count=5000):
+  """ SQLite backend against the in-memory baseline."""
+  def run(backend):
+    def creates(n):
+      for i in xrange(n):
+        backend.create_comment('Post', 'id%d' % (i % 10), 'u%d' % (i % 7),
+                               'comment %d' % i)
+
+    def pages(n):
+      for i in xrange(n):
+        backend.get_comments('Post', 'id%d' % (i % 10), limit=20)
+
+    def comments(n):
+      for i in xrange(n):
+        backend.get_comment(i + 1)
+
+    return [('%s creates/sec' % backend.__name__, rate(creates, count)),
+            ('%s pages/sec' % backend.__name__, rate(pages, count)),
+            ('%s gets/sec' % backend.__name__, rate(comments, count))]
+
+  results = []
+  with BenchDb():
+    # first pages are cached by DbManager, so pages mostly measure the cache
+    results.extend(run(dbm))
+
+  memory = storage.backend('memory')
+  memory.connect('bench')
+  results.extend(run(memory))
+  memory.drop('bench')
+  return results
+
+
+def bench_pages(count=2000):
+  """ Comments page requests without and with the fragment cache. Viewers
+  change every request, the object is not changed."""
+  from webob import Request
+  import main
+
+  def requests(n):
+    for i in xrange(n):
+      response = Request.blank('/?obj_type=Post&obj_id=id1&viewer_id=uid%d' % (i % 10 + 1)
+                               ).get_response(main.application)
+      assert response.status_int == 200
+
+  cache = main.CommentsHandler.fragment_cache
+  results = []
+  with BenchDb():
+    for i in xrange(main.COMMENTS_PAGE_SIZE):
+      dbm.create_comment('Post', 'id1', 'uid%d' % (i % 10 + 1), 'comment %d' % i)
+    try:
+      main.CommentsHandler.fragment_cache = LRUCache(0)
+      results.append(('pages/sec not cached', rate(requests, count)))
+      main.CommentsHandler.fragment_cache = LRUCache(cache.size, cache.ttl, cache.max_bytes)
+      results.append(('pages/sec cached', rate(requests, count)))
+    finally:
+      main.CommentsHandler.fragment_cache = cache
+  return results
+
+
+BENCHMARKS = {
+  'statements': bench_statements,
+  'backends': bench_backends,
+  'pages': bench_pages,
+}
+
+
+def main(names):
+  for name in names or sorted(BENCHMARKS):
+    print name
+    for label, value in BENCHMARKS[name]():
+      print '  %-40s %12.1f' % (label, value)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,93 @@
+__author__ = 'okoneshnikov'
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+  """ Thread safe in-process LRU cache bounded by entries count, total size
+  of values (max_bytes, for strings) and entry time to live.
+
+  A reader that loads value from database takes token() before the query and
+  passes it to set(). If any entry was invalidated in between, the value may
+  be stale and is not stored.
+  """
+
+  def __init__(self, size, ttl=None, max_bytes=None):
+    self.size = size
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+    self._data = OrderedDict()
+    self._lock = threading.Lock()
+    self._invalidations = 0
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def _weight(self, value):
+    return len(value) if self.max_bytes else 0
+
+  def _pop(self, key):
+    item = self._data.pop(key, None)
+    if item is not None:
+      self.bytes -= self._weight(item[1])
+    return item
+
+  def get(self, key, default=None):
+    with self._lock:
+      item = self._pop(key)
+      if item is None:
+        self.misses += 1
+        return default
+
+      expires, value = item
+      if expires is not None and expires < time.time():
+        self.expirations += 1
+        self.misses += 1
+        return default
+
+      # move to the end of LRU order
+      self._data[key] = item
+      self.bytes += self._weight(value)
+      self.hits += 1
+      return value
+
+  def token(self):
+    return self._invalidations
+
+  def set(self, key, value, token=None):
+    with self._lock:
+      if token is not None and token != self._invalidations:
+        return
+
+      weight = self._weight(value)
+      if self.size <= 0 or (self.max_bytes and weight > self.max_bytes):
+        return
+
+      expires = time.time() + self.ttl if self.ttl else None
+      self._pop(key)
+      self._data[key] = (expires, value)
+      self.bytes += weight
+
+      while len(self._data) > self.size or (self.max_bytes and self.bytes > self.max_bytes):
+        self._pop(next(iter(self._data)))
+        self.evictions += 1
+
+  def delete(self, key):
+    with self._lock:
+      self._invalidations += 1
+      self._pop(key)
+
+  def clear(self):
+    with self._lock:
+      self._invalidations += 1
+      self._data.clear()
+      self.bytes = 0
+
+  def stats(self):
+    with self._lock:
+      return dict(hits=self.hits, misses=self.misses,
+                  evictions=self.evictions, expirations=self.expirations,
+                  entries=len(self._data), size=self.size, bytes=self.bytes)
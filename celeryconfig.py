@@ -1,5 +1,14 @@
+from datetime import timedelta
 
 BROKER_URL = 'redis://127.0.0.1:6379/3'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
-CELERY_RESULT_SERIALIZER = 'json'
\ No newline at end of file
+CELERY_RESULT_SERIALIZER = 'json'
+
+# run with celery beat
+CELERYBEAT_SCHEDULE = {
+  'compact-history': {
+    'task': 'tasks.compact_history',
+    'schedule': timedelta(days=1),
+  },
+}
\ No newline at end of file
@@ -1,14 +1,28 @@
 __author__ = 'okoneshnikov'
+import os
+import glob
+import json
 import sqlite3
+import threading
+import time
+import atexit
+import Queue
+import heapq
 import config
-from datetime import datetime
+from datetime import datetime, timedelta
 import utils
 import scheme
+import sharding
+from cache import LRUCache
+from history import HistoryWriter
+from storage import StorageBackend, TreeNode
 
 class CommentAPIError(Exception):
   codes = {
     1: 'Delete comment error. Comment has children comments',
-    2: 'Save history error. Invalid action. It must be add/delete/modified'
+    2: 'Save history error. Invalid action. It must be add/delete/modified',
+    3: 'Database busy. No free connection in pool',
+    4: 'Save history error. History queue is full'
   }
 
   def __init__(self, code, message=None):
@@ -26,49 +40,643 @@ class CommentAPIError(Exception):
     return '%s comment api error. %s, code %s' % (self.__class__.__name__,
                                                  self.message, self.code)
 
-class DbManager(object):
-  """ Hide SQL realization to this class."""
-  connection = sqlite3.connect(config.DB_NAME, check_same_thread=False)
-  connection.row_factory = sqlite3.Row
+class ConnectionPool(object):
+  """ Bounded pool of sqlite3 connections.
+
+  Every thread checks out its own connection on first use and keeps it until
+  release(), so concurrent requests never share a transaction. If all
+  connections are busy the thread waits for a free one; the wait is recorded
+  in the pool statistics.
+  """
+
+  def __init__(self, dbname, size, readonly=False, timeout=None):
+    assert size > 0
+    self.dbname = dbname
+    self.size = size
+    self.readonly = readonly
+    self.timeout = timeout
+    self._idle = Queue.LifoQueue()
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._created = 0
+    self._all = []
+    self._stats = dict(checkouts=0, waits=0, timeouts=0,
+                       wait_time=0.0, max_wait=0.0)
+
+  def _open(self):
+    conn = sqlite3.connect(self.dbname, timeout=config.DB_BUSY_TIMEOUT,
+                           check_same_thread=False,
+                           cached_statements=config.DB_STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    if self.readonly:
+      conn.execute('PRAGMA query_only=ON')
+    else:
+      conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+  def checkout(self):
+    """ Take connection from the pool. Wait if all connections are busy."""
+    try:
+      conn = self._idle.get_nowait()
+    except Queue.Empty:
+      conn = None
+      with self._lock:
+        create = self._created < self.size
+        if create:
+          self._created += 1
+
+      if create:
+        try:
+          conn = self._open()
+        except:
+          with self._lock:
+            self._created -= 1
+          raise
+        with self._lock:
+          self._all.append(conn)
+      else:
+        start = time.time()
+        try:
+          conn = self._idle.get(timeout=self.timeout)
+        except Queue.Empty:
+          with self._lock:
+            self._stats['timeouts'] += 1
+          raise CommentAPIError(3)
+        finally:
+          waited = time.time() - start
+          with self._lock:
+            self._stats['waits'] += 1
+            self._stats['wait_time'] += waited
+            self._stats['max_wait'] = max(self._stats['max_wait'], waited)
+
+    with self._lock:
+      self._stats['checkouts'] += 1
+    return conn
+
+  def checkin(self, conn):
+    """ Return connection to the pool. Uncommitted changes are rolled back."""
+    conn.rollback()
+    self._idle.put(conn)
+
+  def connection(self):
+    """ Return connection bound to the current thread."""
+    conn = getattr(self._local, 'connection', None)
+    if conn is None:
+      conn = self._local.connection = self.checkout()
+    return conn
+
+  def release(self):
+    """ Return connection of the current thread to the pool."""
+    conn = getattr(self._local, 'connection', None)
+    if conn is not None:
+      self._local.connection = None
+      self.checkin(conn)
+
+  def close(self):
+    """ Close all connections created by the pool."""
+    with self._lock:
+      connections, self._all = self._all, []
+      self._created = 0
+    for conn in connections:
+      conn.close()
+    self._idle = Queue.LifoQueue()
+    self._local = threading.local()
+
+  def stats(self):
+    with self._lock:
+      result = dict(self._stats)
+      result.update(size=self.size, created=self._created,
+                    idle=self._idle.qsize())
+    return result
+
+class DbManager(StorageBackend):
+  """ SQLite storage backend. Hide SQL realization to this class.
+
+  Writes go through `pool`, get_* methods read through `read_pool` so slow
+  reads never wait for the writer's transaction.
+
+  With DB_SHARDS > 1 comments, COMMENTSTREE and HISTORY rows are stored in
+  shard files with their own pools (`shard_pools`, `shard_read_pools`),
+  `pool` and `read_pool` serve REPORTS of the main database. With one shard
+  the main pools are the shard pools.
+  """
+  _insert_sql = {}
+  _history_writers = {}
+  # async HISTORY rows of the current thread waiting for commit, by shard
+  _history_pending = threading.local()
+  dbname = config.DB_NAME
+  shards = 1
+
+  # report is exported while it or a report sharing its file is working
+  report_exported_sql = "(STATUS='working' OR EXISTS (SELECT 1 FROM REPORTS AS A " \
+                        "WHERE A.SOURCE_ID=REPORTS.ID AND A.STATUS='working'))"
+
+  # Read-through caches of single comments and of the first page of object
+  # comments. They are per process, writes of other processes become visible
+  # after CACHE_TTL seconds.
+  comment_cache = LRUCache(config.CACHE_COMMENTS_SIZE, config.CACHE_TTL)
+  page_cache = LRUCache(config.CACHE_PAGES_SIZE, config.CACHE_TTL)
+
+  pool = ConnectionPool(config.DB_NAME, config.DB_POOL_SIZE,
+                        timeout=config.DB_POOL_TIMEOUT)
+  read_pool = ConnectionPool(config.DB_NAME, config.DB_READ_POOL_SIZE,
+                             readonly=True, timeout=config.DB_POOL_TIMEOUT)
+  shard_pools = [pool]
+  shard_read_pools = [read_pool]
 
   @classmethod
-  def connect(cls, dbname):
-    cls.connection = sqlite3.connect(dbname, check_same_thread=False)
-    cls.connection.row_factory = sqlite3.Row
+  def connect(cls, dbname, shards=None):
+    cls.close()
+    cls.dbname = dbname
+    cls.shards = shards or config.DB_SHARDS
+    cls.pool = ConnectionPool(dbname, config.DB_POOL_SIZE,
+                              timeout=config.DB_POOL_TIMEOUT)
+    cls.read_pool = ConnectionPool(dbname, config.DB_READ_POOL_SIZE,
+                                   readonly=True, timeout=config.DB_POOL_TIMEOUT)
+    if cls.shards > 1:
+      names = sharding.shard_names(dbname, cls.shards)
+      cls.shard_pools = [ConnectionPool(name, config.DB_POOL_SIZE,
+                                        timeout=config.DB_POOL_TIMEOUT)
+                         for name in names]
+      cls.shard_read_pools = [ConnectionPool(name, config.DB_READ_POOL_SIZE,
+                                             readonly=True,
+                                             timeout=config.DB_POOL_TIMEOUT)
+                              for name in names]
+    else:
+      cls.shard_pools = [cls.pool]
+      cls.shard_read_pools = [cls.read_pool]
 
   @classmethod
-  def commit(cls):
-    cls.connection.commit()
+  def all_pools(cls):
+    """ Return main and shard pools, every pool once."""
+    pools = [cls.pool, cls.read_pool]
+    for pool in cls.shard_pools + cls.shard_read_pools:
+      if pool not in pools:
+        pools.append(pool)
+    return pools
 
   @classmethod
-  def insert(cls, table_name, params, cursor=None):
-    assert table_name in scheme.scheme_dict
+  def close(cls):
+    cls.stop_history()
+    for pool in cls.all_pools():
+      pool.close()
 
-    items = []
-    for field, descr in scheme.scheme_dict[table_name]:
+  @classmethod
+  def release(cls):
+    """ Return connections of the current thread to the pools."""
+    for pool in cls.all_pools():
+      pool.release()
 
-      if 'AUTOINCREMENT' in descr:
-        value = 'NULL'
+  @classmethod
+  def cursor(cls, readonly=False, shard=None):
+    """ Return cursor of the main database or of shard."""
+    if shard is None:
+      pool = cls.read_pool if readonly else cls.pool
+    elif readonly:
+      pool = cls.shard_read_pools[shard]
+    else:
+      pool = cls.shard_pools[shard]
+    return pool.connection().cursor()
+
+  @classmethod
+  def commit(cls, shard=None):
+    """ Commit the write transaction of shard connection and queue its async
+    HISTORY rows."""
+    pool = cls.pool if shard is None else cls.shard_pools[shard]
+    pool.connection().commit()
+    if shard is not None:
+      cls.queue_history(shard)
+
+  @classmethod
+  def rollback(cls, shard=None):
+    """ Roll back the write transaction of shard connection and drop its
+    async HISTORY rows."""
+    pool = cls.pool if shard is None else cls.shard_pools[shard]
+    pool.connection().rollback()
+    if shard is not None:
+      cls.pending_history(shard)[:] = []
+
+  @classmethod
+  def object_shard(cls, obj_type, obj_id):
+    """ Return shard of object comments."""
+    return sharding.object_shard(obj_type, obj_id, cls.shards)
+
+  @classmethod
+  def comment_shards(cls, comment_id):
+    """ Return shards to look for comment in, the most likely first."""
+    return sharding.id_shards(comment_id, cls.shards)
 
-      elif descr.startswith('TEXT') or descr.startswith('CHAR('):
-        value = "'%s'" % params.get(field, params.get(field.lower(), ''))
+  @classmethod
+  def comment_shard(cls, comment_id):
+    """ Return shard of comment, the shard which allocated its id if the
+    comment does not exist."""
+    shards = cls.comment_shards(comment_id)
+    if len(shards) > 1:
+      for shard in shards:
+        c = cls.cursor(readonly=True, shard=shard)
+        c.execute("SELECT 1 FROM COMMENTS WHERE ID=?", (comment_id,))
+        if c.fetchone():
+          return shard
+    return shards[0]
+
+  @classmethod
+  def merge_rows(cls, results, key):
+    """ Merge rows of shards sorted by key fields into one sorted iterator."""
+    if len(results) == 1:
+      return iter(results[0])
+
+    decorated = [((tuple(r[field] for field in key), r) for r in rows)
+                 for rows in results]
+    return (r for k, r in heapq.merge(*decorated))
+
+  @classmethod
+  def cache_stats(cls):
+    return dict(comments=cls.comment_cache.stats(), pages=cls.page_cache.stats())
+
+  @classmethod
+  def invalidate(cls, obj_type, obj_id, comment_id=None, top_level=True):
+    """ Drop cached comment and cached first page of object comments if
+    the comment is shown there."""
+    if comment_id is not None:
+      cls.comment_cache.delete(int(comment_id))
+    if top_level:
+      cls.page_cache.delete((obj_type, obj_id))
+
+  @classmethod
+  def pool_stats(cls):
+    result = dict(write=cls.pool.stats(), read=cls.read_pool.stats())
+    if cls.shards > 1:
+      result['shards'] = [dict(write=write.stats(), read=read.stats())
+                          for write, read in zip(cls.shard_pools, cls.shard_read_pools)]
+    return result
+
+  @classmethod
+  def reshard(cls, count):
+    """ Move comments with their COMMENTSTREE, OBJECT_VERSIONS, HISTORY and
+    HISTORY archive rows from current shards to `count` new shard files (to
+    the main database for one shard). Writers must be stopped; set DB_SHARDS
+    to count after it.
+
+    Comment ids are kept, ids of every new shard start after the largest id
+    allocated from its range. The main database is cleared after its rows are
+    moved, old shard files are left for backup.
+    @return: list of new shard files.
+    """
+    assert count > 0 and count != cls.shards
+    sources = [pool.dbname for pool in cls.shard_pools]
+    targets = sharding.shard_names(cls.dbname, count)
+    cls.close()
+
+    for index, name in enumerate(targets):
+      if name == cls.dbname:
+        conn = sqlite3.connect(name)
+        rows = conn.execute('SELECT count(*) FROM COMMENTS').fetchone()[0]
+        conn.close()
+        if rows:
+          raise ValueError('%s has comments' % name)
+      elif os.path.exists(name):
+        raise ValueError('%s already exists' % name)
       else:
-        value = '%s' % params.get(field, params.get(field.lower(), 'NULL'))
+        scheme.create_tables(name)
+
+    # the largest allocated id of every id range
+    last_ids = {}
+    # versions of all comments of shards (see data_version) sum up in new ones
+    data_version = 0
+    prefix = scheme.history_archive_prefix
+    history_tables = set(['HISTORY'])
+    for source in sources:
+      conn = sqlite3.connect(source)
+      for id_range, last_id in conn.execute(
+          "SELECT (ID - 1) / ?, max(ID) FROM COMMENTS GROUP BY 1 UNION ALL "
+          "SELECT (COMMENT_ID - 1) / ?, max(COMMENT_ID) FROM HISTORY GROUP BY 1 UNION ALL "
+          "SELECT (seq - 1) / ?, seq FROM sqlite_sequence WHERE name='COMMENTS' AND seq > 0",
+          (sharding.ID_RANGE, sharding.ID_RANGE, sharding.ID_RANGE)):
+        last_ids[id_range] = max(last_ids.get(id_range, 0), last_id)
+      data_version += conn.execute(
+        "SELECT coalesce(sum(VERSION), 0) FROM OBJECT_VERSIONS "
+        "WHERE COMMENT_ID=0 AND OBJ_TYPE='' AND OBJ_ID=''").fetchone()[0]
+      if conn.execute("SELECT count(*) FROM sqlite_master WHERE name='SHARD_SEQUENCE'").fetchone()[0]:
+        for seq, in conn.execute('SELECT SEQ FROM SHARD_SEQUENCE WHERE SEQ > 0'):
+          id_range = sharding.id_range(seq)
+          last_ids[id_range] = max(last_ids.get(id_range, 0), seq)
+      history_tables.update(r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND substr(name, 1, ?)=?",
+        (len(prefix), prefix)))
+      conn.close()
 
-      items.append(value)
+    for source in sources:
+      conn = sqlite3.connect(source, timeout=config.DB_BUSY_TIMEOUT)
+      conn.create_function('OBJECT_SHARD', 2,
+                           lambda obj_type, obj_id: sharding.object_shard(obj_type, obj_id, count))
+      # HISTORY of deleted comments goes to the shard of id range
+      conn.create_function('ID_SHARD', 1,
+                           lambda comment_id: sharding.id_shards(comment_id, count)[0])
+      try:
+        for index, target in enumerate(targets):
+          conn.execute('ATTACH DATABASE ? AS TARGET', (target,))
+          for table_name in sorted(history_tables - set(['HISTORY'])):
+            conn.execute(scheme.table_sql('TARGET.' + table_name, scheme.history_meta))
 
-    values = ','.join(items)
+          conn.execute("INSERT INTO TARGET.COMMENTS SELECT * FROM COMMENTS "
+                       "WHERE OBJECT_SHARD(OBJ_TYPE, OBJ_ID)=?", (index,))
+          conn.execute("INSERT INTO TARGET.COMMENTSTREE SELECT COMMENTSTREE.* "
+                       "FROM COMMENTSTREE JOIN COMMENTS ON COMMENTS.ID=COMMENTSTREE.ID "
+                       "WHERE OBJECT_SHARD(COMMENTS.OBJ_TYPE, COMMENTS.OBJ_ID)=?", (index,))
+          # versions go on growing, so old ETags are not matched
+          conn.execute("INSERT INTO TARGET.OBJECT_VERSIONS SELECT * FROM OBJECT_VERSIONS "
+                       "WHERE OBJ_TYPE!='' AND OBJECT_SHARD(OBJ_TYPE, OBJ_ID)=?", (index,))
+          for table_name in sorted(history_tables):
+            if conn.execute("SELECT count(*) FROM sqlite_master WHERE name=?",
+                            (table_name,)).fetchone()[0]:
+              conn.execute("INSERT INTO TARGET.%s SELECT H.* FROM %s AS H "
+                           "LEFT JOIN COMMENTS ON COMMENTS.ID=H.COMMENT_ID "
+                           "WHERE CASE WHEN COMMENTS.ID IS NULL THEN ID_SHARD(H.COMMENT_ID) "
+                           "ELSE OBJECT_SHARD(COMMENTS.OBJ_TYPE, COMMENTS.OBJ_ID) END=?"
+                           % (table_name, table_name), (index,))
+          conn.commit()
+          conn.execute('DETACH DATABASE TARGET')
 
-    sql = "INSERT INTO %s VALUES (%s)" % (table_name, values)
-    c = cursor or cls.connection.cursor()
-    c.execute(sql)
+        if source == cls.dbname:
+          for table_name in ('COMMENTS', 'COMMENTSTREE', 'HISTORY', 'OBJECT_VERSIONS'):
+            conn.execute('DELETE FROM %s' % table_name)
+          conn.execute("INSERT INTO COMMENTS_FTS(COMMENTS_FTS) VALUES('delete-all')")
+          conn.commit()
+          for table_name in history_tables - set(['HISTORY']):
+            conn.execute('DROP TABLE IF EXISTS %s' % table_name)
+      finally:
+        conn.close()
+
+    for index, target in enumerate(targets):
+      conn = sqlite3.connect(target, timeout=config.DB_BUSY_TIMEOUT)
+      try:
+        conn.execute("INSERT INTO COMMENTS_FTS(COMMENTS_FTS) VALUES('rebuild')")
+        conn.execute("INSERT INTO OBJECT_VERSIONS (COMMENT_ID, OBJ_TYPE, OBJ_ID, VERSION, "
+                     "UPDATED_DATE) VALUES (0, '', '', ?, ?) "
+                     "ON CONFLICT (COMMENT_ID, OBJ_TYPE, OBJ_ID) "
+                     "DO UPDATE SET VERSION=VERSION+excluded.VERSION",
+                     (data_version, utils.dbdate(datetime.utcnow())))
+        conn.commit()
+        if count > 1:
+          sharding.init_sequence(conn, index, last_ids.get(index, 0))
+        else:
+          conn.execute("UPDATE sqlite_sequence SET seq=max(seq, ?) WHERE name='COMMENTS'",
+                       (max(last_ids.values() or [0]),))
+          conn.commit()
+      finally:
+        conn.close()
+
+    cls.connect(cls.dbname, count)
+    cls.comment_cache.clear()
+    cls.page_cache.clear()
+    return targets
+
+  @classmethod
+  def insert_sql(cls, table_name):
+    """ Return INSERT statement with placeholders for all table fields and
+    the list of (field, default) pairs for its parameters. The statement text
+    is the same for every call, so sqlite reuses the compiled statement from
+    the connection statement cache."""
+    assert table_name in scheme.scheme_dict
+
+    result = cls._insert_sql.get(table_name)
+    if result is None:
+      fields = []
+      for field, descr in scheme.scheme_dict[table_name]:
+        if descr.startswith('TEXT') or descr.startswith('CHAR('):
+          fields.append((field, ''))
+        else:
+          fields.append((field, None))
+
+      sql = "INSERT INTO %s (%s) VALUES (%s)" % \
+            (table_name, ','.join(f for f, d in fields),
+             ','.join('?' * len(fields)))
+      result = cls._insert_sql[table_name] = (sql, fields)
+    return result
+
+  @classmethod
+  def insert_values(cls, table_name, params):
+    """ Return INSERT statement parameters in table fields order."""
+    sql, fields = cls.insert_sql(table_name)
+    return [params.get(field, params.get(field.lower(), default))
+            for field, default in fields]
+
+  @classmethod
+  def insert(cls, table_name, params, cursor=None):
+    sql, fields = cls.insert_sql(table_name)
+    c = cursor or cls.cursor()
+    c.execute(sql, cls.insert_values(table_name, params))
     return c
 
 
   @classmethod
-  def log(cls, comment_id, user_id, action, comment=None):
-    """ Store user action to HISTORY table."""
+  def log(cls, comment_id, user_id, action, comment=None, shard=0):
+    """ Store user action to HISTORY table of comment shard. In async
+    HISTORY_MODE the row is kept until the write is committed, see commit()."""
+
+    params = cls.history_params(comment_id, user_id, action, comment)
+    if config.HISTORY_MODE == 'async':
+      cls.pending_history(shard).append(cls.insert_values('HISTORY', params))
+    else:
+      cls.insert('HISTORY', params, cls.cursor(shard=shard))
+
+  @classmethod
+  def log_many(cls, rows, cursor, shard=0):
+    """ Store many HISTORY rows made by history_params()."""
+    values = [cls.insert_values('HISTORY', params) for params in rows]
+    if config.HISTORY_MODE == 'async':
+      cls.pending_history(shard).extend(values)
+    else:
+      cursor.executemany(cls.insert_sql('HISTORY')[0], values)
+
+  @classmethod
+  def pending_history(cls, shard=0):
+    """ Return async HISTORY rows of the current thread not committed yet."""
+    pending = getattr(cls._history_pending, 'rows', None)
+    if pending is None:
+      pending = cls._history_pending.rows = {}
+    return pending.setdefault(shard, [])
+
+  @classmethod
+  def queue_history(cls, shard=0):
+    """ Pass HISTORY rows of a committed write to the history writer. Rows
+    that do not fit into the full queue are written synchronously, so the
+    committed write is never left without its history."""
+    pending = cls.pending_history(shard)
+    if not pending:
+      return
+
+    values, pending[:] = list(pending), []
+    writer = cls.history_writer(shard)
+    for index, v in enumerate(values):
+      if not writer.add(v):
+        conn = cls.shard_pools[shard].connection()
+        conn.executemany(cls.insert_sql('HISTORY')[0], values[index:])
+        conn.commit()
+        break
+
+  @classmethod
+  def history_writer(cls, shard=0):
+    writer = cls._history_writers.get(shard)
+    if writer is None:
+      writer = cls._history_writers[shard] = HistoryWriter(
+        cls.shard_pools[shard].dbname, cls.insert_sql('HISTORY')[0])
+    return writer
+
+  @classmethod
+  def flush_history(cls):
+    """ Wait until queued HISTORY rows are written."""
+    for writer in cls._history_writers.values():
+      writer.flush()
+
+  @classmethod
+  def stop_history(cls):
+    """ Write queued HISTORY rows and stop the history writers."""
+    writers, cls._history_writers = cls._history_writers, {}
+    for writer in writers.values():
+      writer.stop()
+
+  @classmethod
+  def compact_history(cls, retention_days=None, archive=None,
+                      archive_months=None, batch_size=None):
+    """ Apply HISTORY retention policy: move rows older than retention_days
+    to per-month archives and drop archives older than archive_months.
+    @return: (archived rows count, dropped archives names).
+    """
+    if retention_days is None:
+      retention_days = config.HISTORY_RETENTION_DAYS
+    if archive_months is None:
+      archive_months = config.HISTORY_ARCHIVE_MONTHS
+
+    now = datetime.utcnow()
+    before = utils.dbdate(now - timedelta(days=retention_days))
+    archived = cls.archive_history(before, archive, batch_size)
+
+    dropped = []
+    if archive_months:
+      # months are counted from the first day of current month
+      months = now.year * 12 + now.month - 1 - archive_months
+      dropped = cls.drop_history_archives('%04d_%02d' % (months // 12, months % 12 + 1))
+
+    return archived, dropped
+
+  @classmethod
+  def archive_history(cls, before, archive=None, batch_size=None):
+    """ Move HISTORY rows created before date to per-month archive tables
+    HISTORY_YYYY_MM (archive='table') or NDJSON files
+    HISTORY_ARCHIVE_DIR/history_YYYY_MM.ndjson (archive='file').
+
+    Rows are moved in batches, one short transaction per batch, so writers
+    never wait long for the write lock.
+    @return: number of moved rows.
+    """
+    archive = archive or config.HISTORY_ARCHIVE
+    batch_size = batch_size or config.HISTORY_COMPACT_BATCH
+    assert archive in ('table', 'file')
+
+    fields = [field for field, descr in scheme.history_meta]
+    count = 0
+    for shard in range(cls.shards):
+      c = cls.cursor(shard=shard)
+
+      while True:
+        c.execute("SELECT rowid, * FROM HISTORY WHERE CREATED_DATE < ? "
+                  "ORDER BY CREATED_DATE LIMIT ?", (before, batch_size))
+        rows = c.fetchall()
+        if not rows:
+          break
+
+        months = {}
+        for r in rows:
+          month = r['CREATED_DATE'][:7].replace('-', '_')
+          months.setdefault(month, []).append([r[field] for field in fields])
+
+        if archive == 'table':
+          # sqlite3 module commits open transaction before DDL statements,
+          # so tables are created before the batch transaction starts
+          for month in months:
+            c.execute(scheme.table_sql(scheme.history_archive_prefix + month,
+                                       scheme.history_meta))
+
+        try:
+          for month, values in sorted(months.items()):
+            if archive == 'table':
+              table_name = scheme.history_archive_prefix + month
+              c.executemany("INSERT INTO %s (%s) VALUES (%s)" %
+                            (table_name, ','.join(fields), ','.join('?' * len(fields))),
+                            values)
+            else:
+              cls.write_history_file(month, fields, values)
+
+          c.executemany("DELETE FROM HISTORY WHERE rowid=?", [(r[0],) for r in rows])
+          cls.commit(shard)
+        except:
+          c.connection.rollback()
+          raise
+
+        count += len(rows)
+        if len(rows) < batch_size:
+          break
+        # let other writers take the lock between batches
+        time.sleep(config.HISTORY_COMPACT_PAUSE)
+
+    return count
+
+  @classmethod
+  def history_file_name(cls, month):
+    return os.path.join(config.HISTORY_ARCHIVE_DIR, 'history_%s.ndjson' % month)
 
+  @classmethod
+  def write_history_file(cls, month, fields, values):
+    if not os.path.isdir(config.HISTORY_ARCHIVE_DIR):
+      os.makedirs(config.HISTORY_ARCHIVE_DIR)
+
+    with open(cls.history_file_name(month), 'a') as f:
+      for row in values:
+        f.write(json.dumps(dict(zip(fields, row))) + '\n')
+      f.flush()
+      os.fsync(f.fileno())
+
+  @classmethod
+  def history_archives(cls):
+    """ Return list of (month, archive name) of existing archive tables and
+    files, month is YYYY_MM string."""
+    prefix = scheme.history_archive_prefix
+    result = set()
+    for shard in range(cls.shards):
+      c = cls.cursor(readonly=True, shard=shard)
+      c.execute("SELECT name FROM sqlite_master WHERE type='table' AND substr(name, 1, ?)=?",
+                (len(prefix), prefix))
+      result.update((r[0][len(prefix):], r[0]) for r in c.fetchall())
+
+    for name in glob.glob(cls.history_file_name('*')):
+      result.add((os.path.basename(name)[len('history_'):-len('.ndjson')], name))
+
+    return sorted(result)
+
+  @classmethod
+  def drop_history_archives(cls, before_month):
+    """ Drop archive tables and files of months before YYYY_MM month.
+    @return: list of dropped archives names."""
+    dropped = []
+    for month, name in cls.history_archives():
+      if month >= before_month:
+        continue
+
+      if name.startswith(scheme.history_archive_prefix):
+        for shard in range(cls.shards):
+          c = cls.cursor(shard=shard)
+          c.execute('DROP TABLE IF EXISTS %s' % name)
+          cls.commit(shard)
+      else:
+        os.remove(name)
+      dropped.append(name)
+
+    return dropped
+
+  @classmethod
+  def history_params(cls, comment_id, user_id, action, comment=None):
+    """ Return HISTORY row for user action."""
     if not action in scheme.history_actions:
       raise CommentAPIError(2)
 
@@ -81,27 +689,30 @@ class DbManager(object):
     if comment:
       params['comment'] = comment
 
-    cls.insert('HISTORY', params)
+    return params
 
 
   @classmethod
   def clear(cls, table_name):
     """Delete from table all rows."""
+    assert table_name in scheme.scheme_dict
     sql = 'DELETE FROM %s' % table_name
-    c = cls.connection.cursor()
-    c.execute(sql)
-    cls.connection.commit()
-
-  @classmethod
-  def clear_comments(cls):
-    cls.clear('COMMENTSTREE')
-    cls.clear('COMMENTS')
+    # REPORTS are in the main database, other tables in shards
+    for shard in [None] if table_name == 'REPORTS' else range(cls.shards):
+      c = cls.cursor(shard=shard)
+      c.execute(sql)
+      if table_name == 'COMMENTS':
+        c.execute("INSERT INTO COMMENTS_FTS(COMMENTS_FTS) VALUES('delete-all')")
+      cls.commit(shard)
+    cls.comment_cache.clear()
+    cls.page_cache.clear()
 
   @classmethod
-  def get(cls, table_name, id):
-    c = cls.connection.cursor()
-    sql = "SELECT * FROM %s WHERE ID=%s" % (table_name, id)
-    c.execute(sql)
+  def get(cls, table_name, id, shard=None):
+    assert table_name in scheme.scheme_dict
+    c = cls.cursor(readonly=True, shard=shard)
+    sql = "SELECT * FROM %s WHERE ID=?" % table_name
+    c.execute(sql, (id,))
     result = c.fetchone()
     return result
 
@@ -129,39 +740,159 @@ class DbManager(object):
       obj_type=obj_type,
       obj_id=obj_id,
       user_id=user_id,
-      parent_id=parent_id if parent_id else 'NULL',
+      parent_id=parent_id or None,
       comment=comment
     )
 
-    c = cls.insert('COMMENTS', params)
+    shard = cls.object_shard(obj_type, obj_id)
+    c = cls.cursor(shard=shard)
+    if cls.shards > 1:
+      params['id'] = sharding.allocate_ids(c)
+    cls.insert('COMMENTS', params, c)
     new_id = c.lastrowid
+    c.execute("INSERT INTO COMMENTS_FTS(rowid, COMMENT) VALUES (?, ?)",
+              (new_id, comment))
 
     # get all parent nodes
     parents = []
     if parent_id:
-      parents = cls.get_parents(parent_id)
+      parents = cls.get_parents(parent_id, shard)
       parents.append(parent_id)
 
     # add rows to COMMENTSTREE table
     for index, pid in enumerate(parents):
-      cls.insert('COMMENTSTREE', dict(id=new_id, parent_id=pid, level=index+1))
+      cls.insert('COMMENTSTREE', dict(id=new_id, parent_id=pid, level=index+1), c)
 
-    cls.log(new_id, user_id, 'add', comment)
-    cls.connection.commit()
+    cls.update_versions(obj_type, obj_id, parents, c)
+    cls.log(new_id, user_id, 'add', comment, shard)
+    cls.commit(shard)
+    cls.invalidate(obj_type, obj_id, top_level=not parent_id)
     return new_id
 
+  @classmethod
+  def create_comments_bulk(cls, comments, chunk_size=None):
+    """ Create many comments. Comments are written in chunks, one transaction
+    per chunk, with executemany for COMMENTS, COMMENTSTREE and HISTORY tables.
+
+    @param comments: iterable of dicts with obj_type, obj_id, user_id,
+      comment and optional id, parent_id, created keys. Parent comment must
+      be created before its children (earlier in the iterable or in database).
+    @param chunk_size: comments per transaction.
+    @return: number of created comments.
+    """
+    chunk_size = chunk_size or config.BULK_CHUNK_SIZE
+    count = 0
+    for chunk in utils.chunks(comments, chunk_size):
+      # comments of an object are in one shard, their order is kept
+      shards = {}
+      for item in chunk:
+        shards.setdefault(cls.object_shard(item['obj_type'], item['obj_id']), []).append(item)
+
+      for shard, items in sorted(shards.items()):
+        cls._create_comments_chunk(items, shard)
+      count += len(chunk)
+
+    return count
+
+  @classmethod
+  def _create_comments_chunk(cls, chunk, shard=0):
+    c = cls.cursor(shard=shard)
+    # take write lock before ids are allocated
+    c.execute('BEGIN IMMEDIATE')
+    try:
+      if cls.shards > 1:
+        next_id = sharding.allocate_ids(c, len(chunk))
+      else:
+        c.execute("SELECT max(ID) FROM COMMENTS")
+        max_id = c.fetchone()[0] or 0
+        c.execute("SELECT seq FROM sqlite_sequence WHERE name='COMMENTS'")
+        row = c.fetchone()
+        next_id = max(max_id, row[0] if row else 0) + 1
+
+      # parents lists of comments from chunk and their parents
+      ancestors = {}
+      # (obj_type, obj_id): parents of its new comments
+      objects = {}
+      comments_rows = []
+      tree_rows = []
+      history_rows = []
+      now = datetime.utcnow()
+
+      for item in chunk:
+        assert item['obj_type'] and item['obj_id'] and item['user_id']
+
+        comment_id = item.get('id')
+        if comment_id is None:
+          comment_id = next_id
+          next_id += 1
+        elif cls.shards == 1:
+          next_id = max(next_id, comment_id + 1)
+
+        parent_id = item.get('parent_id') or None
+        parents = []
+        if parent_id:
+          parents = ancestors.get(parent_id)
+          if parents is None:
+            parents = ancestors[parent_id] = cls.get_parents(parent_id, shard)
+          parents = parents + [parent_id]
+        ancestors[comment_id] = parents
+        objects.setdefault((item['obj_type'], item['obj_id']), set()).update(parents)
+
+        created = item.get('created') or now
+        if isinstance(created, datetime):
+          created = utils.dbdate(created)
+
+        comments_rows.append(cls.insert_values('COMMENTS', dict(
+          id=comment_id,
+          created_date=created,
+          updated_date=created,
+          obj_type=item['obj_type'],
+          obj_id=item['obj_id'],
+          user_id=item['user_id'],
+          parent_id=parent_id,
+          comment=item.get('comment', '')
+        )))
+
+        for index, pid in enumerate(parents):
+          tree_rows.append(cls.insert_values('COMMENTSTREE',
+                                             dict(id=comment_id, parent_id=pid, level=index+1)))
+
+        history_rows.append(cls.history_params(
+          comment_id, item['user_id'], 'add', item.get('comment')))
+
+      c.executemany(cls.insert_sql('COMMENTS')[0], comments_rows)
+      comment_index = [f for f, d in scheme.comments_meta].index('COMMENT')
+      c.executemany("INSERT INTO COMMENTS_FTS(rowid, COMMENT) VALUES (?, ?)",
+                    [(row[0], row[comment_index]) for row in comments_rows])
+      c.executemany(cls.insert_sql('COMMENTSTREE')[0], tree_rows)
+      for obj, parents in sorted(objects.items()):
+        cls.update_versions(obj[0], obj[1], parents, c)
+      cls.log_many(history_rows, c, shard)
+      cls.commit(shard)
+    except:
+      cls.rollback(shard)
+      raise
+
+    for obj in set((item['obj_type'], item['obj_id'])
+                   for item in chunk if not item.get('parent_id')):
+      cls.invalidate(*obj)
+
 
   @classmethod
-  def get_parents(cls, comment_id):
+  def get_parents(cls, comment_id, shard=None):
     """
     Return comment parents.
     @comment_id: comment id.
+    @shard: comment shard, found by id if it is not given.
     @return: parents list.
     """
     assert comment_id
-    sql = 'SELECT * FROM COMMENTSTREE WHERE ID=%s' % comment_id
-    c = cls.connection.cursor()
-    c.execute(sql)
+    if shard is None:
+      shard = cls.comment_shard(comment_id)
+    sql = 'SELECT * FROM COMMENTSTREE WHERE ID=?'
+    # part of the write path, so read inside the writer's transaction
+    c = cls.cursor(shard=shard)
+    c.execute(sql, (comment_id,))
     result = [(r['PARENT_ID'], r['LEVEL']) for r in c.fetchall()]
     result.sort(key=lambda x: x[1])
 
@@ -169,81 +900,429 @@ class DbManager(object):
 
 
   @classmethod
-  def get_comments(cls, obj_type, obj_id, user_id=None, limit=20, offset=0):
-    c = cls.connection.cursor()
-    sql = "SELECT * FROM COMMENTS WHERE OBJ_TYPE = '%s' AND OBJ_ID = '%s' AND PARENT_ID IS NULL" % (obj_type, obj_id)
+  def get_comments(cls, obj_type, obj_id, user_id=None, limit=20, cursor=None,
+                   cached=True):
+    """ Return page of top level object comments ordered by creation date.
+    @param cursor: next page cursor returned with previous page.
+    @param cached: False reads the database, the page cache may be older
+      in processes which did not make the change (up to CACHE_TTL).
+    @return: (rows, next page cursor or None).
+    """
+    # only the first page of all users comments is cached
+    cached = cached and user_id is None and not cursor
+    if cached:
+      pages = cls.page_cache.get((obj_type, obj_id)) or {}
+      if limit in pages:
+        return pages[limit]
+      token = cls.page_cache.token()
+
+    c = cls.cursor(readonly=True, shard=cls.object_shard(obj_type, obj_id))
+    c.execute(*cls.comments_query(obj_type, obj_id, user_id, limit, cursor))
+    result = cls.page_result(c.fetchall(), limit)
+
+    if cached:
+      pages = dict(pages)
+      pages[limit] = result
+      cls.page_cache.set((obj_type, obj_id), pages, token)
+
+    return result
+
+  @classmethod
+  def comments_query(cls, obj_type, obj_id, user_id, limit, cursor):
+    """ Return (sql, params) of get_comments page query."""
+    sql = "SELECT * FROM COMMENTS WHERE OBJ_TYPE = ? AND OBJ_ID = ? AND PARENT_ID IS NULL"
+    params = [obj_type, obj_id]
     if not user_id is None:
-      sql = sql + " AND USER_ID = '%s'" % user_id
+      sql = sql + " AND USER_ID = ?"
+      params.append(user_id)
 
-    sql = sql + " ORDER BY CREATED_DATE LIMIT %d OFFSET %d" % (limit, offset)
+    if cursor:
+      created, last_id = utils.decode_cursor(cursor)
+      sql = sql + " AND CREATED_DATE >= ? AND (CREATED_DATE > ? OR ID > ?)"
+      params.extend([created, created, last_id])
+
+    sql = sql + " ORDER BY CREATED_DATE, ID LIMIT ?"
+    params.append(limit + 1)
+    return sql, params
+
+  @classmethod
+  def get_comments_multi(cls, objects, limit=None):
+    """ Return first top level comments of many objects at once.
+    @param objects: list of (obj_type, obj_id).
+    @param limit: comments per object.
+    @return: dict {(obj_type, obj_id): (rows, next page cursor or None, total
+      top level comments)} for every object, cursor is for get_comments.
+    """
+    limit = limit or config.FEED_PAGE_SIZE
+    objects = list(set((obj_type, obj_id) for obj_type, obj_id in objects))
+    result = dict((key, ([], None, 0)) for key in objects)
+
+    shards = {}
+    for key in objects:
+      shards.setdefault(cls.object_shard(*key), []).append(key)
+
+    for shard, keys in shards.items():
+      c = cls.cursor(readonly=True, shard=shard)
+      # 2 parameters per object must fit to sqlite variables limit
+      for chunk in utils.chunks(keys, config.FEED_QUERY_OBJECTS):
+        c.execute(*cls.comments_multi_query(chunk, limit))
+        rows = {}
+        totals = {}
+        for r in c:
+          key = (r['OBJ_TYPE'], r['OBJ_ID'])
+          rows.setdefault(key, []).append(r)
+          totals[key] = r['TOTAL']
+
+        for key in rows:
+          page, next_cursor = cls.page_result(rows[key], limit)
+          result[key] = (page, next_cursor, totals[key])
 
-    c.execute(sql)
-    result = c.fetchall()
     return result
 
   @classmethod
-  def get_comment(cls, comment_id):
-    return cls.get('COMMENTS', comment_id)
+  def comments_multi_query(cls, objects, limit):
+    """ Return (sql, params) of get_comments_multi query. Window functions
+    number and count top level comments of every object over the object
+    index, only limit + 1 first rows of each object are read from table."""
+    sql = """WITH OBJECTS(OBJ_TYPE, OBJ_ID) AS (VALUES %s),
+    RANKED AS (
+      SELECT COMMENTS.ID,
+        ROW_NUMBER() OVER (PARTITION BY COMMENTS.OBJ_TYPE, COMMENTS.OBJ_ID
+                           ORDER BY COMMENTS.CREATED_DATE, COMMENTS.ID) AS ROW_NUM,
+        COUNT(*) OVER (PARTITION BY COMMENTS.OBJ_TYPE, COMMENTS.OBJ_ID) AS TOTAL
+      FROM OBJECTS JOIN COMMENTS ON COMMENTS.OBJ_TYPE = OBJECTS.OBJ_TYPE
+        AND COMMENTS.OBJ_ID = OBJECTS.OBJ_ID AND COMMENTS.PARENT_ID IS NULL
+    )
+    SELECT COMMENTS.*, RANKED.TOTAL FROM RANKED JOIN COMMENTS ON COMMENTS.ID = RANKED.ID
+    WHERE RANKED.ROW_NUM <= ?
+    ORDER BY COMMENTS.OBJ_TYPE, COMMENTS.OBJ_ID, RANKED.ROW_NUM""" % (
+      ', '.join(['(?, ?)'] * len(objects)))
+
+    params = [value for key in objects for value in key]
+    params.append(limit + 1)
+    return sql, params
+
+  @classmethod
+  def get_comment(cls, comment_id, cached=True):
+    try:
+      comment_id = int(comment_id)
+    except (TypeError, ValueError):
+      return None
+
+    # cached row may be older in processes which did not make the change
+    comment = cls.comment_cache.get(comment_id) if cached else None
+    if comment is None:
+      token = cls.comment_cache.token()
+      for shard in cls.comment_shards(comment_id):
+        comment = cls.get('COMMENTS', comment_id, shard)
+        if comment is not None:
+          break
+
+      if comment is not None:
+        cls.comment_cache.set(comment_id, comment, token)
+
+    return comment
+
+  @classmethod
+  def search_comments(cls, text, obj_type=None, obj_id=None, user_id=None,
+                      limit=20, cursor=None):
+    """ Full-text search of comments, best matches first. Without object
+    all shards are searched and their pages are merged by rank, ranks are
+    computed by every shard from its own statistics.
+    @param text: words to search, all of them must be in comment.
+    @param cursor: next page cursor returned with previous page.
+    @return: (rows with RANK field, next page cursor or None).
+    """
+    if obj_type and obj_id:
+      shards = [cls.object_shard(obj_type, obj_id)]
+    else:
+      shards = range(cls.shards)
+
+    query = cls.search_query(text, obj_type, obj_id, user_id, limit, cursor)
+    results = []
+    for shard in shards:
+      c = cls.cursor(readonly=True, shard=shard)
+      c.execute(*query)
+      results.append(c.fetchall())
+
+    rows = list(cls.merge_rows(results, ('RANK', 'ID')))[:limit + 1]
+    return cls.page_result(rows, limit, key=('RANK', 'ID'))
+
+  @classmethod
+  def search_query(cls, text, obj_type, obj_id, user_id, limit, cursor):
+    """ Return (sql, params) of search_comments page query."""
+    # every word is quoted, so user input can't break fts5 query syntax
+    match = ' '.join('"%s"' % word.replace('"', '""') for word in text.split())
+
+    sql = "SELECT COMMENTS.*, bm25(COMMENTS_FTS) AS RANK FROM COMMENTS_FTS " \
+          "JOIN COMMENTS ON COMMENTS.ID = COMMENTS_FTS.rowid " \
+          "WHERE COMMENTS_FTS MATCH ?"
+    params = [match]
+
+    for field, value in (('OBJ_TYPE', obj_type), ('OBJ_ID', obj_id),
+                         ('USER_ID', user_id)):
+      if value:
+        sql += " AND COMMENTS.%s = ?" % field
+        params.append(value)
+
+    if cursor:
+      rank, last_id = utils.decode_cursor(cursor, (utils.NUMBER, utils.INTEGER))
+      sql += " AND (bm25(COMMENTS_FTS) > ? OR " \
+             "(bm25(COMMENTS_FTS) = ? AND COMMENTS.ID > ?))"
+      params.extend([rank, rank, last_id])
+
+    sql += " ORDER BY RANK, COMMENTS.ID LIMIT ?"
+    params.append(limit + 1)
+    return sql, params
+
+  @classmethod
+  def rebuild_search_index(cls):
+    """ Rebuild COMMENTS_FTS index from COMMENTS table."""
+    for shard in range(cls.shards):
+      c = cls.cursor(shard=shard)
+      c.execute("INSERT INTO COMMENTS_FTS(COMMENTS_FTS) VALUES('rebuild')")
+      cls.commit(shard)
+
+  @classmethod
+  def get_comment_object(cls, comment_id, cursor):
+    """ Return (OBJ_TYPE, OBJ_ID, PARENT_ID, COMMENT) of comment inside the
+    writer's transaction."""
+    cursor.execute("SELECT OBJ_TYPE, OBJ_ID, PARENT_ID, COMMENT FROM COMMENTS WHERE ID=?",
+                   (comment_id,))
+    return cursor.fetchone()
+
+  @classmethod
+  def delete_search_index(cls, comment_id, comment, cursor):
+    """ Remove comment text from COMMENTS_FTS. External content index needs
+    the old text to find its terms."""
+    cursor.execute("INSERT INTO COMMENTS_FTS(COMMENTS_FTS, rowid, COMMENT) "
+                   "VALUES ('delete', ?, ?)", (comment_id, comment))
 
   @classmethod
   def delete_comment(cls, comment_id, user_id):
-    c = cls.connection.cursor()
+    shard = cls.comment_shard(comment_id)
+    c = cls.cursor(shard=shard)
     # check children
-    sql = "SELECT count(*) FROM COMMENTS WHERE PARENT_ID=%s" % comment_id
-    c.execute(sql)
+    sql = "SELECT count(*) FROM COMMENTS WHERE PARENT_ID=?"
+    c.execute(sql, (comment_id,))
     result = c.fetchone()
 
     if result[0]:
       raise CommentAPIError(1)
     else:
-      sql = "DELETE FROM COMMENTS WHERE ID=%s" % comment_id
-      c.execute(sql)
-      sql = "DELETE FROM COMMENTSTREE WHERE ID=%s" % comment_id
-      c.execute(sql)
+      obj = cls.get_comment_object(comment_id, c)
+      if obj:
+        cls.update_versions(obj[0], obj[1],
+                            cls.get_parents(comment_id, shard) + [int(comment_id)], c)
+      sql = "DELETE FROM COMMENTS WHERE ID=?"
+      c.execute(sql, (comment_id,))
+      sql = "DELETE FROM COMMENTSTREE WHERE ID=?"
+      c.execute(sql, (comment_id,))
+      if obj:
+        cls.delete_search_index(comment_id, obj[3], c)
 
-      cls.log(comment_id, user_id, 'delete')
-      cls.connection.commit()
+      cls.log(comment_id, user_id, 'delete', shard=shard)
+      cls.commit(shard)
+      if obj:
+        cls.invalidate(obj[0], obj[1], comment_id, not obj[2])
 
     return True
 
+  @classmethod
+  def delete_subtree(cls, comment_id, user_id, batch_size=None):
+    """ Delete comment with all its children (all levels) in one transaction.
+    Children are found with one COMMENTSTREE query and deleted in batches.
+    @return: number of deleted comments.
+    """
+    batch_size = batch_size or config.DELETE_BATCH_SIZE
+    shard = cls.comment_shard(comment_id)
+    c = cls.cursor(shard=shard)
+    # no new children can be added while the subtree is deleted
+    c.execute('BEGIN IMMEDIATE')
+    try:
+      obj = cls.get_comment_object(comment_id, c)
+      if not obj:
+        cls.commit(shard)
+        return 0
+
+      # subtrees of deleted children are not found any more
+      cls.update_versions(obj[0], obj[1],
+                          cls.get_parents(comment_id, shard) + [int(comment_id)], c)
+
+      c.execute("SELECT COMMENTS.ID, COMMENTS.COMMENT FROM COMMENTSTREE, COMMENTS "
+                "WHERE COMMENTSTREE.PARENT_ID=? AND COMMENTS.ID=COMMENTSTREE.ID",
+                (comment_id,))
+      rows = [(int(comment_id), obj[3])] + [tuple(r) for r in c.fetchall()]
+
+      for batch in utils.chunks(rows, batch_size):
+        ids = [r[0] for r in batch]
+        marks = ','.join('?' * len(ids))
+        c.execute("DELETE FROM COMMENTS WHERE ID IN (%s)" % marks, ids)
+        c.execute("DELETE FROM COMMENTSTREE WHERE ID IN (%s)" % marks, ids)
+        c.executemany("INSERT INTO COMMENTS_FTS(COMMENTS_FTS, rowid, COMMENT) "
+                      "VALUES ('delete', ?, ?)", batch)
+        cls.log_many([cls.history_params(id, user_id, 'delete') for id in ids], c, shard)
+
+      cls.commit(shard)
+    except:
+      cls.rollback(shard)
+      raise
+
+    for id, text in rows:
+      cls.comment_cache.delete(id)
+    cls.invalidate(obj[0], obj[1], top_level=not obj[2])
+    return len(rows)
 
   @classmethod
   def update_comment(cls, comment_id, user_id, comment):
-    c = cls.connection.cursor()
-    sql = "UPDATE COMMENTS SET COMMENT='%s' WHERE ID=%s" % (comment, comment_id)
-    c.execute(sql)
+    shard = cls.comment_shard(comment_id)
+    c = cls.cursor(shard=shard)
+    obj = cls.get_comment_object(comment_id, c)
+    sql = "UPDATE COMMENTS SET COMMENT=? WHERE ID=?"
+    c.execute(sql, (comment, comment_id))
+    if obj:
+      cls.delete_search_index(comment_id, obj[3], c)
+      c.execute("INSERT INTO COMMENTS_FTS(rowid, COMMENT) VALUES (?, ?)",
+                (comment_id, comment))
+      cls.update_versions(obj[0], obj[1],
+                          cls.get_parents(comment_id, shard) + [int(comment_id)], c)
+
+    cls.log(comment_id, user_id, 'modified', comment, shard)
+    cls.commit(shard)
+    if obj:
+      cls.invalidate(obj[0], obj[1], comment_id, not obj[2])
+
 
-    cls.log(comment_id, user_id, 'modified', comment)
-    cls.connection.commit()
+  @classmethod
+  def update_versions(cls, obj_type, obj_id, comment_ids, cursor):
+    """ Increment versions of object comments and of subtrees of comment_ids
+    inside the writer's transaction."""
+    now = utils.dbdate(datetime.utcnow())
+    rows = [(id, obj_type, obj_id, now) for id in [0] + sorted(set(comment_ids))]
+    # empty object is the version of all comments of shard, see data_version
+    rows.append((0, '', '', now))
+    cursor.executemany(
+      "INSERT INTO OBJECT_VERSIONS (COMMENT_ID, OBJ_TYPE, OBJ_ID, VERSION, UPDATED_DATE) "
+      "VALUES (?, ?, ?, 1, ?) ON CONFLICT (COMMENT_ID, OBJ_TYPE, OBJ_ID) "
+      "DO UPDATE SET VERSION=VERSION+1, UPDATED_DATE=excluded.UPDATED_DATE", rows)
+
+  @classmethod
+  def get_object_version(cls, obj_type, obj_id):
+    c = cls.cursor(readonly=True, shard=cls.object_shard(obj_type, obj_id))
+    c.execute("SELECT VERSION, UPDATED_DATE FROM OBJECT_VERSIONS "
+              "WHERE COMMENT_ID=0 AND OBJ_TYPE=? AND OBJ_ID=?", (obj_type, obj_id))
+    row = c.fetchone()
+    return tuple(row) if row else (0, None)
 
+  @classmethod
+  def get_subtree_version(cls, comment_id):
+    """ Look for version in shards of comment, comments are not read."""
+    for shard in cls.comment_shards(comment_id):
+      c = cls.cursor(readonly=True, shard=shard)
+      c.execute("SELECT VERSION, UPDATED_DATE FROM OBJECT_VERSIONS WHERE COMMENT_ID=?",
+                (int(comment_id),))
+      row = c.fetchone()
+      if row:
+        return tuple(row)
+    return 0, None
 
   @classmethod
   def get_comments_tree(cls, comment_id):
     """ Return comment children (all levels).
     @param comment_id: comment id.
     """
-    c = cls.connection.cursor()
+    c = cls.cursor(readonly=True, shard=cls.comment_shard(comment_id))
     sql = "SELECT * FROM COMMENTS, COMMENTSTREE " \
-          "WHERE COMMENTSTREE.PARENT_ID=%s AND " \
-          "COMMENTS.ID=COMMENTSTREE.ID ORDER BY COMMENTS.ID" % comment_id
-    c.execute(sql)
+          "WHERE COMMENTSTREE.PARENT_ID=? AND " \
+          "COMMENTS.ID=COMMENTSTREE.ID ORDER BY COMMENTS.ID"
+    c.execute(sql, (comment_id,))
     result = c.fetchall()
     return result
 
   @classmethod
-  def get_reports(cls, user_id, limit=20, offset=0):
-    c = cls.connection.cursor()
+  def iter_subtree(cls, comment_id, max_depth=None, child_limit=None, after_id=None):
+    """ Walk get_subtree rows while they are read from database, see
+    StorageBackend.iter_subtree."""
+    max_depth = max_depth or config.TREE_MAX_DEPTH
+    child_limit = child_limit or config.TREE_CHILD_LIMIT
+    comment_id = int(comment_id)
+
+    c = cls.cursor(readonly=True, shard=cls.comment_shard(comment_id))
+    c.execute("SELECT count(*) FROM COMMENTS WHERE PARENT_ID=? AND ID>?",
+              (comment_id, after_id or 0))
+    root = TreeNode(comment_id, None, 0, c.fetchone()[0])
+    root.last_id = after_id
+    stack = [root]
+
+    c.execute(*cls.subtree_query(comment_id, max_depth, child_limit, after_id))
+    for r in c:
+      # leave subtrees of previous comments up to the parent of this one
+      while stack[-1].depth >= r['DEPTH']:
+        yield 'close', stack.pop().close()
+
+      parent = stack[-1]
+      parent.shown += 1
+      parent.last_id = r['ID']
+
+      node = TreeNode(r['ID'], r, r['DEPTH'], r['CHILDREN'])
+      stack.append(node)
+      yield 'open', node
+
+    while stack:
+      yield 'close', stack.pop().close()
+
+  @classmethod
+  def subtree_query(cls, comment_id, max_depth, child_limit, after_id=None):
+    """ Return (sql, params) of get_subtree query. Recursive query walks
+    children by PARENT_ID and takes at most child_limit children of every
+    comment, the queue ordered by depth gives depth-first order."""
+    sql = """WITH RECURSIVE TREE AS (
+      SELECT COMMENTS.*, 1 AS DEPTH FROM COMMENTS
+      WHERE ID IN (SELECT ID FROM COMMENTS WHERE PARENT_ID = ? AND ID > ?
+                   ORDER BY ID LIMIT ?)
+      UNION ALL
+      SELECT COMMENTS.*, TREE.DEPTH + 1 FROM TREE JOIN COMMENTS
+      ON COMMENTS.PARENT_ID = TREE.ID
+      WHERE TREE.DEPTH < ? AND COMMENTS.ID IN (
+        SELECT CHILD.ID FROM COMMENTS AS CHILD WHERE CHILD.PARENT_ID = TREE.ID
+        ORDER BY CHILD.ID LIMIT ?)
+      ORDER BY DEPTH DESC, ID
+    )
+    SELECT TREE.*, (SELECT count(*) FROM COMMENTS AS CHILD
+                    WHERE CHILD.PARENT_ID = TREE.ID) AS CHILDREN
+    FROM TREE"""
+    return sql, (comment_id, after_id or 0, child_limit, max_depth, child_limit)
+
+  @classmethod
+  def get_reports(cls, user_id, limit=20, cursor=None):
+    """ Return page of reports, newest first.
+    @param cursor: next page cursor returned with previous page.
+    @return: (rows, next page cursor or None).
+    """
+    c = cls.cursor(readonly=True)
+    c.execute(*cls.reports_query(user_id, limit, cursor))
+    return cls.page_result(c.fetchall(), limit)
 
+  @classmethod
+  def reports_query(cls, user_id, limit, cursor):
+    """ Return (sql, params) of get_reports page query."""
+    where = []
+    params = []
     if user_id:
-      sql = "SELECT * FROM REPORTS WHERE OWNER='%s' " \
-            "ORDER BY CREATED_DATE DESC LIMIT %d OFFSET %d" % (user_id, limit, offset)
-    else:
-      sql = "SELECT * FROM REPORTS " \
-            "ORDER BY CREATED_DATE DESC LIMIT %d OFFSET %d" % (limit, offset)
+      where.append("OWNER=?")
+      params.append(user_id)
 
-    c.execute(sql)
-    result = c.fetchall()
-    return result
+    if cursor:
+      created, last_id = utils.decode_cursor(cursor)
+      where.append("CREATED_DATE <= ? AND (CREATED_DATE < ? OR ID < ?)")
+      params.extend([created, created, last_id])
+
+    sql = "SELECT * FROM REPORTS "
+    if where:
+      sql += "WHERE %s " % " AND ".join(where)
+    sql += "ORDER BY CREATED_DATE DESC, ID DESC LIMIT ?"
+    params.append(limit + 1)
+    return sql, params
 
   @classmethod
   def create_report(cls, owner, user_id, obj_type=None, obj_id=None,
@@ -252,7 +1331,7 @@ class DbManager(object):
     """Add report description to REPORTS table."""
     assert user_id
     now = datetime.utcnow()
-    c = cls.insert('REPORTS', dict(
+    params = dict(
       owner=owner,
       user_id=user_id,
       obj_type=obj_type or '',
@@ -264,44 +1343,292 @@ class DbManager(object):
       file_name='',
       created_date=utils.dbdate(now),
       updated_date=utils.dbdate(now)
-    ))
-    cls.connection.commit()
+    )
+    if not config.REPORT_CACHE:
+      c = cls.insert('REPORTS', params)
+      cls.commit()
+      return c.lastrowid
+
+    params['cache_key'] = cls.report_cache_key(
+      user_id, obj_type, obj_id, start_date, end_date, file_type,
+      cls.data_version(obj_type, obj_id))
+    c = cls.cursor()
+    # the same report requested at once is created only once
+    c.execute('BEGIN IMMEDIATE')
+    try:
+      c.execute("SELECT ID, STATUS, FILE_NAME FROM REPORTS WHERE CACHE_KEY=? "
+                "AND SOURCE_ID IS NULL AND STATUS IN ('working', 'completed') "
+                "ORDER BY ID LIMIT 1", (params['cache_key'],))
+      source = c.fetchone()
+      if source:
+        # completed report gets the file at once and does not wait for source
+        params.update(status=source[1], file_name=source[2])
+        if source[1] == 'working':
+          params['source_id'] = source[0]
+      cls.insert('REPORTS', params, c)
+      cls.commit()
+    except:
+      c.connection.rollback()
+      raise
     return c.lastrowid
 
+  @classmethod
+  def get_working_reports(cls):
+    c = cls.cursor(readonly=True)
+    c.execute("SELECT * FROM REPORTS WHERE SOURCE_ID IS NULL AND %s ORDER BY ID"
+              % cls.report_exported_sql)
+    return c.fetchall()
+
+  @classmethod
+  def data_version(cls, obj_type=None, obj_id=None):
+    """ Return OBJECT_VERSIONS version of object, versions of all shards
+    without object. They are written in transaction of comment change,
+    asynchronous HISTORY does not delay them."""
+    if obj_type and obj_id:
+      return str(cls.get_object_version(obj_type, obj_id)[0])
+    versions = []
+    for shard in range(cls.shards):
+      c = cls.cursor(readonly=True, shard=shard)
+      c.execute("SELECT VERSION FROM OBJECT_VERSIONS "
+                "WHERE COMMENT_ID=0 AND OBJ_TYPE='' AND OBJ_ID=''")
+      row = c.fetchone()
+      versions.append(str(row[0] if row else 0))
+    return ','.join(versions)
+
   @classmethod
   def get_report_data(cls, report_id):
+    return list(cls.iter_report_data(report_id))
+
+  @classmethod
+  def get_report(cls, report_id):
+    return cls.get('REPORTS', report_id)
+
+  @classmethod
+  def iter_report_data(cls, report_id, batch_size=None, since=None, until=None,
+                       after=None):
+    """ Iterate comments of report ordered by creation date. Rows are read by
+    fetchmany batches of batch_size rows (REPORT_FETCH_SIZE by default).
+    since (inclusive) and until (exclusive) dates narrow report dates range,
+    after skips comments up to (CREATED_DATE, ID) mark."""
     report = cls.get('REPORTS', report_id)
     assert report
 
-    c = cls.connection.cursor()
-    sql = "SELECT * FROM COMMENTS WHERE USER_ID='%s'" % report['user_id']
+    # every shard returns sorted rows, they are merged by date
+    query = cls.report_data_query(report, since, until, after)
+    results = []
+    for shard in cls.report_shards(report):
+      c = cls.cursor(readonly=True, shard=shard)
+      c.execute(*query)
+      results.append(cls.iter_cursor(c, batch_size))
+
+    return cls.merge_rows(results, ('CREATED_DATE', 'ID'))
+
+  @classmethod
+  def get_report_dates(cls, report_id):
+    report = cls.get('REPORTS', report_id)
+    assert report
+
+    where, params = cls.report_filter(report)
+    sql = "SELECT min(CREATED_DATE), max(CREATED_DATE) FROM COMMENTS WHERE " + where
+    first, last = None, None
+    for shard in cls.report_shards(report):
+      c = cls.cursor(readonly=True, shard=shard)
+      c.execute(sql, params)
+      shard_first, shard_last = c.fetchone()
+      if shard_first is not None:
+        first = min(first or shard_first, shard_first)
+        last = max(last, shard_last)
+
+    return first, last
 
+  @classmethod
+  def report_shards(cls, report):
+    """ Return shards with comments of report."""
     if report['obj_type'] and report['obj_id']:
-      sql += " AND OBJ_TYPE='%s' AND OBJ_ID='%s'" % (report['obj_type'], report['obj_id'])
+      return [cls.object_shard(report['obj_type'], report['obj_id'])]
+    return range(cls.shards)
+
+  @classmethod
+  def iter_cursor(cls, cursor, batch_size=None):
+    """ Yield rows of executed query read by fetchmany batches."""
+    batch_size = batch_size or config.REPORT_FETCH_SIZE
+    while True:
+      rows = cursor.fetchmany(batch_size)
+      if not rows:
+        break
+      for r in rows:
+        yield r
+
+  @classmethod
+  def report_changed(cls, report_id):
+    report = cls.get('REPORTS', report_id)
+    assert report
+    if cls.report_expired(report) or config.HISTORY_MODE == 'async':
+      # changes logged by other processes (web server) may be still queued,
+      # only synchronous HISTORY shows all committed changes
+      return True
+
+    exported = report['exported_date']
+    where, params = cls.report_filter(report, upto=cls.report_mark(report))
+    count = 0
+    for shard in cls.report_shards(report):
+      c = cls.cursor(readonly=True, shard=shard)
+      # deleted comments are not in COMMENTS, so any deletion may be in report
+      c.execute("SELECT 1 FROM HISTORY WHERE CREATED_DATE >= ? AND ACTION='delete' "
+                "LIMIT 1", (exported,))
+      if c.fetchone():
+        return True
+
+      c.execute("SELECT 1 FROM HISTORY WHERE CREATED_DATE >= ? AND ACTION='modified' "
+                "AND EXISTS (SELECT 1 FROM COMMENTS WHERE ID=HISTORY.COMMENT_ID AND %s) "
+                "LIMIT 1" % where, [exported] + params)
+      if c.fetchone():
+        return True
+
+      c.execute("SELECT count(*) FROM COMMENTS WHERE " + where, params)
+      count += c.fetchone()[0]
+
+    # comments created with dates before the mark
+    return count != report['exported_rows']
+
+  @classmethod
+  def report_filter(cls, report, since=None, until=None, after=None, upto=None):
+    """ Return (where clause, params) of comments of report. after and upto
+    are (CREATED_DATE, ID) keys: comments greater than after, not greater
+    than upto."""
+    sql = "USER_ID=?"
+    params = [report['user_id']]
+
+    if report['obj_type'] and report['obj_id']:
+      sql += " AND OBJ_TYPE=? AND OBJ_ID=?"
+      params.extend([report['obj_type'], report['obj_id']])
     elif report['obj_type']:
-      sql += " AND OBJ_TYPE='%s'" % report['obj_type']
+      sql += " AND OBJ_TYPE=?"
+      params.append(report['obj_type'])
 
     if report['start_date']:
-      sql += " AND CREATED_DATE >= '%s'" % report['start_date']
+      sql += " AND CREATED_DATE >= ?"
+      params.append(report['start_date'])
 
     if report['end_date']:
-      sql += " AND CREATED_DATE <= '%s'" % report['end_date']
+      sql += " AND CREATED_DATE <= ?"
+      params.append(report['end_date'])
 
-    sql += " ORDER BY CREATED_DATE"
-    c.execute(sql)
-    data = c.fetchall()
-    return data
+    if since:
+      sql += " AND CREATED_DATE >= ?"
+      params.append(since)
 
-  @classmethod
-  def get_report_file_name(cls, report_id):
-    return 'static/reports/report_%s.csv' % report_id
+    if until:
+      sql += " AND CREATED_DATE < ?"
+      params.append(until)
+
+    # date range first, so the date index is used for keys comparison
+    if after:
+      sql += " AND CREATED_DATE >= ? AND (CREATED_DATE > ? OR ID > ?)"
+      params.extend([after[0], after[0], after[1]])
 
+    if upto:
+      sql += " AND CREATED_DATE <= ? AND (CREATED_DATE < ? OR ID <= ?)"
+      params.extend([upto[0], upto[0], upto[1]])
+
+    return sql, params
+
+  @classmethod
+  def report_data_query(cls, report, since=None, until=None, after=None):
+    """ Return (sql, params) selecting comments of report."""
+    where, params = cls.report_filter(report, since, until, after)
+    return "SELECT * FROM COMMENTS WHERE %s ORDER BY CREATED_DATE, ID" % where, params
 
   @classmethod
   def update_report(cls, report_id, file_name, file_type='csv', status='completed', description=''):
-    c = cls.connection.cursor()
-    sql = "UPDATE REPORTS SET FILE_TYPE='%s', FILE_NAME='%s', " \
-          "STATUS='%s', DESCRIPTION='%s' WHERE ID=%s" % \
-          (file_type, file_name, status, description, report_id)
-    c.execute(sql)
-    cls.connection.commit()
\ No newline at end of file
+    c = cls.cursor()
+    # cancelled source is exported for reports sharing its file
+    sql = "UPDATE REPORTS SET FILE_TYPE=?, FILE_NAME=?, " \
+          "STATUS=CASE STATUS WHEN 'cancelled' THEN STATUS ELSE ? END, " \
+          "DESCRIPTION=?, SOURCE_ID=NULL WHERE ID=?"
+    c.execute(sql, (file_type, file_name, status, description, report_id))
+    # only working reports wait for the result, they stop sharing after it
+    sql = "UPDATE REPORTS SET FILE_TYPE=?, FILE_NAME=?, STATUS=?, DESCRIPTION=?, " \
+          "SOURCE_ID=NULL WHERE SOURCE_ID=? AND STATUS='working'"
+    c.execute(sql, (file_type, file_name, status, description, report_id))
+    cls.commit()
+
+  @classmethod
+  def update_report_status(cls, report_id, status):
+    c = cls.cursor()
+    c.execute("UPDATE REPORTS SET STATUS=? WHERE ID=?", (status, report_id))
+    cls.commit()
+
+  @classmethod
+  def restart_report(cls, report_id):
+    c = cls.cursor()
+    c.execute("UPDATE REPORTS SET STATUS='working' WHERE ID=? AND NOT %s"
+              % cls.report_exported_sql, (report_id,))
+    cls.commit()
+    return c.rowcount > 0
+
+  @classmethod
+  def start_report(cls, report_id, total_rows):
+    c = cls.cursor()
+    now = utils.dbdate(datetime.utcnow())
+    # cancelled report is exported for reports sharing its file
+    c.execute("UPDATE REPORTS SET STATUS=CASE STATUS WHEN 'cancelled' THEN STATUS "
+              "ELSE 'working' END, STARTED_DATE=?, PROGRESS_ROWS=0, "
+              "TOTAL_ROWS=?, ROWS_PER_SEC=0, PROGRESS_DATE=? "
+              "WHERE ID=? AND (STATUS!='cancelled' OR %s)" % cls.report_exported_sql,
+              (now, total_rows, now, report_id))
+    cls.commit()
+    return c.rowcount > 0
+
+  @classmethod
+  def update_report_progress(cls, report_id, rows):
+    c = cls.cursor()
+    # throughput since the start by database clock (UTC like dbdate)
+    c.execute("UPDATE REPORTS SET PROGRESS_ROWS=PROGRESS_ROWS+?, "
+              "PROGRESS_DATE=datetime('now'), ROWS_PER_SEC=(PROGRESS_ROWS+?) / "
+              "max(1.0, (julianday('now') - julianday(STARTED_DATE)) * 86400) "
+              "WHERE ID=?", (rows, rows, report_id))
+    c.execute("SELECT %s FROM REPORTS WHERE ID=?" % cls.report_exported_sql,
+              (report_id,))
+    exported = c.fetchone()
+    cls.commit()
+    return exported is not None and bool(exported[0])
+
+  @classmethod
+  def cancel_report(cls, report_id):
+    c = cls.cursor()
+    c.execute("UPDATE REPORTS SET STATUS='cancelled', SOURCE_ID=NULL "
+              "WHERE ID=? AND STATUS='working'", (report_id,))
+    cls.commit()
+    return c.rowcount > 0
+
+  @classmethod
+  def report_file_shared(cls, report_id, file_name):
+    c = cls.cursor(readonly=True)
+    c.execute("SELECT 1 FROM REPORTS WHERE ID!=? AND (FILE_NAME=? OR SOURCE_ID=?) "
+              "LIMIT 1", (report_id, file_name, report_id))
+    return c.fetchone() is not None
+
+  @classmethod
+  def count_report_data(cls, report_id, after=None):
+    report = cls.get('REPORTS', report_id)
+    assert report
+
+    where, params = cls.report_filter(report, after=after)
+    count = 0
+    for shard in cls.report_shards(report):
+      c = cls.cursor(readonly=True, shard=shard)
+      c.execute("SELECT count(*) FROM COMMENTS WHERE " + where, params)
+      count += c.fetchone()[0]
+    return count
+
+  @classmethod
+  def update_report_mark(cls, report_id, last_date, last_id, rows, exported_date):
+    c = cls.cursor()
+    sql = "UPDATE REPORTS SET LAST_DATE=?, LAST_ID=?, EXPORTED_ROWS=?, " \
+          "EXPORTED_DATE=? WHERE ID=?"
+    c.execute(sql, (last_date, last_id, rows, exported_date, report_id))
+    cls.commit()
+
+
+atexit.register(DbManager.stop_history)
@@ -6,4 +6,101 @@ STATIC_ROOT_URL = 'static'
 
 IN_DEV_SERVER = True
 
-DB_NAME = 'comments.db'
\ No newline at end of file
+DB_NAME = 'comments.db'
+# connections per pool; paste httpserver runs 10 worker threads by default
+DB_POOL_SIZE = 10
+DB_READ_POOL_SIZE = 10
+# seconds to wait for a free pooled connection
+DB_POOL_TIMEOUT = 30
+# seconds sqlite waits for the write lock
+DB_BUSY_TIMEOUT = 10
+DB_STATEMENT_CACHE_SIZE = 100
+
+# storage backend: 'sqlite' or 'memory' (process memory, see memory.py)
+STORAGE_BACKEND = 'sqlite'
+
+# comments are split to this number of database files by object, see sharding
+DB_SHARDS = 1
+
+# comments per transaction in DbManager.create_comments_bulk
+BULK_CHUNK_SIZE = 5000
+
+# DbManager read-through caches: entries count and time to live in seconds
+CACHE_COMMENTS_SIZE = 10000
+CACHE_PAGES_SIZE = 1000
+CACHE_TTL = 60
+# rendered comments tables of the comments page by object version: entries
+# count and total length of their html
+FRAGMENT_CACHE_SIZE = 1000
+FRAGMENT_CACHE_BYTES = 16 * 1024 * 1024
+
+# HISTORY audit log mode:
+#   sync - row is written in the transaction of the comment change
+#   async - rows are queued after the change is committed and written in
+#     batches by a background thread, restarted reports are rebuilt instead of appended (see report_changed)
+HISTORY_MODE = 'sync'
+HISTORY_BATCH_SIZE = 500
+# seconds before a non full batch is written
+HISTORY_FLUSH_INTERVAL = 1.0
+HISTORY_QUEUE_SIZE = 10000
+# seconds to wait for free space in a full queue
+HISTORY_PUT_TIMEOUT = 5
+
+# HISTORY retention: rows older than HISTORY_RETENTION_DAYS are moved to
+# per-month archive tables ('table') or NDJSON files in HISTORY_ARCHIVE_DIR
+# ('file'); archives older than HISTORY_ARCHIVE_MONTHS are dropped (0 - keep).
+HISTORY_RETENTION_DAYS = 90
+HISTORY_ARCHIVE = 'table'
+HISTORY_ARCHIVE_DIR = 'archive'
+HISTORY_ARCHIVE_MONTHS = 24
+# rows moved per transaction and pause in seconds between transactions
+HISTORY_COMPACT_BATCH = 1000
+HISTORY_COMPACT_PAUSE = 0.01
+
+# comments deleted per statement by DbManager.delete_subtree
+DELETE_BATCH_SIZE = 500
+
+# comments tree page: levels and children per comment loaded at once
+TREE_MAX_DEPTH = 3
+TREE_CHILD_LIMIT = 20
+
+# streamed pages are sent by chunks of this size (characters)
+STREAM_CHUNK_SIZE = 8192
+
+# comments feed: top level comments per object and objects per request/query
+FEED_PAGE_SIZE = 3
+FEED_MAX_OBJECTS = 100
+FEED_QUERY_OBJECTS = 400
+
+# report files: directory, rows per fetchmany and file write buffer (bytes)
+REPORTS_DIR = 'static/reports'
+REPORT_FETCH_SIZE = 1000
+REPORT_BUFFER_SIZE = 1024 * 1024
+# reports longer than REPORT_SLICE_DAYS days are exported by date slices in
+# REPORT_WORKERS processes
+REPORT_SLICE_DAYS = 30
+REPORT_WORKERS = 4
+# new report with the same parameters and data as a working or completed one
+# shares its file instead of running the query again
+REPORT_CACHE = True
+# file type of new reports (reports.FILE_TYPES) and gzip compression level
+REPORT_FILE_TYPE = 'csv.gz'
+REPORT_GZIP_LEVEL = 6
+# files are sent by StaticFileHandler in parts of STATIC_CHUNK_SIZE bytes
+STATIC_CHUNK_SIZE = 64 * 1024
+# Cache-Control max-age of static files, report files are revalidated
+STATIC_MAX_AGE = 3600
+# StaticFileHandler caches of file types and stat results: entries count and
+# seconds a stat result is used
+STATIC_CACHE_SIZE = 1000
+STATIC_STAT_TTL = 1
+# working report progress is stored not more often than every
+# REPORT_PROGRESS_INTERVAL seconds
+REPORT_PROGRESS_INTERVAL = 5
+# executor of tasks.py tasks: 'celery' (broker is needed) or 'local' (threads
+# of application process), see executors.py
+TASK_EXECUTOR = 'celery'
+LOCAL_WORKERS = 2
+LOCAL_QUEUE_SIZE = 100
+# running tasks of one owner (e.g. reports of one admin)
+LOCAL_OWNER_LIMIT = 1
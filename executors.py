@@ -0,0 +1,168 @@
+""" Executors of background tasks.
+
+TASK_EXECUTOR config selects how tasks.py tasks run:
+  'celery' - by Celery workers, tasks are sent to the broker.
+  'local' - by LocalExecutor threads of the application process, no broker is
+    needed. Queue is bounded, tasks with higher priority run first and every
+    owner has at most LOCAL_OWNER_LIMIT running tasks.
+
+Tasks are submitted with submit(task, args, owner=..., priority=...), task is
+a function of tasks.py (Celery task object).
+"""
+__author__ = 'okoneshnikov'
+import heapq
+import logging
+import threading
+import itertools
+
+import config
+
+# task priorities, higher runs first
+PRIORITY_LOW = -1
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 1
+
+_executors = {}
+_local = threading.local()
+
+
+class QueueFull(Exception):
+  """ Task is not accepted: LOCAL_QUEUE_SIZE tasks are waiting."""
+
+
+def in_process():
+  """ Check if current thread is a LocalExecutor worker. Tasks running in
+  application process share its storage connections."""
+  return getattr(_local, 'worker', False)
+
+
+class CeleryExecutor(object):
+  """ Send tasks to Celery broker. Owner limit is not applied, priority is
+  passed to the broker on its scale."""
+
+  # Redis broker takes priorities 0-9 by steps of 3, lower runs first
+  priorities = {PRIORITY_HIGH: 0, PRIORITY_NORMAL: 3, PRIORITY_LOW: 6}
+
+  def submit(self, task, args=(), kwargs=None, owner=None, priority=PRIORITY_NORMAL):
+    return task.apply_async(args, kwargs, priority=self.broker_priority(priority))
+
+  def broker_priority(self, priority):
+    """ Return broker priority of executor priority, out of range ones get
+    the nearest."""
+    priority = max(PRIORITY_LOW, min(PRIORITY_HIGH, priority))
+    return self.priorities[priority]
+
+  def start(self):
+    pass
+
+  def stats(self):
+    return {}
+
+
+class LocalExecutor(object):
+  """ Run tasks in a pool of threads of this process.
+
+  Waiting tasks are kept in a heap ordered by (priority, submit order). A
+  worker takes the first task whose owner has less than owner_limit running
+  tasks, other tasks wait.
+  """
+
+  def __init__(self, workers=None, queue_size=None, owner_limit=None):
+    self.workers = workers or config.LOCAL_WORKERS
+    self.queue_size = queue_size or config.LOCAL_QUEUE_SIZE
+    self.owner_limit = owner_limit or config.LOCAL_OWNER_LIMIT
+    self._cond = threading.Condition()
+    self._heap = []
+    self._order = itertools.count()
+    self._running = {}
+    self._threads = []
+    self._stats = dict(submitted=0, rejected=0, completed=0, failed=0)
+
+  def submit(self, task, args=(), kwargs=None, owner=None, priority=PRIORITY_NORMAL):
+    """ Queue task.
+    @raise QueueFull: queue_size tasks are waiting.
+    """
+    with self._cond:
+      if len(self._heap) >= self.queue_size:
+        self._stats['rejected'] += 1
+        raise QueueFull()
+
+      heapq.heappush(self._heap, (-priority, next(self._order),
+                                  task, args, kwargs or {}, owner))
+      self._stats['submitted'] += 1
+      self._cond.notify_all()
+
+    self.start()
+
+  def start(self):
+    """ Start worker threads if they are not started."""
+    with self._cond:
+      while len(self._threads) < self.workers:
+        thread = threading.Thread(target=self._work, name='task-worker-%d' % len(self._threads))
+        thread.daemon = True
+        self._threads.append(thread)
+        thread.start()
+
+  def _next_task(self):
+    """ Remove and return the first task with free owner slot or None."""
+    for item in sorted(self._heap):
+      owner = item[-1]
+      if owner is None or self._running.get(owner, 0) < self.owner_limit:
+        self._heap.remove(item)
+        heapq.heapify(self._heap)
+        return item
+    return None
+
+  def _work(self):
+    _local.worker = True
+    while True:
+      with self._cond:
+        item = self._next_task()
+        while item is None:
+          self._cond.wait()
+          item = self._next_task()
+
+        priority, order, task, args, kwargs, owner = item
+        self._running[owner] = self._running.get(owner, 0) + 1
+
+      try:
+        task(*args, **kwargs)
+        result = 'completed'
+      except Exception:
+        logging.exception('Task %s%r failed', getattr(task, 'name', task), args)
+        result = 'failed'
+
+      with self._cond:
+        self._running[owner] -= 1
+        if not self._running[owner]:
+          del self._running[owner]
+        self._stats[result] += 1
+        # task of this owner may wait for the slot
+        self._cond.notify_all()
+
+  def join(self):
+    """ Wait until all queued tasks are done."""
+    with self._cond:
+      while self._heap or self._running:
+        self._cond.wait(0.1)
+
+  def stats(self):
+    with self._cond:
+      result = dict(self._stats)
+      result.update(waiting=len(self._heap), running=sum(self._running.values()))
+    return result
+
+
+def executor(name=None):
+  """ Return executor by name, TASK_EXECUTOR by default."""
+  name = name or config.TASK_EXECUTOR
+  result = _executors.get(name)
+  if result is None:
+    assert name in ('celery', 'local'), name
+    result = _executors[name] = LocalExecutor() if name == 'local' else CeleryExecutor()
+  return result
+
+
+def submit(task, args=(), kwargs=None, owner=None, priority=PRIORITY_NORMAL):
+  """ Run task by configured executor."""
+  return executor().submit(task, args, kwargs, owner, priority)
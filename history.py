@@ -0,0 +1,102 @@
+__author__ = 'okoneshnikov'
+import os
+import time
+import sqlite3
+import logging
+import threading
+import Queue
+
+import config
+
+# queue markers
+FLUSH = 'flush'
+STOP = 'stop'
+
+
+class HistoryWriter(object):
+  """ Write-behind HISTORY log.
+
+  Rows are queued in memory and written by a background thread with one
+  executemany per batch. A batch is written when it has batch_size rows or
+  flush_interval seconds passed since its first row. The queue is bounded:
+  when it is full add() waits for free space up to put_timeout seconds.
+  """
+
+  def __init__(self, dbname, insert_sql, batch_size=None, flush_interval=None,
+               queue_size=None, put_timeout=None):
+    self.dbname = dbname
+    self.insert_sql = insert_sql
+    self.batch_size = batch_size or config.HISTORY_BATCH_SIZE
+    self.flush_interval = flush_interval or config.HISTORY_FLUSH_INTERVAL
+    self.put_timeout = put_timeout or config.HISTORY_PUT_TIMEOUT
+    self.queue = Queue.Queue(queue_size or config.HISTORY_QUEUE_SIZE)
+    self._lock = threading.Lock()
+    self._thread = None
+    self._pid = None
+
+  def start(self):
+    with self._lock:
+      # thread of parent process does not exist after fork
+      if self._thread is None or self._pid != os.getpid():
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='HistoryWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+  def add(self, values):
+    """ Queue HISTORY row values.
+    @return: False if queue stays full for put_timeout seconds.
+    """
+    self.start()
+    try:
+      self.queue.put(values, timeout=self.put_timeout)
+    except Queue.Full:
+      return False
+    return True
+
+  def flush(self):
+    """ Write queued rows now and wait until they are written."""
+    if self._thread is not None:
+      self.queue.put(FLUSH)
+      self.queue.join()
+
+  def stop(self):
+    """ Write queued rows and stop the background thread."""
+    with self._lock:
+      thread, self._thread = self._thread, None
+
+    if thread is not None and self._pid == os.getpid():
+      self.queue.put(STOP)
+      thread.join()
+
+  def _run(self):
+    conn = sqlite3.connect(self.dbname, timeout=config.DB_BUSY_TIMEOUT)
+    stopped = False
+    try:
+      while not stopped:
+        batch = [self.queue.get()]
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1] not in (FLUSH, STOP):
+          timeout = deadline - time.time()
+          if timeout <= 0:
+            break
+          try:
+            batch.append(self.queue.get(timeout=timeout))
+          except Queue.Empty:
+            break
+
+        stopped = batch[-1] == STOP
+        rows = [r for r in batch if r not in (FLUSH, STOP)]
+
+        try:
+          if rows:
+            conn.executemany(self.insert_sql, rows)
+            conn.commit()
+        except sqlite3.Error:
+          conn.rollback()
+          logging.exception('Failed to write %d HISTORY rows', len(rows))
+        finally:
+          for i in batch:
+            self.queue.task_done()
+    finally:
+      conn.close()
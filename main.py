@@ -2,6 +2,7 @@ import webapp2
 import os, sys
 import logging
 from paste import httpserver
+from markupsafe import Markup, escape
 
 # Calculate the path based on the location of the WSGI script.
 workspace = os.path.dirname(__file__)
@@ -10,9 +11,16 @@ if not workspace in sys.path:
 
 import base_handler
 import config
-from comments import DbManager as dbm
+import utils
+import storage
+import reports
 from comments import CommentAPIError
+from cache import LRUCache
 import tasks
+import executors
+import migrations
+
+dbm = storage.backend()
 
 # test object types
 object_types = [
@@ -29,45 +37,75 @@ users_ids = ['admin'] + ['uid%d' % (x+1) for x in range(10)]
 
 COMMENTS_PAGE_SIZE = 10
 REPORTS_PAGE_SIZE = 10
+SEARCH_PAGE_SIZE = 20
+
+# viewer_id of cached fragments, replaced by the viewer of request. Template
+# text is escaped, so it is not found in comments.
+VIEWER_PLACEHOLDER = Markup(u'<!--viewer_id-->')
 
 class CommentsHandler(base_handler.BaseHandler):
+  # comments tables by (obj_type, obj_id, cursor, limit, object version), a
+  # change of object comments makes a new key. Entries live CACHE_TTL like
+  # DbManager caches they are read from.
+  fragment_cache = LRUCache(config.FRAGMENT_CACHE_SIZE, config.CACHE_TTL,
+                            config.FRAGMENT_CACHE_BYTES)
+
   def get(self):
     obj_type = self.request.get('obj_type', object_types[0])
     obj_id = self.request.get('obj_id', object_ids[0])
     limit = int(self.request.get('limit', COMMENTS_PAGE_SIZE) or COMMENTS_PAGE_SIZE)
+    viewer_id = self.viewer_id or users_ids[0]
     error = None
-    comments = []
-    more = False
+    table = None
 
     if obj_type and not obj_type in object_types:
       error = 'Invalid object type'
     elif obj_id and not obj_id in object_ids:
       error = 'Invalid object id'
     elif obj_type and obj_id:
-      offset = self.page*limit
-      comments = dbm.get_comments(obj_type, obj_id, limit=limit+1, offset=offset)
-      if len(comments) > limit:
-        more = True
-        comments = comments[:limit]
+      try:
+        table = self.comments_table(obj_type, obj_id, limit)
+      except ValueError:
+        error = 'Invalid cursor'
+
+    if table is None:
+      table = self.render_fragment('comments_table.html', comments=[],
+                                   viewer_id=VIEWER_PLACEHOLDER)
 
     context = {
       'obj_type': obj_type,
       'obj_id': obj_id,
-      'comments': comments,
+      'comments_table': Markup(table.replace(VIEWER_PLACEHOLDER, escape(viewer_id))),
       'error': error,
       'object_types': object_types,
       'object_ids': object_ids,
       'user_ids': users_ids,
-      'page': self.page,
-      'prev_page': self.page-1,
-      'next_page': self.page+1 if more else None
+      'viewer_id': viewer_id
     }
 
-    if not self.viewer_id:
-      context['viewer_id'] = users_ids[0]
-
     self.render_response('comments_page.html', **context)
 
+  def comments_table(self, obj_type, obj_id, limit):
+    """ Return html of comments table page with VIEWER_PLACEHOLDER, rendered
+    once for all viewers of object version."""
+    version, updated = dbm.get_object_version(obj_type, obj_id)
+    key = (obj_type, obj_id, self.page_cursor, limit, version)
+    table = self.fragment_cache.get(key)
+    if table is None:
+      # rows are read after the version, cached page may be older than it
+      comments, next_cursor = dbm.get_comments(obj_type, obj_id, limit=limit,
+                                               cursor=self.page_cursor,
+                                               cached=False)
+      table = self.render_fragment('comments_table.html',
+                                   obj_type=obj_type,
+                                   obj_id=obj_id,
+                                   comments=comments,
+                                   cursor=self.page_cursor,
+                                   next_cursor=next_cursor,
+                                   viewer_id=VIEWER_PLACEHOLDER)
+      self.fragment_cache.set(key, table)
+    return table
+
 class EditCommentHandler(base_handler.BaseHandler):
   def get(self):
     obj_type = self.request.get('obj_type')
@@ -107,7 +145,10 @@ class EditCommentHandler(base_handler.BaseHandler):
 
     if comment_id:
       # update comment
-      dbm.update_comment(comment_id, self.viewer_id, comment)
+      if dbm.get_comment(comment_id, cached=False):
+        dbm.update_comment(comment_id, self.viewer_id, comment)
+      else:
+        error = '%s (103). Comment %s.' % (base_handler.error_codes[103], comment_id)
     else:
       # create new comment
       comment_id = dbm.create_comment(obj_type, obj_id, self.viewer_id, comment, parent_id)
@@ -130,27 +171,22 @@ class EditCommentHandler(base_handler.BaseHandler):
 class CommentsTreeHandler(base_handler.BaseHandler):
   def get(self):
     comment_id = self.request.get('comment_id')
-    page = self.request.get('page')
     comment = dbm.get_comment(comment_id)
 
     if comment:
-      rows = dbm.get_comments_tree(comment_id)
-
-      # create tree
-      nodes = dict((r['ID'], {'children': [], 'value': r}) for r in rows)
-      nodes[comment['ID']] = {'children': [], 'value': comment}
-
-      for r in rows:
-        nodes[r['PARENT_ID']]['children'].append(nodes[r['ID']])
+      # rows are read while the page is sent
+      tree = dbm.iter_subtree(comment['ID'],
+                              int(self.request.get('depth', 0) or 0),
+                              int(self.request.get('limit', 0) or 0))
 
       context = {
         'parent': comment,
-        'page': page,
+        'cursor': self.page_cursor,
         'viewer_id': self.viewer_id,
-        'comments_tree': nodes[comment['ID']]['children']
+        'comments_tree': tree
       }
 
-      self.render_response('comments_tree_page.html', **context)
+      self.stream_response('comments_tree_page.html', **context)
     else:
       return self.error(404)
 
@@ -159,26 +195,49 @@ class CommentsTreeHandler(base_handler.BaseHandler):
   def post(self):
     pass
 
+class CommentsSubtreeHandler(base_handler.BaseHandler):
+  """ Next children of a tree node, html fragment for the tree page."""
+
+  def get(self):
+    parent = dbm.get_comment(self.request.get('tree'))
+    if not parent:
+      return self.error(404)
+
+    try:
+      comment_id, after_id = utils.decode_cursor(self.page_cursor,
+                                                 (utils.INTEGER, utils.INTEGER))
+      tree = dbm.iter_subtree(comment_id,
+                              int(self.request.get('depth', 0) or 0),
+                              int(self.request.get('limit', 0) or 0),
+                              after_id)
+    except (TypeError, ValueError):
+      return self.error(400)
+
+    context = {
+      'parent': parent,
+      'viewer_id': self.viewer_id,
+      'comments_tree': tree
+    }
+
+    self.stream_response('comments_subtree.html', **context)
+
 class ReportsCommentsHandler(base_handler.BaseHandler):
 
   def get(self):
     limit = int(self.request.get('limit', REPORTS_PAGE_SIZE) or
                 REPORTS_PAGE_SIZE)
 
-    more = False
-    offset = self.page*limit
-    reports = dbm.get_reports(self.viewer_id, limit+1, offset)
-
-    if len(reports) > limit:
-      more = True
-      reports = reports[:limit]
+    try:
+      reports, next_cursor = dbm.get_reports(self.viewer_id, limit,
+                                             self.page_cursor)
+    except ValueError:
+      return self.error(400)
 
     context = {
       'viewer_id': self.viewer_id,
       'reports': reports,
-      'page': self.page,
-      'prev_page': self.page-1,
-      'next_page': self.page+1 if more else None
+      'cursor': self.page_cursor,
+      'next_cursor': next_cursor
     }
 
     self.render_response('reports_page.html', **context)
@@ -191,28 +250,90 @@ class ReportsCommentsHandler(base_handler.BaseHandler):
     if not report_id:
       return self.error_result(101, "Required report_id parameter.")
 
-    if not action in ('restart',):
+    try:
+      report_id = int(report_id)
+    except ValueError:
+      return self.error_result(100, "Invalid report_id parameter.")
+
+    if not action in ('restart', 'cancel'):
       return  self.error_result(100, "Invalid action parameter.")
 
-    # run task to create report
-    tasks.create_report.delay(report_id)
+    if action == 'cancel':
+      # export stops at its next progress update
+      if not dbm.cancel_report(report_id):
+        return self.error_result(100, "Report is not working.")
+      return {'result': True}
+
+    report = dbm.get_report(report_id)
+    if report is None:
+      return self.error_result(103, "Report %s." % report_id)
+
+    # the second export would append the same rows to the file
+    if not dbm.restart_report(report_id):
+      return self.error_result(100, "Report is working.")
+
+    # append new comments to report file
+    try:
+      executors.submit(tasks.create_report, (report_id,), {'incremental': True},
+                       owner=self.viewer_id, priority=executors.PRIORITY_HIGH)
+    except executors.QueueFull:
+      # completed report stays usable
+      dbm.update_report_status(report_id, report['STATUS'])
+      return self.error_result(106, "Too many reports are waiting, try later.")
 
     return {'result': True}
 
+  @base_handler.restapi
+  def progress(self):
+    """ Return export progress of report as json."""
+    report_id = self.request.get('report_id')
+    if not report_id:
+      return self.error_result(101, "Required report_id parameter.")
+
+    try:
+      report_id = int(report_id)
+    except ValueError:
+      return self.error_result(100, "Invalid report_id parameter.")
+
+    report = dbm.get_report(report_id)
+    if report is None:
+      return self.error_result(103, "Report %s." % report_id)
+
+    result = {'report_id': report_id, 'status': report['STATUS']}
+    # report sharing file of other report has its progress
+    if report['SOURCE_ID']:
+      report = dbm.get_report(report['SOURCE_ID']) or report
+
+    rows = report['PROGRESS_ROWS'] or 0
+    total = report['TOTAL_ROWS']
+    rate = report['ROWS_PER_SEC'] or 0
+    result.update(rows=rows, total=total, rows_per_sec=rate,
+                  started=report['STARTED_DATE'] or None,
+                  updated=report['PROGRESS_DATE'] or None)
+    if total:
+      result['percent'] = min(100.0, 100.0 * rows / total)
+    if result['status'] == 'working' and total and rate:
+      result['eta'] = max(0, total - rows) / rate
+
+    return result
+
 class NewReportHandler(base_handler.BaseHandler):
 
   def get(self, error=None):
     user_id = self.request.get('user_id')
     obj_type = self.request.get('obj_type')
     obj_id = self.request.get('obj_id')
+    file_type = self.request.get('file_type', config.REPORT_FILE_TYPE)
 
     context = {
       'user_id': user_id,
       'obj_type': obj_type,
       'obj_id': obj_id,
+      'file_type': file_type,
       'object_types': [''] + object_types,
       'object_ids': [''] + object_ids,
-      'user_ids': users_ids
+      'user_ids': users_ids,
+      'file_types': reports.FILE_TYPES
     }
 
     self.render_response('new_report_page.html', **context)
@@ -223,6 +344,7 @@ class NewReportHandler(base_handler.BaseHandler):
     obj_id = self.request.get('obj_id')
     start_date = self.request.get('start_date', '')
     end_date = self.request.get('end_date', '')
+    file_type = self.request.get('file_type', config.REPORT_FILE_TYPE)
 
     if start_date:
       start_date += " 00:00:00"
@@ -235,11 +357,19 @@ class NewReportHandler(base_handler.BaseHandler):
     if not (user_id or obj_type):
       return self.get("Required user_id or obj_type parameters")
 
+    if not file_type in reports.FILE_TYPES:
+      return self.get("Invalid file_type parameter")
+
     report_id = dbm.create_report(self.viewer_id, user_id, obj_type, obj_id,
-                      start_date, end_date)
+                      start_date, end_date, file_type=file_type)
 
-    # run task to create report
-    tasks.create_report.delay(report_id)
+    # run task to create report, the same completed one gives its file
+    try:
+      if dbm.get_report(report_id)['STATUS'] == 'working':
+        executors.submit(tasks.create_report, (report_id,), owner=self.viewer_id)
+    except executors.QueueFull:
+      dbm.update_report_status(report_id, 'cancelled')
+      return self.get("Too many reports are waiting, restart the report later")
 
     self.redirect('/comment/reports?viewer_id=%s' % self.viewer_id)
 
@@ -248,10 +378,21 @@ class DeleteCommentHandler(base_handler.BaseHandler):
   @base_handler.restapi
   def post(self):
     comment_id = self.request.get('comment_id')
+    cascade = self.request.get('cascade') in ('1', 'true')
 
     if not self.viewer_id in users_ids:
       return self.error_result(100, 'Invalid viewer_id=%r' % self.viewer_id)
 
+    try:
+      comment_id = int(comment_id)
+    except ValueError:
+      return self.error_result(100, "Invalid comment_id parameter.")
+
+    if cascade:
+      # delete comment with all children
+      deleted = dbm.delete_subtree(comment_id, self.viewer_id)
+      return {'result': True, 'deleted': deleted}
+
     try:
       dbm.delete_comment(comment_id, self.viewer_id)
     except CommentAPIError, e:
@@ -259,12 +400,241 @@ class DeleteCommentHandler(base_handler.BaseHandler):
 
     return {'result': True}
 
+class SearchCommentsHandler(base_handler.BaseHandler):
+
+  @base_handler.restapi
+  def get(self):
+    text = self.request.get('q', '').strip()
+    limit = int(self.request.get('limit', SEARCH_PAGE_SIZE) or SEARCH_PAGE_SIZE)
+
+    if not text:
+      return self.error_result(101, "Required q parameter.")
+
+    try:
+      rows, next_cursor = dbm.search_comments(text,
+                                              obj_type=self.request.get('obj_type'),
+                                              obj_id=self.request.get('obj_id'),
+                                              user_id=self.request.get('user_id'),
+                                              limit=limit,
+                                              cursor=self.page_cursor)
+    except ValueError:
+      return self.error_result(100, "Invalid cursor parameter.")
+
+    return {
+      'comments': [utils.row_to_dict(r) for r in rows],
+      'next_cursor': next_cursor
+    }
+
+class CommentsFeedHandler(base_handler.BaseHandler):
+  """ First top level comments and counts of many objects, e.g. previews
+  of a page. Objects are passed as repeated obj_type and obj_id parameters."""
+
+  @base_handler.restapi
+  def get(self):
+    obj_types = self.request.get_all('obj_type')
+    obj_ids = self.request.get_all('obj_id')
+    limit = int(self.request.get('limit', config.FEED_PAGE_SIZE) or
+                config.FEED_PAGE_SIZE)
+
+    if not obj_types:
+      return self.error_result(101, "Required obj_type and obj_id parameters.")
+
+    if len(obj_types) != len(obj_ids):
+      return self.error_result(100, "Every obj_type must have obj_id.")
+
+    if len(obj_types) > config.FEED_MAX_OBJECTS:
+      return self.error_result(100, "At most %s objects are allowed." %
+                               config.FEED_MAX_OBJECTS)
+
+    objects = zip(obj_types, obj_ids)
+    result = dbm.get_comments_multi(objects, limit)
+
+    feed = []
+    for key in objects:
+      rows, next_cursor, total = result[key]
+      comments = []
+      for r in rows:
+        comment = utils.row_to_dict(r)
+        comment.pop('TOTAL', None)
+        comments.append(comment)
+
+      feed.append({
+        'obj_type': key[0],
+        'obj_id': key[1],
+        'total': total,
+        'comments': comments,
+        'next_cursor': next_cursor
+      })
+
+    return {'objects': feed}
+
+class CommentsApiHandler(base_handler.BaseHandler):
+  """ JSON API of object comments: GET lists top level comments, POST
+  creates comment. Responses carry version of object comments as ETag, GET
+  with the current one (If-None-Match) gets 304 after one version lookup."""
+
+  @base_handler.restapi
+  def get(self):
+    obj_type = self.request.get('obj_type')
+    obj_id = self.request.get('obj_id')
+    limit = int(self.request.get('limit', COMMENTS_PAGE_SIZE) or COMMENTS_PAGE_SIZE)
+
+    if not (obj_type and obj_id):
+      return self.error_result(101, "Required obj_type and obj_id parameters.")
+
+    version, updated = dbm.get_object_version(obj_type, obj_id)
+    if self.not_modified(version, updated):
+      return None
+
+    try:
+      # cached page may be older than the version (ETag)
+      rows, next_cursor = dbm.get_comments(obj_type, obj_id,
+                                           user_id=self.request.get('user_id') or None,
+                                           limit=limit, cursor=self.page_cursor,
+                                           cached=False)
+    except ValueError:
+      return self.error_result(100, "Invalid cursor parameter.")
+
+    return {
+      'comments': [utils.row_to_dict(r) for r in rows],
+      'next_cursor': next_cursor,
+      'version': version
+    }
+
+  @base_handler.restapi
+  def post(self):
+    obj_type = self.request.get('obj_type')
+    obj_id = self.request.get('obj_id')
+    parent_id = self.request.get('parent_id')
+    comment = self.request.get('comment')
+
+    if not self.viewer_id in users_ids:
+      return self.error_result(100, 'Invalid viewer_id=%r' % self.viewer_id)
+
+    if not comment:
+      return self.error_result(101, "Required comment parameter.")
+
+    if parent_id:
+      # reply belongs to object of its parent
+      parent = dbm.get_comment(parent_id)
+      if not parent:
+        return self.error_result(103, "Comment %s." % parent_id)
+      obj_type, obj_id, parent_id = parent['OBJ_TYPE'], parent['OBJ_ID'], parent['ID']
+    elif not (obj_type and obj_id):
+      return self.error_result(101, "Required obj_type and obj_id parameters.")
+
+    comment_id = dbm.create_comment(obj_type, obj_id, self.viewer_id, comment,
+                                    parent_id or None)
+    self.response.status_int = 201
+    self.response.location = '/api/comments/%s' % comment_id
+    return {'comment': utils.row_to_dict(dbm.get_comment(comment_id))}
+
+class CommentApiHandler(base_handler.BaseHandler):
+  """ JSON API of one comment: GET, PUT (new comment text) and DELETE (with
+  cascade=1 deletes children too). ETag is version of comment subtree."""
+
+  @base_handler.restapi
+  def get(self, comment_id):
+    # version is read first and comment is not cached, so it is not older
+    # than its ETag
+    version, updated = dbm.get_subtree_version(comment_id)
+    comment = dbm.get_comment(comment_id, cached=False)
+    if not comment:
+      return self.error_result(103, "Comment %s." % comment_id)
+
+    if self.not_modified(version, updated):
+      return None
+
+    return {'comment': utils.row_to_dict(comment), 'version': version}
+
+  @base_handler.restapi
+  def put(self, comment_id):
+    comment = self.request.get('comment')
+
+    if not self.viewer_id in users_ids:
+      return self.error_result(100, 'Invalid viewer_id=%r' % self.viewer_id)
+
+    if not comment:
+      return self.error_result(101, "Required comment parameter.")
+
+    if not dbm.get_comment(comment_id):
+      return self.error_result(103, "Comment %s." % comment_id)
+
+    dbm.update_comment(comment_id, self.viewer_id, comment)
+    return {'comment': utils.row_to_dict(dbm.get_comment(comment_id))}
+
+  @base_handler.restapi
+  def delete(self, comment_id):
+    cascade = self.request.get('cascade') in ('1', 'true')
+
+    if not self.viewer_id in users_ids:
+      return self.error_result(100, 'Invalid viewer_id=%r' % self.viewer_id)
+
+    if cascade:
+      return {'result': True, 'deleted': dbm.delete_subtree(comment_id, self.viewer_id)}
+
+    try:
+      dbm.delete_comment(comment_id, self.viewer_id)
+    except CommentAPIError, e:
+      return self.error_result(105, str(e))
+
+    return {'result': True}
+
+class CommentTreeApiHandler(base_handler.BaseHandler):
+  """ JSON API of comment children down to `depth` levels with at most
+  `limit` children of every comment. Not returned children are loaded by
+  cursors of the result. ETag is version of the requested subtree."""
+
+  @base_handler.restapi
+  def get(self, comment_id):
+    depth = int(self.request.get('depth', 0) or 0)
+    limit = int(self.request.get('limit', 0) or 0)
+    after_id = None
+
+    if self.page_cursor:
+      try:
+        # children of the tree comment or of one of its children
+        cursor_id, after_id = utils.decode_cursor(self.page_cursor,
+                                                (utils.INTEGER, utils.INTEGER))
+        if cursor_id != int(comment_id) and \
+           (cursor_id < 1 or not int(comment_id) in dbm.get_parents(cursor_id)):
+          raise ValueError('cursor is not in subtree')
+      except (TypeError, ValueError):
+        return self.error_result(100, "Invalid cursor parameter.")
+      comment_id = cursor_id
+
+    # version is read first and comment is not cached, so comments are not
+    # older than their ETag
+    version, updated = dbm.get_subtree_version(comment_id)
+    comment = dbm.get_comment(comment_id, cached=False)
+    if not comment:
+      return self.error_result(103, "Comment %s." % comment_id)
+
+    if self.not_modified(version, updated):
+      return None
+
+    rows, cursors = dbm.get_subtree(comment['ID'], depth, limit, after_id)
+    return {
+      'comment': utils.row_to_dict(comment),
+      'comments': [utils.row_to_dict(r) for r in rows],
+      'cursors': cursors,
+      'version': version
+    }
+
 application = webapp2.WSGIApplication([
     ('/comment/add/?', EditCommentHandler),
     ('/comment/edit/?', EditCommentHandler),
     ('/comment/delete/?', DeleteCommentHandler),
     ('/comment/tree/?', CommentsTreeHandler),
+    ('/comment/tree/more/?', CommentsSubtreeHandler),
+    ('/comment/search/?', SearchCommentsHandler),
+    ('/comment/feed/?', CommentsFeedHandler),
+    ('/api/comments/?', CommentsApiHandler),
+    webapp2.Route(r'/api/comments/<comment_id:\d+>', CommentApiHandler),
+    webapp2.Route(r'/api/comments/<comment_id:\d+>/tree', CommentTreeApiHandler),
     ('/comment/new_report/?', NewReportHandler),
+    webapp2.Route('/comment/reports/progress', ReportsCommentsHandler,
+                  handler_method='progress', methods=['GET']),
     ('/comment/reports/?', ReportsCommentsHandler),
     ('/', CommentsHandler),
     ('/static/(.+)', base_handler.StaticFileHandler) # only for dev server
@@ -272,6 +642,16 @@ application = webapp2.WSGIApplication([
 ], debug=True)
 
 def main():
+  # schema of the code, e.g. OBJECT_VERSIONS table
+  for name, applied in migrations.migrate_all(config.DB_NAME):
+    if applied:
+      logging.info('%s: applied migrations %s', name, applied)
+  # pools of configured shards
+  dbm.connect(config.DB_NAME)
+  if config.TASK_EXECUTOR == 'local':
+    # reports of stopped process are exported again
+    executors.executor().start()
+    tasks.recover_reports()
   httpserver.serve(application,
                   host=config.WEBSITE_APP_HOST,
                   port=config.WEBSTIE_APP_PORT)
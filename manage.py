@@ -0,0 +1,104 @@
+""" Command line tools for comments database.
+
+Usage: python manage.py <command> [options]
+"""
+__author__ = 'okoneshnikov'
+import argparse
+import json
+import sys
+
+import config
+import migrations
+from comments import DbManager as dbm
+
+
+def read_ndjson(f):
+  """ Yield one dict per non empty line of NDJSON file."""
+  for line in f:
+    line = line.strip()
+    if line:
+      yield json.loads(line)
+
+
+def load(args):
+  """ Load comments from NDJSON file."""
+  with open(args.file) as f:
+    count = dbm.create_comments_bulk(read_ndjson(f), args.chunk_size)
+  print 'Loaded %d comments' % count
+
+
+def migrate(args):
+  """ Upgrade database schema."""
+  for name, applied in migrations.migrate_all(args.db, args.shards, args.target):
+    print '%s applied migrations: %s' % (name, ', '.join(map(str, applied)) or 'none')
+
+
+def compact_history(args):
+  """ Move old HISTORY rows to archives and drop expired archives."""
+  archived, dropped = dbm.compact_history(args.days, args.archive, args.months,
+                                          args.batch_size)
+  print 'Archived %d HISTORY rows' % archived
+  for name in dropped:
+    print 'Dropped %s' % name
+
+
+def rebuild_search(args):
+  """ Rebuild full-text search index of comments."""
+  dbm.rebuild_search_index()
+  print 'Search index rebuilt'
+
+
+def reshard(args):
+  """ Move comments to new number of shard files."""
+  for name in dbm.reshard(args.count):
+    print 'Moved comments to %s' % name
+  print 'Set DB_SHARDS = %d in config' % args.count
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Comments database tools')
+  parser.add_argument('--db', default=config.DB_NAME, help='database file')
+  parser.add_argument('--shards', type=int, default=config.DB_SHARDS,
+                      help='current number of shards')
+  commands = parser.add_subparsers()
+
+  command = commands.add_parser('load', help=load.__doc__)
+  command.add_argument('file', help='NDJSON file, one comment per line with '
+                                    'obj_type, obj_id, user_id, comment and '
+                                    'optional id, parent_id, created keys')
+  command.add_argument('--chunk-size', type=int, default=config.BULK_CHUNK_SIZE,
+                       help='comments per transaction')
+  command.set_defaults(func=load)
+
+  command = commands.add_parser('migrate', help=migrate.__doc__)
+  command.add_argument('--target', type=int, help='target schema version')
+  command.set_defaults(func=migrate)
+
+  command = commands.add_parser('compact-history', help=compact_history.__doc__)
+  command.add_argument('--days', type=int, default=config.HISTORY_RETENTION_DAYS,
+                       help='keep rows of last days in HISTORY table')
+  command.add_argument('--archive', choices=('table', 'file'),
+                       default=config.HISTORY_ARCHIVE, help='archive type')
+  command.add_argument('--months', type=int, default=config.HISTORY_ARCHIVE_MONTHS,
+                       help='keep archives of last months, 0 - keep all')
+  command.add_argument('--batch-size', type=int, default=config.HISTORY_COMPACT_BATCH,
+                       help='rows moved per transaction')
+  command.set_defaults(func=compact_history)
+
+  command = commands.add_parser('rebuild-search', help=rebuild_search.__doc__)
+  command.set_defaults(func=rebuild_search)
+
+  command = commands.add_parser('reshard', help=reshard.__doc__)
+  command.add_argument('count', type=int, help='new number of shards')
+  command.set_defaults(func=reshard)
+
+  args = parser.parse_args(argv)
+  dbm.connect(args.db, args.shards)
+  try:
+    args.func(args)
+  finally:
+    dbm.close()
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
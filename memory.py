@@ -0,0 +1,670 @@
+""" In-memory storage backend.
+
+Comments are kept in dicts indexed like SQLite tables: by id, by object, by
+user, by parent and by word, with ancestor lists instead of COMMENTSTREE.
+Databases live while the process runs, connect() with the same name returns
+the same data. HISTORY is kept without archives.
+"""
+__author__ = 'okoneshnikov'
+import re
+import bisect
+import threading
+from datetime import datetime, timedelta
+
+import config
+import utils
+import scheme
+from comments import CommentAPIError
+from storage import StorageBackend, TreeNode
+
+word_re = re.compile(r'\w+', re.UNICODE)
+
+
+class Row(tuple):
+  """ Table row with values by index and by case insensitive field name, like
+  sqlite3.Row. Subclasses made by row_class() know their fields."""
+  __slots__ = ()
+  fields = ()
+  index = {}
+
+  def __getitem__(self, key):
+    if isinstance(key, basestring):
+      key = self.index[key.upper()]
+    return tuple.__getitem__(self, key)
+
+  def keys(self):
+    return list(self.fields)
+
+  def replace(self, **values):
+    """ Return copy of row with new values of fields."""
+    result = list(self)
+    for field, value in values.items():
+      result[self.index[field]] = value
+    return self.__class__(result)
+
+  def extend(self, fields, values):
+    """ Return copy of row with additional fields."""
+    return row_class(self.fields + fields)(tuple(self) + tuple(values))
+
+
+_row_classes = {}
+
+def row_class(fields):
+  """ Return Row subclass for fields tuple."""
+  cls = _row_classes.get(fields)
+  if cls is None:
+    cls = _row_classes[fields] = type('Row', (Row,), dict(
+      __slots__=(), fields=fields,
+      index=dict((field, i) for i, field in enumerate(fields))))
+  return cls
+
+
+def table_row(table_name, params):
+  """ Make row of table from dict with lower case keys, fields without value
+  get the same defaults as DbManager.insert_values."""
+  values = []
+  for field, descr in scheme.scheme_dict[table_name]:
+    default = '' if descr.startswith('TEXT') or descr.startswith('CHAR(') else None
+    values.append(params.get(field.lower(), default))
+  return row_class(tuple(f for f, d in scheme.scheme_dict[table_name]))(values)
+
+
+def words(text):
+  return set(word_re.findall((text or u'').lower()))
+
+
+class Database(object):
+  """ Tables and indexes of one in-memory database."""
+
+  def __init__(self):
+    self.comments = {}
+    # comment id: parent ids, the root first
+    self.ancestors = {}
+    # parent id: sorted children ids
+    self.children = {}
+    # (obj_type, obj_id): sorted (CREATED_DATE, ID) of top level comments
+    self.objects = {}
+    # user id: sorted (CREATED_DATE, ID) of user comments
+    self.users = {}
+    # word: ids of comments with it
+    self.words = {}
+    self.history = []
+    self.reports = {}
+    # (obj_type, obj_id) or comment id: (version, updated date)
+    self.versions = {}
+    self.last_ids = dict(COMMENTS=0, REPORTS=0, HISTORY=0)
+
+
+_databases = {}
+
+
+class MemoryStorage(StorageBackend):
+  """ Storage backend with all data in process memory, see StorageBackend.
+
+  All calls hold one lock, so it is safe for threads of one process. Data of
+  other processes (e.g. Celery workers) is not shared.
+  """
+  _lock = threading.RLock()
+  dbname = config.DB_NAME
+  db = _databases.setdefault(dbname, Database())
+
+  @classmethod
+  def connect(cls, dbname):
+    with cls._lock:
+      cls.dbname = dbname
+      cls.db = _databases.setdefault(dbname, Database())
+
+  @classmethod
+  def close(cls):
+    pass
+
+  @classmethod
+  def release(cls):
+    pass
+
+  @classmethod
+  def drop(cls, dbname):
+    """ Forget all data of database."""
+    with cls._lock:
+      _databases.pop(dbname, None)
+      if dbname == cls.dbname:
+        cls.db = _databases.setdefault(dbname, Database())
+
+  @classmethod
+  def clear(cls, table_name):
+    assert table_name in scheme.scheme_dict
+    with cls._lock:
+      db = cls.db
+      if table_name == 'COMMENTS':
+        for name in ('comments', 'children', 'objects', 'users', 'words'):
+          setattr(db, name, {})
+      elif table_name == 'COMMENTSTREE':
+        db.ancestors = {}
+      elif table_name == 'HISTORY':
+        db.history = []
+      elif table_name == 'OBJECT_VERSIONS':
+        db.versions = {}
+      else:
+        db.reports = {}
+
+  @classmethod
+  def next_id(cls, table_name, id=None):
+    """ Return id of new row like AUTOINCREMENT does."""
+    if id is None:
+      id = cls.db.last_ids[table_name] + 1
+    cls.db.last_ids[table_name] = max(cls.db.last_ids[table_name], id)
+    return id
+
+  @classmethod
+  def log(cls, comment_id, user_id, action, comment=None):
+    if not action in scheme.history_actions:
+      raise CommentAPIError(2)
+
+    cls.next_id('HISTORY')
+    cls.db.history.append(table_row('HISTORY', dict(
+      id=comment_id, user_id=user_id, action=action, comment_id=comment_id,
+      comment=comment or '', created_date=utils.dbdate(datetime.utcnow()))))
+
+  @classmethod
+  def flush_history(cls):
+    pass
+
+  @classmethod
+  def compact_history(cls, retention_days=None, archive=None,
+                      archive_months=None, batch_size=None):
+    """ Drop HISTORY rows older than retention_days, there are no archives."""
+    if retention_days is None:
+      retention_days = config.HISTORY_RETENTION_DAYS
+    before = utils.dbdate(datetime.utcnow() - timedelta(days=retention_days))
+
+    with cls._lock:
+      history = [r for r in cls.db.history if r['CREATED_DATE'] >= before]
+      count = len(cls.db.history) - len(history)
+      cls.db.history = history
+    return count, []
+
+  @classmethod
+  def add_comment(cls, row):
+    """ Store comment row and index it."""
+    db = cls.db
+    comment_id = row['ID']
+    parent_id = row['PARENT_ID']
+    db.comments[comment_id] = row
+
+    parents = []
+    if parent_id:
+      parents = db.ancestors.get(parent_id, []) + [parent_id]
+      bisect.insort(db.children.setdefault(parent_id, []), comment_id)
+    else:
+      bisect.insort(db.objects.setdefault((row['OBJ_TYPE'], row['OBJ_ID']), []),
+                    (row['CREATED_DATE'], comment_id))
+    db.ancestors[comment_id] = parents
+    cls.update_versions(row['OBJ_TYPE'], row['OBJ_ID'], parents)
+
+    bisect.insort(db.users.setdefault(row['USER_ID'], []),
+                  (row['CREATED_DATE'], comment_id))
+    for word in words(row['COMMENT']):
+      db.words.setdefault(word, set()).add(comment_id)
+
+  @classmethod
+  def update_versions(cls, obj_type, obj_id, comment_ids):
+    """ Increment versions of object comments and of subtrees of comment_ids."""
+    now = utils.dbdate(datetime.utcnow())
+    # empty object is the version of all comments, see data_version
+    for key in [(obj_type, obj_id), ('', '')] + list(set(comment_ids)):
+      cls.db.versions[key] = (cls.db.versions.get(key, (0, None))[0] + 1, now)
+
+  @classmethod
+  def get_object_version(cls, obj_type, obj_id):
+    with cls._lock:
+      return cls.db.versions.get((obj_type, obj_id), (0, None))
+
+  @classmethod
+  def get_subtree_version(cls, comment_id):
+    with cls._lock:
+      return cls.db.versions.get(int(comment_id), (0, None))
+
+  @classmethod
+  def remove_comment(cls, comment_id):
+    """ Remove comment row with its indexes."""
+    db = cls.db
+    row = db.comments.pop(comment_id)
+    parent_id = row['PARENT_ID']
+    key = (row['CREATED_DATE'], comment_id)
+
+    if parent_id:
+      # parent may be removed before its children by delete_subtree
+      if comment_id in db.children.get(parent_id, ()):
+        db.children[parent_id].remove(comment_id)
+    else:
+      db.objects[(row['OBJ_TYPE'], row['OBJ_ID'])].remove(key)
+    db.ancestors.pop(comment_id, None)
+    db.children.pop(comment_id, None)
+    db.users[row['USER_ID']].remove(key)
+    for word in words(row['COMMENT']):
+      db.words[word].discard(comment_id)
+    return row
+
+  @classmethod
+  def create_comment(cls, obj_type, obj_id, user_id, comment, parent_id=None, created=None):
+    assert obj_type and obj_id and user_id
+    created = utils.dbdate(created or datetime.utcnow())
+
+    with cls._lock:
+      comment_id = cls.next_id('COMMENTS')
+      cls.add_comment(table_row('COMMENTS', dict(
+        id=comment_id, created_date=created, updated_date=created,
+        obj_type=obj_type, obj_id=obj_id, user_id=user_id,
+        parent_id=int(parent_id) if parent_id else None, comment=comment)))
+      cls.log(comment_id, user_id, 'add', comment)
+    return comment_id
+
+  @classmethod
+  def create_comments_bulk(cls, comments, chunk_size=None):
+    now = datetime.utcnow()
+    count = 0
+    with cls._lock:
+      for item in comments:
+        assert item['obj_type'] and item['obj_id'] and item['user_id']
+        created = item.get('created') or now
+        if isinstance(created, datetime):
+          created = utils.dbdate(created)
+
+        comment_id = cls.next_id('COMMENTS', item.get('id'))
+        cls.add_comment(table_row('COMMENTS', dict(
+          id=comment_id, created_date=created, updated_date=created,
+          obj_type=item['obj_type'], obj_id=item['obj_id'],
+          user_id=item['user_id'],
+          parent_id=int(item['parent_id']) if item.get('parent_id') else None,
+          comment=item.get('comment', ''))))
+        cls.log(comment_id, item['user_id'], 'add', item.get('comment'))
+        count += 1
+    return count
+
+  @classmethod
+  def get_parents(cls, comment_id):
+    with cls._lock:
+      return list(cls.db.ancestors.get(int(comment_id), []))
+
+  @classmethod
+  def get_comments(cls, obj_type, obj_id, user_id=None, limit=20, cursor=None,
+                   cached=True):
+    with cls._lock:
+      keys = cls.db.objects.get((obj_type, obj_id), [])
+      start = 0
+      if cursor:
+        created, last_id = utils.decode_cursor(cursor)
+        start = bisect.bisect_right(keys, (created, last_id))
+
+      rows = []
+      for created, comment_id in keys[start:]:
+        row = cls.db.comments[comment_id]
+        if user_id is None or row['USER_ID'] == user_id:
+          rows.append(row)
+          if len(rows) > limit:
+            break
+
+    return cls.page_result(rows, limit)
+
+  @classmethod
+  def get_comments_multi(cls, objects, limit=None):
+    limit = limit or config.FEED_PAGE_SIZE
+    result = {}
+    with cls._lock:
+      for key in objects:
+        keys = cls.db.objects.get(tuple(key), [])
+        rows = [cls.db.comments[comment_id] for created, comment_id in keys[:limit + 1]]
+        page, next_cursor = cls.page_result(rows, limit)
+        result[tuple(key)] = (page, next_cursor, len(keys))
+    return result
+
+  @classmethod
+  def get_comment(cls, comment_id, cached=True):
+    try:
+      comment_id = int(comment_id)
+    except (TypeError, ValueError):
+      return None
+
+    with cls._lock:
+      return cls.db.comments.get(comment_id)
+
+  @classmethod
+  def search_comments(cls, text, obj_type=None, obj_id=None, user_id=None,
+                      limit=20, cursor=None):
+    """ Search comments with all words of text. RANK is minus share of text
+    words in comment words, so better matches go first like with bm25."""
+    query = words(text)
+    with cls._lock:
+      ids = None
+      for word in query:
+        found = cls.db.words.get(word, set())
+        ids = found if ids is None else ids & found
+
+      rows = []
+      for comment_id in ids or ():
+        row = cls.db.comments[comment_id]
+        if ((obj_type and row['OBJ_TYPE'] != obj_type) or
+            (obj_id and row['OBJ_ID'] != obj_id) or
+            (user_id and row['USER_ID'] != user_id)):
+          continue
+
+        comment_words = word_re.findall(row['COMMENT'].lower())
+        rank = -float(sum(1 for w in comment_words if w in query)) / len(comment_words)
+        rows.append(row.extend(('RANK',), (rank,)))
+
+    rows.sort(key=lambda r: (r['RANK'], r['ID']))
+    if cursor:
+      rank, last_id = utils.decode_cursor(cursor, (utils.NUMBER, utils.INTEGER))
+      rows = [r for r in rows if (r['RANK'], r['ID']) > (rank, last_id)]
+
+    return cls.page_result(rows[:limit + 1], limit, key=('RANK', 'ID'))
+
+  @classmethod
+  def delete_comment(cls, comment_id, user_id):
+    comment_id = int(comment_id)
+    with cls._lock:
+      if cls.db.children.get(comment_id):
+        raise CommentAPIError(1)
+
+      if comment_id in cls.db.comments:
+        row = cls.db.comments[comment_id]
+        cls.update_versions(row['OBJ_TYPE'], row['OBJ_ID'],
+                            cls.db.ancestors[comment_id] + [comment_id])
+        cls.remove_comment(comment_id)
+      cls.log(comment_id, user_id, 'delete')
+    return True
+
+  @classmethod
+  def delete_subtree(cls, comment_id, user_id, batch_size=None):
+    comment_id = int(comment_id)
+    with cls._lock:
+      if comment_id not in cls.db.comments:
+        return 0
+
+      row = cls.db.comments[comment_id]
+      cls.update_versions(row['OBJ_TYPE'], row['OBJ_ID'],
+                          cls.db.ancestors[comment_id] + [comment_id])
+      ids = [comment_id] + [r['ID'] for r in cls.get_comments_tree(comment_id)]
+      # children first, so every removed comment is a leaf
+      for id in reversed(ids):
+        cls.remove_comment(id)
+        cls.log(id, user_id, 'delete')
+    return len(ids)
+
+  @classmethod
+  def update_comment(cls, comment_id, user_id, comment):
+    comment_id = int(comment_id)
+    with cls._lock:
+      row = cls.db.comments.get(comment_id)
+      if row is not None:
+        for word in words(row['COMMENT']):
+          cls.db.words[word].discard(comment_id)
+        for word in words(comment):
+          cls.db.words.setdefault(word, set()).add(comment_id)
+        cls.db.comments[comment_id] = row.replace(COMMENT=comment)
+        cls.update_versions(row['OBJ_TYPE'], row['OBJ_ID'],
+                            cls.db.ancestors[comment_id] + [comment_id])
+      cls.log(comment_id, user_id, 'modified', comment)
+
+  @classmethod
+  def get_comments_tree(cls, comment_id):
+    """ Return all comment children ordered by id with LEVEL of comment_id
+    in their parents list."""
+    comment_id = int(comment_id)
+    with cls._lock:
+      level = len(cls.db.ancestors.get(comment_id, [])) + 1
+      result = []
+      parents = [comment_id]
+      while parents:
+        children = []
+        for parent_id in parents:
+          children.extend(cls.db.children.get(parent_id, []))
+        result.extend(children)
+        parents = children
+
+      return [cls.db.comments[id].extend(('LEVEL',), (level,)) for id in sorted(result)]
+
+  @classmethod
+  def iter_subtree(cls, comment_id, max_depth=None, child_limit=None, after_id=None):
+    """ Walk get_subtree rows, children of a comment are read when the walk
+    comes to it. The lock is taken for every read, not for the whole walk."""
+    max_depth = max_depth or config.TREE_MAX_DEPTH
+    child_limit = child_limit or config.TREE_CHILD_LIMIT
+    comment_id = int(comment_id)
+
+    with cls._lock:
+      ids = [id for id in cls.db.children.get(comment_id, []) if id > (after_id or 0)]
+    root = TreeNode(comment_id, None, 0, len(ids))
+    root.last_id = after_id
+    # nodes of the current path with iterators of their not walked children
+    stack = [(root, iter(ids[:child_limit]))]
+
+    while stack:
+      node, children = stack[-1]
+      id = next(children, None)
+      if id is None:
+        stack.pop()
+        yield 'close', node.close()
+        continue
+
+      with cls._lock:
+        row = cls.db.comments.get(id)
+        ids = list(cls.db.children.get(id, []))
+      if row is None:
+        # deleted while the tree is walked
+        continue
+
+      depth = node.depth + 1
+      child = TreeNode(id, row.extend(('DEPTH', 'CHILDREN'), (depth, len(ids))),
+                       depth, len(ids))
+      node.shown += 1
+      node.last_id = id
+      yield 'open', child
+      stack.append((child, iter(ids[:child_limit] if depth < max_depth else [])))
+
+  @classmethod
+  def get_reports(cls, user_id, limit=20, cursor=None):
+    with cls._lock:
+      rows = sorted(cls.db.reports.values(),
+                    key=lambda r: (r['CREATED_DATE'], r['ID']), reverse=True)
+
+    if user_id:
+      rows = [r for r in rows if r['OWNER'] == user_id]
+    if cursor:
+      created, last_id = utils.decode_cursor(cursor)
+      rows = [r for r in rows if (r['CREATED_DATE'], r['ID']) < (created, last_id)]
+
+    return cls.page_result(rows[:limit + 1], limit)
+
+  @classmethod
+  def create_report(cls, owner, user_id, obj_type=None, obj_id=None,
+                    start_date=None, end_date=None,
+                    status='working', file_type='csv'):
+    assert user_id
+    now = utils.dbdate(datetime.utcnow())
+    with cls._lock:
+      params = dict(
+        owner=owner, user_id=user_id,
+        obj_type=obj_type or '', obj_id=obj_id or '',
+        start_date=start_date or '', end_date=end_date or '',
+        status=status, file_type=file_type, file_name='',
+        created_date=now, updated_date=now)
+      if config.REPORT_CACHE:
+        params['cache_key'] = cls.report_cache_key(
+          user_id, obj_type, obj_id, start_date, end_date, file_type,
+          cls.data_version(obj_type, obj_id))
+        sources = [r for r in cls.db.reports.values()
+                   if r['CACHE_KEY'] == params['cache_key'] and r['SOURCE_ID'] is None
+                   and r['STATUS'] in ('working', 'completed')]
+        if sources:
+          source = min(sources, key=lambda r: r['ID'])
+          # completed report gets the file at once and does not wait for source
+          params.update(status=source['STATUS'], file_name=source['FILE_NAME'])
+          if source['STATUS'] == 'working':
+            params['source_id'] = source['ID']
+
+      params['id'] = report_id = cls.next_id('REPORTS')
+      cls.db.reports[report_id] = table_row('REPORTS', params)
+    return report_id
+
+  @classmethod
+  def get_working_reports(cls):
+    with cls._lock:
+      return [r for id, r in sorted(cls.db.reports.items())
+              if r['SOURCE_ID'] is None and cls.report_exported(r)]
+
+  @classmethod
+  def report_exported(cls, report):
+    """ Report is exported while it or a report sharing its file is working."""
+    return report['STATUS'] == 'working' or any(
+      r['SOURCE_ID'] == report['ID'] and r['STATUS'] == 'working'
+      for r in cls.db.reports.values())
+
+  @classmethod
+  def data_version(cls, obj_type=None, obj_id=None):
+    """ Return version of object, version of all comments without object."""
+    key = (obj_type, obj_id) if obj_type and obj_id else ('', '')
+    with cls._lock:
+      return str(cls.db.versions.get(key, (0, None))[0])
+
+  @classmethod
+  def get_report(cls, report_id):
+    with cls._lock:
+      return cls.db.reports.get(int(report_id))
+
+  @classmethod
+  def get_report_data(cls, report_id):
+    with cls._lock:
+      report = cls.db.reports.get(int(report_id))
+      assert report
+
+      keys = cls.db.users.get(report['USER_ID'], [])
+      if report['START_DATE']:
+        keys = keys[bisect.bisect_left(keys, (report['START_DATE'],)):]
+
+      rows = []
+      for created, comment_id in keys:
+        if report['END_DATE'] and created > report['END_DATE']:
+          break
+
+        row = cls.db.comments[comment_id]
+        if report['OBJ_TYPE'] and row['OBJ_TYPE'] != report['OBJ_TYPE']:
+          continue
+        if report['OBJ_TYPE'] and report['OBJ_ID'] and row['OBJ_ID'] != report['OBJ_ID']:
+          continue
+        rows.append(row)
+
+    return rows
+
+  @classmethod
+  def update_report(cls, report_id, file_name, file_type='csv', status='completed', description=''):
+    with cls._lock:
+      report = cls.db.reports.get(int(report_id))
+      if report is not None:
+        # cancelled source is exported for reports sharing its file
+        cls.db.reports[report['ID']] = report.replace(
+          FILE_TYPE=file_type, FILE_NAME=file_name,
+          STATUS='cancelled' if report['STATUS'] == 'cancelled' else status,
+          DESCRIPTION=description, SOURCE_ID=None)
+        for r in list(cls.db.reports.values()):
+          # only working reports wait for the result, they stop sharing after it
+          if r['SOURCE_ID'] == report['ID'] and r['STATUS'] == 'working':
+            cls.db.reports[r['ID']] = r.replace(
+              FILE_TYPE=file_type, FILE_NAME=file_name, STATUS=status,
+              DESCRIPTION=description, SOURCE_ID=None)
+
+  @classmethod
+  def update_report_status(cls, report_id, status):
+    cls.replace_report(report_id, STATUS=status)
+
+  @classmethod
+  def restart_report(cls, report_id):
+    with cls._lock:
+      report = cls.db.reports.get(int(report_id))
+      if report is None or cls.report_exported(report):
+        return False
+      cls.replace_report(report_id, STATUS='working')
+    return True
+
+  @classmethod
+  def start_report(cls, report_id, total_rows):
+    now = utils.dbdate(datetime.utcnow())
+    with cls._lock:
+      report = cls.db.reports.get(int(report_id))
+      if report is None:
+        return False
+      if report['STATUS'] != 'cancelled':
+        report = report.replace(STATUS='working')
+      elif not cls.report_exported(report):
+        return False
+      cls.replace_report(report_id, STATUS=report['STATUS'], STARTED_DATE=now,
+                         PROGRESS_ROWS=0, TOTAL_ROWS=total_rows, ROWS_PER_SEC=0,
+                         PROGRESS_DATE=now)
+    return True
+
+  @classmethod
+  def update_report_progress(cls, report_id, rows):
+    now = datetime.utcnow()
+    with cls._lock:
+      report = cls.db.reports.get(int(report_id))
+      if report is None:
+        return False
+      rows += report['PROGRESS_ROWS'] or 0
+      seconds = (now - utils.parse_dbdate(report['STARTED_DATE'])).total_seconds()
+      cls.replace_report(report_id, PROGRESS_ROWS=rows, PROGRESS_DATE=utils.dbdate(now),
+                         ROWS_PER_SEC=rows / max(1.0, seconds))
+      return cls.report_exported(report)
+
+  @classmethod
+  def cancel_report(cls, report_id):
+    with cls._lock:
+      report = cls.db.reports.get(int(report_id))
+      if report is None or report['STATUS'] != 'working':
+        return False
+      cls.replace_report(report_id, STATUS='cancelled', SOURCE_ID=None)
+    return True
+
+  @classmethod
+  def report_file_shared(cls, report_id, file_name):
+    with cls._lock:
+      return any(r['ID'] != int(report_id) and
+                 (r['FILE_NAME'] == file_name or r['SOURCE_ID'] == int(report_id))
+                 for r in cls.db.reports.values())
+
+  @classmethod
+  def replace_report(cls, report_id, **values):
+    """ Set fields of report row."""
+    with cls._lock:
+      report = cls.db.reports.get(int(report_id))
+      if report is not None:
+        cls.db.reports[report['ID']] = report.replace(**values)
+
+  @classmethod
+  def update_report_mark(cls, report_id, last_date, last_id, rows, exported_date):
+    with cls._lock:
+      report = cls.db.reports.get(int(report_id))
+      if report is not None:
+        cls.db.reports[report['ID']] = report.replace(
+          LAST_DATE=last_date, LAST_ID=last_id, EXPORTED_ROWS=rows,
+          EXPORTED_DATE=exported_date)
+
+  @classmethod
+  def report_changed(cls, report_id):
+    report = cls.get_report(report_id)
+    assert report
+    if cls.report_expired(report):
+      return True
+
+    with cls._lock:
+      history = [r for r in cls.db.history
+                 if r['CREATED_DATE'] >= report['EXPORTED_DATE']]
+    if any(r['ACTION'] == 'delete' for r in history):
+      return True
+
+    mark = cls.report_mark(report)
+    ids = set(r['ID'] for r in cls.get_report_data(report_id)
+              if mark and (r['CREATED_DATE'], r['ID']) <= mark)
+    if any(r['ACTION'] == 'modified' and int(r['COMMENT_ID']) in ids for r in history):
+      return True
+
+    return len(ids) != report['EXPORTED_ROWS']
@@ -0,0 +1,146 @@
+""" Versioned schema migrations.
+
+Every migration is a list of idempotent steps. Each step runs and commits in
+its own short transaction, so a live server only waits for one index build at
+a time (readers are not blocked in WAL mode). Applied versions are stored in
+SCHEMA_VERSION table.
+
+The application applies not applied migrations on start (migrate_all),
+`python manage.py migrate` does it without starting the server.
+"""
+__author__ = 'okoneshnikov'
+import sqlite3
+import logging
+from datetime import datetime
+
+import config
+import utils
+import sharding
+
+version_table_sql = '''CREATE TABLE IF NOT EXISTS SCHEMA_VERSION
+(VERSION INTEGER PRIMARY KEY, DESCRIPTION TEXT, APPLIED_DATE TEXT NOT NULL)
+'''
+
+
+def add_column(table_name, name, description):
+  """ Return step adding column if table has not it yet."""
+  def step(conn):
+    columns = [r[1].upper() for r in conn.execute('PRAGMA table_info(%s)' % table_name)]
+    if name.upper() not in columns:
+      conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table_name, name, description))
+  return step
+
+
+# (version, description, steps)
+MIGRATIONS = [
+  (1, 'Indexes for get_comments, get_reports, get_report_data and HISTORY', [
+    # get_comments: filter by object and top level, ordered by date
+    '''CREATE INDEX IF NOT EXISTS comments_object_date_index
+       ON COMMENTS (OBJ_TYPE, OBJ_ID, PARENT_ID, CREATED_DATE)''',
+    'DROP INDEX IF EXISTS object_index',
+    # get_report_data: filter by user and dates range, ordered by date
+    '''CREATE INDEX IF NOT EXISTS comments_user_date_index
+       ON COMMENTS (USER_ID, CREATED_DATE)''',
+    'DROP INDEX IF EXISTS user_index',
+    # get_reports
+    '''CREATE INDEX IF NOT EXISTS reports_owner_date_index
+       ON REPORTS (OWNER, CREATED_DATE)''',
+    '''CREATE INDEX IF NOT EXISTS reports_date_index
+       ON REPORTS (CREATED_DATE)''',
+    '''CREATE INDEX IF NOT EXISTS history_comment_index
+       ON HISTORY (COMMENT_ID)''',
+    '''CREATE INDEX IF NOT EXISTS history_date_index
+       ON HISTORY (CREATED_DATE)''',
+  ]),
+  (2, 'Full-text search index of comments', [
+    # external content table, comment text is stored only in COMMENTS
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS COMMENTS_FTS
+       USING fts5(COMMENT, content='COMMENTS', content_rowid='ID')''',
+    "INSERT INTO COMMENTS_FTS(COMMENTS_FTS) VALUES('rebuild')",
+  ]),
+  (3, 'Index of direct children for depth limited trees', [
+    '''CREATE INDEX IF NOT EXISTS comments_parent_index
+       ON COMMENTS (PARENT_ID)''',
+  ]),
+  (4, 'High-water mark of report export for incremental restart', [
+    add_column('REPORTS', 'LAST_DATE', 'TEXT'),
+    add_column('REPORTS', 'LAST_ID', 'INT'),
+    add_column('REPORTS', 'EXPORTED_ROWS', 'INT'),
+    add_column('REPORTS', 'EXPORTED_DATE', 'TEXT'),
+  ]),
+  (5, 'Reports deduplication by parameters and data version', [
+    add_column('REPORTS', 'CACHE_KEY', 'TEXT'),
+    add_column('REPORTS', 'SOURCE_ID', 'INT'),
+    '''CREATE INDEX IF NOT EXISTS reports_cache_key_index
+       ON REPORTS (CACHE_KEY)''',
+    '''CREATE INDEX IF NOT EXISTS reports_source_index
+       ON REPORTS (SOURCE_ID)''',
+  ]),
+  (6, 'Report export progress', [
+    add_column('REPORTS', 'STARTED_DATE', 'TEXT'),
+    add_column('REPORTS', 'PROGRESS_ROWS', 'INT'),
+    add_column('REPORTS', 'TOTAL_ROWS', 'INT'),
+    add_column('REPORTS', 'ROWS_PER_SEC', 'REAL'),
+    add_column('REPORTS', 'PROGRESS_DATE', 'TEXT'),
+  ]),
+  (7, 'Versions of objects and subtrees for conditional GET', [
+    # versions start from 0 for existing comments
+    '''CREATE TABLE IF NOT EXISTS OBJECT_VERSIONS
+       (COMMENT_ID INTEGER NOT NULL, OBJ_TYPE CHAR(50) NOT NULL,
+        OBJ_ID CHAR(50) NOT NULL, VERSION INTEGER NOT NULL,
+        UPDATED_DATE TEXT NOT NULL)''',
+    '''CREATE UNIQUE INDEX IF NOT EXISTS object_versions_index
+       ON OBJECT_VERSIONS (COMMENT_ID, OBJ_TYPE, OBJ_ID)''',
+  ]),
+]
+
+
+def current_version(conn):
+  conn.execute(version_table_sql)
+  conn.commit()
+  return conn.execute('SELECT max(VERSION) FROM SCHEMA_VERSION').fetchone()[0] or 0
+
+
+def migrate(dbname, target=None):
+  """ Apply not applied migrations up to target version (all by default).
+  @return: list of applied versions.
+  """
+  conn = sqlite3.connect(dbname, timeout=config.DB_BUSY_TIMEOUT)
+  try:
+    version = current_version(conn)
+    applied = []
+
+    for number, description, steps in MIGRATIONS:
+      if number <= version or (target is not None and number > target):
+        continue
+
+      logging.info('Migration %s: %s', number, description)
+      for step in steps:
+        if callable(step):
+          step(conn)
+        else:
+          conn.execute(step)
+        conn.commit()
+
+      conn.execute('INSERT INTO SCHEMA_VERSION VALUES (?, ?, ?)',
+                   (number, description, utils.dbdate(datetime.utcnow())))
+      conn.commit()
+      applied.append(number)
+
+    return applied
+  finally:
+    conn.close()
+
+
+def migrate_all(dbname=None, shards=None, target=None):
+  """ Migrate database and its shard files.
+  @return: list of (file name, applied versions).
+  """
+  dbname = dbname or config.DB_NAME
+  shards = shards or config.DB_SHARDS
+  return [(name, migrate(name, target))
+          for name in sharding.database_names(dbname, shards)]
+
+
+def latest_version():
+  return MIGRATIONS[-1][0]
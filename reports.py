@@ -0,0 +1,181 @@
+""" Report files writers.
+
+Writers take an iterator of COMMENTS rows and write them to the file as they
+come, so export memory does not grow with report size. Long reports are split
+by date_slices, slices are written to part files in parallel and joined by
+concat_files.
+
+Report FILE_TYPE is one of FILE_TYPES: CSV with header or NDJSON (JSON object
+per line), '.gz' types are gzip compressed while written. Appended rows and
+joined parts are separate gzip members, readers join members (RFC 1952).
+"""
+__author__ = 'okoneshnikov'
+import os
+import csv
+import gzip
+import json
+import time
+import shutil
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+
+import config
+import utils
+from scheme import comments_meta
+
+FILE_TYPES = ('csv', 'csv.gz', 'ndjson', 'ndjson.gz')
+
+fields = [item[0] for item in comments_meta]
+
+
+class ReportCancelled(Exception):
+  """ Report export is stopped by StorageBackend.cancel_report."""
+
+
+def csv_row(r):
+  """ Return CSV row of comment: numbers as is, text encoded to utf-8."""
+  row = []
+  for val in r:
+    if isinstance(val, (int, long)):
+      row.append(val)
+    else:
+      row.append((val or '').encode('utf-8'))
+  return row
+
+
+def csv_writer(csvfile):
+  return csv.writer(csvfile, delimiter=',', quoting=csv.QUOTE_ALL)
+
+
+def file_format(file_type):
+  """ Return rows format of file type: 'csv' or 'ndjson'."""
+  assert file_type in FILE_TYPES, file_type
+  return file_type.split('.')[0]
+
+
+@contextmanager
+def report_file(file_name, file_type='csv', append=False, buffer_size=None):
+  """ Open report file for writing, compressed for '.gz' file types."""
+  buffer_size = buffer_size or config.REPORT_BUFFER_SIZE
+  with open(file_name, 'ab' if append else 'wb', buffer_size) as f:
+    if file_type.endswith('.gz'):
+      with gzip.GzipFile(fileobj=f, mode='wb',
+                         compresslevel=config.REPORT_GZIP_LEVEL) as gz:
+        yield gz
+    else:
+      yield f
+
+
+def write_header(f, file_type='csv'):
+  """ Write fields names row to CSV report, NDJSON has not header."""
+  if file_format(file_type) == 'csv':
+    csv_writer(f).writerow(fields)
+
+
+def write_report(rows, file_name, file_type='csv', buffer_size=None,
+                 header=True, append=False):
+  """ Write comments rows to report file.
+
+  @param rows: iterable of COMMENTS rows, consumed once.
+  @param file_name: report file.
+  @param file_type: one of FILE_TYPES.
+  @param buffer_size: file write buffer in bytes (REPORT_BUFFER_SIZE by default).
+  @param header: write CSV header first, part files have not it.
+  @param append: add rows to the end of existing file.
+  @return: (number of written rows, (CREATED_DATE, ID) of the last row or None).
+  """
+  count = 0
+  last = None
+
+  with report_file(file_name, file_type, append, buffer_size) as f:
+    if header:
+      write_header(f, file_type)
+
+    if file_format(file_type) == 'csv':
+      write_row = csv_writer(f).writerow
+      for r in rows:
+        write_row(csv_row(r))
+        count += 1
+        last = r
+    else:
+      for r in rows:
+        f.write(json.dumps(OrderedDict(zip(fields, r))))
+        f.write('\n')
+        count += 1
+        last = r
+
+  if last is None:
+    return count, None
+  return count, (last['CREATED_DATE'], last['ID'])
+
+
+def track_progress(rows, update, interval=None):
+  """ Yield rows, report progress while they are consumed.
+
+  @param rows: iterable of rows.
+  @param update: function called with number of rows yielded since its
+    previous call, not more often than every `interval` seconds
+    (REPORT_PROGRESS_INTERVAL) and after the last row. It returns False to
+    stop export: ReportCancelled is raised to the consumer.
+  """
+  interval = interval or config.REPORT_PROGRESS_INTERVAL
+  count = 0
+  next_update = time.time() + interval
+  for r in rows:
+    yield r
+    count += 1
+    if time.time() >= next_update:
+      if not update(count):
+        raise ReportCancelled()
+      count = 0
+      next_update = time.time() + interval
+
+  if not update(count):
+    raise ReportCancelled()
+
+
+def date_slices(first, last, days=None):
+  """ Split report dates range to slices of `days` days (REPORT_SLICE_DAYS by
+  default).
+
+  @param first: date of the first report comment (or report start date).
+  @param last: date of the last report comment (or report end date).
+  @return: list of (since, until) dates, since is inclusive and until is
+    exclusive. The first since and the last until are None, so slices cover
+    whole report whatever its bounds are.
+  """
+  days = days or config.REPORT_SLICE_DAYS
+  if not (first and last):
+    return [(None, None)]
+
+  step = timedelta(days=days)
+  bounds = []
+  bound = utils.parse_dbdate(first) + step
+  last = utils.parse_dbdate(last)
+  while bound <= last:
+    bounds.append(utils.dbdate(bound))
+    bound += step
+
+  return zip([None] + bounds, bounds + [None])
+
+
+def part_file_name(file_name, index):
+  return '%s.part%d' % (file_name, index)
+
+
+def concat_files(parts, file_name, file_type='csv', buffer_size=None):
+  """ Write header and part files of the same type in order to report file,
+  remove parts."""
+  buffer_size = buffer_size or config.REPORT_BUFFER_SIZE
+
+  with report_file(file_name, file_type, buffer_size=buffer_size) as f:
+    write_header(f, file_type)
+
+  with open(file_name, 'ab', buffer_size) as f:
+    for part in parts:
+      with open(part, 'rb') as part_file:
+        shutil.copyfileobj(part_file, f, buffer_size)
+
+  for part in parts:
+    os.remove(part)
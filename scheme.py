@@ -1,6 +1,8 @@
 __author__ = 'okoneshnikov'
 import config
 import sqlite3
+import migrations
+import sharding
 
 # TABLES
 
@@ -36,10 +38,30 @@ report_meta = (
   ('STATUS', 'TEXT NOT NULL'),
   ('FILE_TYPE', 'TEXT NOT NULL'),
   ('FILE_NAME', 'TEXT'),
-  ('DESCRIPTION', 'TEXT')
+  ('DESCRIPTION', 'TEXT'),
+  # high-water mark of exported rows: the last (CREATED_DATE, ID), rows
+  # count and export start date, see migration 4
+  ('LAST_DATE', 'TEXT'),
+  ('LAST_ID', 'INT'),
+  ('EXPORTED_ROWS', 'INT'),
+  ('EXPORTED_DATE', 'TEXT'),
+  # reports with the same parameters and data version share file of the
+  # first one (SOURCE_ID), see migration 5
+  ('CACHE_KEY', 'TEXT'),
+  ('SOURCE_ID', 'INT'),
+  # progress of working report: export start, written and estimated rows,
+  # throughput and the last progress update date, see migration 6
+  ('STARTED_DATE', 'TEXT'),
+  ('PROGRESS_ROWS', 'INT'),
+  ('TOTAL_ROWS', 'INT'),
+  ('ROWS_PER_SEC', 'REAL'),
+  ('PROGRESS_DATE', 'TEXT')
 )
 
 history_actions = ('add', 'delete', 'modified')
+# HISTORY rows older than retention period are moved to per-month archive
+# tables HISTORY_YYYY_MM with the same fields
+history_archive_prefix = 'HISTORY_'
 history_meta = (
   ('ID', 'INTEGER NOT NULL'),
   ('USER_ID', 'CHAR(50)'),
@@ -50,11 +72,22 @@ history_meta = (
   ('CREATED_DATE', 'TEXT NOT NULL'),
 )
 
+# version of object comments (COMMENT_ID is 0) and of comment subtrees, it
+# grows with every change, see migration 7
+object_versions_meta = (
+  ('COMMENT_ID', 'INTEGER NOT NULL'),
+  ('OBJ_TYPE', 'CHAR(50) NOT NULL'),
+  ('OBJ_ID', 'CHAR(50) NOT NULL'),
+  ('VERSION', 'INTEGER NOT NULL'),
+  ('UPDATED_DATE', 'TEXT NOT NULL')
+)
+
 scheme_dict = {
   'COMMENTS': comments_meta,
   'COMMENTSTREE': comments_tree_meta,
   'REPORTS': report_meta,
-  'HISTORY': history_meta
+  'HISTORY': history_meta,
+  'OBJECT_VERSIONS': object_versions_meta
 }
 
 # INDEXES
@@ -78,22 +111,46 @@ ON COMMENTSTREE
 (PARENT_ID)
 '''
 
-def create_scheme(dbname):
+# key of version upsert
+object_versions_index_sql = '''CREATE UNIQUE INDEX IF NOT EXISTS object_versions_index
+ON OBJECT_VERSIONS
+(COMMENT_ID, OBJ_TYPE, OBJ_ID)
+'''
+
+def table_sql(name, description):
+  return 'CREATE TABLE IF NOT EXISTS %s (%s)' % \
+         (name, ','.join(["%s %s" % field for field in description]))
+
+def create_scheme(dbname, migrate=True, shards=None):
+  """ Create tables and indexes of new database and of its shard files (see
+  sharding module) and upgrade them to the latest schema version."""
+  shards = shards or config.DB_SHARDS
+  create_tables(dbname, migrate)
+  if shards > 1:
+    for index, name in enumerate(sharding.shard_names(dbname, shards)):
+      create_tables(name, migrate, shard=index)
+
+def create_tables(dbname, migrate=True, shard=None):
+  """ Create tables and indexes of one database file."""
   conn = sqlite3.connect(dbname)
   c = conn.cursor()
 
   for name, description in scheme_dict.items():
-    sql = 'CREATE TABLE %s (%s)' % \
-          (name, ','.join(["%s %s" % field for field in description]))
-    c.execute(sql)
+    c.execute(table_sql(name, description))
 
   c.execute(object_index_sql)
   c.execute(user_index_sql)
   c.execute(tree_id_index_sql)
   c.execute(tree_parent_index_sql)
+  c.execute(object_versions_index_sql)
 
   conn.commit()
+  if shard is not None:
+    sharding.init_sequence(conn, shard)
   conn.close()
 
+  if migrate:
+    migrations.migrate(dbname)
+
 if __name__ == '__main__':
   create_scheme(config.DB_NAME)
\ No newline at end of file
@@ -0,0 +1,74 @@
+""" Hash sharding of comments by object.
+
+Comments of an object with their COMMENTSTREE and HISTORY rows live in one of
+DB_SHARDS shard files chosen by a hash of (OBJ_TYPE, OBJ_ID). REPORTS stay in
+the main database. Shard i allocates comment ids from its own range
+(i * ID_RANGE, (i + 1) * ID_RANGE], so ids are unique across shards and the
+shard a comment was created in is known from its id.
+"""
+__author__ = 'okoneshnikov'
+import os
+import zlib
+
+ID_RANGE = 2 ** 40
+
+
+def shard_names(dbname, count):
+  """ Return shard files of database, the database itself for one shard."""
+  if count <= 1:
+    return [dbname]
+
+  base, ext = os.path.splitext(dbname)
+  return ['%s_%d_%d%s' % (base, count, index, ext) for index in range(count)]
+
+
+def database_names(dbname, count):
+  """ Return main database and its shard files."""
+  names = [dbname]
+  for name in shard_names(dbname, count):
+    if name not in names:
+      names.append(name)
+  return names
+
+
+def object_shard(obj_type, obj_id, count):
+  """ Return shard index of object comments."""
+  if count <= 1:
+    return 0
+
+  key = u'%s\x00%s' % (obj_type, obj_id)
+  return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % count
+
+
+def id_range(comment_id):
+  """ Return index of id range the comment id was allocated from."""
+  return (int(comment_id) - 1) // ID_RANGE
+
+
+def id_shards(comment_id, count):
+  """ Return shards to look for comment in: the shard which allocated its id
+  first. Comment may be in other shard after resharding."""
+  origin = id_range(comment_id) % count
+  return [origin] + [index for index in range(count) if index != origin]
+
+
+def init_sequence(conn, shard, last_id=0):
+  """ Make new COMMENTS ids of shard start from its range, after last_id.
+  Shard keeps its own sequence: after resharding it has comments with ids
+  of other ranges, so AUTOINCREMENT would allocate ids of other shards."""
+  conn.execute('CREATE TABLE IF NOT EXISTS SHARD_SEQUENCE (SEQ INTEGER NOT NULL)')
+  conn.execute('INSERT INTO SHARD_SEQUENCE (SEQ) SELECT 0 '
+               'WHERE NOT EXISTS (SELECT 1 FROM SHARD_SEQUENCE)')
+  conn.execute('UPDATE SHARD_SEQUENCE SET SEQ=max(SEQ, ?)',
+               (max(shard * ID_RANGE, last_id),))
+  conn.commit()
+
+
+def allocate_ids(cursor, count=1):
+  """ Take count ids from shard sequence. The update takes the write lock,
+  so ids are reserved until the transaction ends.
+  @return: the first id.
+  """
+  cursor.execute('UPDATE SHARD_SEQUENCE SET SEQ=SEQ+?', (count,))
+  cursor.execute('SELECT SEQ FROM SHARD_SEQUENCE')
+  return cursor.fetchone()[0] - count + 1
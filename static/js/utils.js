@@ -2,13 +2,14 @@
  * Created by okoneshnikov on 17.09.16.
  */
 
-function onDelete(comment_id, viewer_id) {
+function onDelete(comment_id, viewer_id, cascade) {
   $.ajax({
     type: "POST",
     url: "/comment/delete/",
     data: {
       comment_id: comment_id,
-      viewer_id: viewer_id
+      viewer_id: viewer_id,
+      cascade: cascade ? 1 : 0
     }
   }).done(function(result) {
     window.location.reload()
@@ -19,4 +20,18 @@ function onDelete(comment_id, viewer_id) {
       alert(result.message);
     }
   });
-}
\ No newline at end of file
+}
+
+function onLoadMore(link, cursor, tree_id, viewer_id) {
+  $.ajax({
+    type: "GET",
+    url: "/comment/tree/more",
+    data: {
+      cursor: cursor,
+      tree: tree_id,
+      viewer_id: viewer_id
+    }
+  }).done(function(html) {
+    $(link).closest("li").replaceWith(html);
+  });
+}
@@ -0,0 +1,416 @@
+""" Storage backends of comments.
+
+StorageBackend lists the operations handlers and tasks use. Backends are
+classes with classmethods and class level state: comments.DbManager stores
+comments in SQLite, memory.MemoryStorage keeps them in process memory (tests,
+local cache tier, baseline for benchmarks). STORAGE_BACKEND config selects
+the backend returned by backend().
+"""
+__author__ = 'okoneshnikov'
+import os
+import json
+import hashlib
+from datetime import datetime, timedelta
+
+import config
+import utils
+
+
+def backend(name=None):
+  """ Return storage backend class by name, STORAGE_BACKEND by default."""
+  name = name or config.STORAGE_BACKEND
+  if name == 'memory':
+    from memory import MemoryStorage
+    return MemoryStorage
+
+  assert name == 'sqlite', name
+  from comments import DbManager
+  return DbManager
+
+
+class TreeNode(object):
+  """ Comment of streamed tree, see StorageBackend.iter_subtree."""
+  __slots__ = ('id', 'value', 'depth', 'children', 'shown', 'last_id', 'more')
+
+  def __init__(self, id, value, depth, children):
+    self.id = id
+    self.value = value
+    self.depth = depth
+    self.children = children
+    self.shown = 0
+    self.last_id = None
+    self.more = None
+
+  def close(self):
+    """ Set cursor of not returned children after all returned ones."""
+    if self.children > self.shown:
+      self.more = utils.encode_cursor(self.id, self.last_id or 0)
+    return self
+
+
+class StorageBackend(object):
+  """ Comments storage interface.
+
+  Rows returned by get_* methods give field values by upper case name
+  (row['ID']) and by index, like sqlite3.Row. Paged methods take the cursor
+  returned with the previous page.
+  """
+
+  @classmethod
+  def connect(cls, dbname):
+    """ Open database, it is used by all following calls."""
+    raise NotImplementedError
+
+  @classmethod
+  def close(cls):
+    raise NotImplementedError
+
+  @classmethod
+  def release(cls):
+    """ Free resources of the current thread, called after every request."""
+    raise NotImplementedError
+
+  @classmethod
+  def clear(cls, table_name):
+    """ Delete all rows of COMMENTS, COMMENTSTREE, HISTORY, REPORTS or
+    OBJECT_VERSIONS."""
+    raise NotImplementedError
+
+  @classmethod
+  def clear_comments(cls):
+    cls.clear('COMMENTSTREE')
+    cls.clear('COMMENTS')
+
+  @classmethod
+  def create_comment(cls, obj_type, obj_id, user_id, comment, parent_id=None, created=None):
+    """ Create comment.
+    @return: new comment id.
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def create_comments_bulk(cls, comments, chunk_size=None):
+    """ Create many comments from dicts with obj_type, obj_id, user_id,
+    comment and optional id, parent_id, created keys.
+    @return: number of created comments.
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def get_parents(cls, comment_id):
+    """ Return comment parents ids, the root first."""
+    raise NotImplementedError
+
+  @classmethod
+  def page_result(cls, rows, limit, key=('CREATED_DATE', 'ID')):
+    """ Cut extra row fetched by keyset query and make cursor of next page
+    from key fields of the last row.
+    @return: (rows, next page cursor or None).
+    """
+    if len(rows) > limit:
+      rows = rows[:limit]
+      return rows, utils.encode_cursor(*[rows[-1][field] for field in key])
+
+    return rows, None
+
+  @classmethod
+  def get_comments(cls, obj_type, obj_id, user_id=None, limit=20, cursor=None,
+                   cached=True):
+    """ Return page of top level object comments ordered by creation date.
+    @param cached: False reads the database, not a cached page.
+    @return: (rows, next page cursor or None).
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def get_comments_multi(cls, objects, limit=None):
+    """ Return first top level comments of many (obj_type, obj_id) objects.
+    @return: dict {(obj_type, obj_id): (rows, next page cursor or None, total
+      top level comments)}.
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def get_comment(cls, comment_id, cached=True):
+    """ Return comment row or None.
+    @param cached: False reads the database, not a cached row.
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def search_comments(cls, text, obj_type=None, obj_id=None, user_id=None,
+                      limit=20, cursor=None):
+    """ Return page of comments with all words of text, best matches first.
+    @return: (rows with RANK field, next page cursor or None).
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def delete_comment(cls, comment_id, user_id):
+    """ Delete comment without children, CommentAPIError if it has them."""
+    raise NotImplementedError
+
+  @classmethod
+  def delete_subtree(cls, comment_id, user_id, batch_size=None):
+    """ Delete comment with all its children.
+    @return: number of deleted comments.
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def update_comment(cls, comment_id, user_id, comment):
+    raise NotImplementedError
+
+  @classmethod
+  def get_comments_tree(cls, comment_id):
+    """ Return all comment children ordered by id."""
+    raise NotImplementedError
+
+  @classmethod
+  def get_subtree(cls, comment_id, max_depth=None, child_limit=None, after_id=None):
+    """ Return comment children down to max_depth levels with at most
+    child_limit children of every comment. Rows are in tree (depth-first)
+    order, children are ordered by id.
+
+    @param comment_id: comment id.
+    @param max_depth: levels to return, 1 - only direct children.
+    @param child_limit: children per comment.
+    @param after_id: return children of comment_id with id greater than it.
+    @return: (rows, cursors). Rows have DEPTH (1 for direct children) and
+      CHILDREN (number of direct children) fields. cursors is a dict
+      {comment id: cursor} for comments (including comment_id) which have
+      not returned children; pass cursor to get_subtree_page to load them.
+    """
+    rows = []
+    cursors = {}
+    for event, node in cls.iter_subtree(comment_id, max_depth, child_limit, after_id):
+      if event == 'open':
+        rows.append(node.value)
+      elif node.more:
+        cursors[node.id] = node.more
+
+    return rows, cursors
+
+  @classmethod
+  def iter_subtree(cls, comment_id, max_depth=None, child_limit=None, after_id=None):
+    """ Walk get_subtree rows.
+
+    Yields ('open', node) for every returned comment in depth-first order and
+    ('close', node) after all its returned children. Node `more` is set before
+    close event: cursor of not returned children or None. The last event
+    closes comment_id node itself (its value is None).
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def get_subtree_page(cls, cursor, max_depth=None, child_limit=None):
+    """ Return next children of comment by cursor returned by get_subtree.
+    @return: (comment id, rows, cursors) see get_subtree.
+    """
+    comment_id, after_id = utils.decode_cursor(cursor, (utils.INTEGER, utils.INTEGER))
+    rows, cursors = cls.get_subtree(comment_id, max_depth, child_limit, after_id)
+    return comment_id, rows, cursors
+
+  @classmethod
+  def get_object_version(cls, obj_type, obj_id):
+    """ Return version of object comments: it grows when any comment of object
+    is created, edited or deleted.
+    @return: (version, date of the last change), (0, None) if comments were
+      not changed since versions are kept.
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def get_subtree_version(cls, comment_id):
+    """ Return version of comment with all its children, see
+    get_object_version."""
+    raise NotImplementedError
+
+  @classmethod
+  def get_reports(cls, user_id, limit=20, cursor=None):
+    """ Return page of reports, newest first.
+    @return: (rows, next page cursor or None).
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def get_working_reports(cls):
+    """ Return reports which write their files (not sharing file of other
+    report) and are working or have working reports sharing their files."""
+    raise NotImplementedError
+
+  @classmethod
+  def create_report(cls, owner, user_id, obj_type=None, obj_id=None,
+                    start_date=None, end_date=None,
+                    status='working', file_type='csv'):
+    """ Add report description. With REPORT_CACHE new report gets status and
+    file of the report with the same cache key which is working or completed.
+    Working one becomes its source (SOURCE_ID), see update_report.
+    @return: new report id.
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def report_cache_key(cls, user_id, obj_type, obj_id, start_date, end_date,
+                       file_type, version):
+    """ Return cache key of report: hash of normalized query parameters and
+    data version (see data_version)."""
+    obj_type = obj_type or ''
+    # object id without type does not filter comments
+    obj_id = obj_id or '' if obj_type else ''
+    params = [user_id, obj_type, obj_id, start_date or '', end_date or '',
+              file_type, version]
+    return hashlib.sha1(json.dumps(params)).hexdigest()
+
+  @classmethod
+  def data_version(cls, obj_type=None, obj_id=None):
+    """ Return version of comments report of object may read. It changes
+    when comment is created, edited or deleted, see OBJECT_VERSIONS."""
+    raise NotImplementedError
+
+  @classmethod
+  def get_report_data(cls, report_id):
+    """ Return comments of report ordered by creation date."""
+    raise NotImplementedError
+
+  @classmethod
+  def get_report(cls, report_id):
+    """ Return report row or None."""
+    raise NotImplementedError
+
+  @classmethod
+  def iter_report_data(cls, report_id, batch_size=None, since=None, until=None,
+                       after=None):
+    """ Iterate comments of report ordered by creation date, backends which
+    can read rows by parts do not load all of them at once.
+    @param since: skip comments created before the date.
+    @param until: skip comments created at the date and later.
+    @param after: (CREATED_DATE, ID) of the last exported comment, skip it
+      and all comments before it.
+    """
+    for r in cls.get_report_data(report_id):
+      if since and r['CREATED_DATE'] < since:
+        continue
+      if after and (r['CREATED_DATE'], r['ID']) <= tuple(after):
+        continue
+      if until and r['CREATED_DATE'] >= until:
+        break
+      yield r
+
+  @classmethod
+  def count_report_data(cls, report_id, after=None):
+    """ Return number of comments of report (after the mark)."""
+    return sum(1 for r in cls.iter_report_data(report_id, after=after))
+
+  @classmethod
+  def get_report_dates(cls, report_id):
+    """ Return creation dates of the first and the last comments of report,
+    (None, None) if report is empty."""
+    rows = cls.get_report_data(report_id)
+    if not rows:
+      return None, None
+    return rows[0]['CREATED_DATE'], rows[-1]['CREATED_DATE']
+
+  @classmethod
+  def get_report_file_name(cls, report_id, file_type='csv', version=None):
+    """ Return report file name, version makes a new file of restarted
+    report which file is given to other reports."""
+    name = 'report_%s-%s' % (report_id, version) if version else 'report_%s' % report_id
+    return os.path.join(config.REPORTS_DIR, '%s.%s' % (name, file_type))
+
+  @classmethod
+  def report_file_shared(cls, report_id, file_name):
+    """ Check if other reports have file_name or wait for report result."""
+    raise NotImplementedError
+
+  @classmethod
+  def update_report(cls, report_id, file_name, file_type='csv', status='completed', description=''):
+    """ Set report result. Report stops sharing file of its source, working
+    reports which share its file get the same result and stop sharing.
+    Cancelled report keeps its status."""
+    raise NotImplementedError
+
+  @classmethod
+  def update_report_status(cls, report_id, status):
+    raise NotImplementedError
+
+  @classmethod
+  def restart_report(cls, report_id):
+    """ Set report working before its export is run again.
+    @return: False if report is not found or is exported already (working
+    or has working reports sharing its file).
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def start_report(cls, report_id, total_rows):
+    """ Set report working and reset its progress before export. Cancelled
+    report stays cancelled while it is exported for reports sharing its file.
+    @return: False if report and reports sharing its file were cancelled
+    while waiting for export.
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def update_report_progress(cls, report_id, rows):
+    """ Add rows written since the previous call to report progress, update
+    its throughput. Several processes may export parts of one report.
+    @return: False if report and reports sharing its file were cancelled,
+    export has to stop.
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def cancel_report(cls, report_id):
+    """ Cancel working report, it stops sharing file of its source. Its
+    export stops when reports sharing its file are not working too, see
+    update_report_progress.
+    @return: False if report is not working.
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def update_report_mark(cls, report_id, last_date, last_id, rows, exported_date):
+    """ Store high-water mark of report file: (CREATED_DATE, ID) of its last
+    comment, number of rows and the date export started."""
+    raise NotImplementedError
+
+  @classmethod
+  def report_changed(cls, report_id):
+    """ Check if report file has to be rebuilt: comments up to its mark were
+    edited or deleted (by HISTORY since export date) or created with past
+    dates. False means newer comments can be appended to the file, it needs
+    synchronous HISTORY (HISTORY_MODE 'sync')."""
+    raise NotImplementedError
+
+  @classmethod
+  def report_mark(cls, report):
+    """ Return (CREATED_DATE, ID) of the last exported comment of report row
+    or None."""
+    if not report['LAST_DATE']:
+      return None
+    return report['LAST_DATE'], report['LAST_ID']
+
+  @classmethod
+  def report_expired(cls, report):
+    """ Check if report row has not usable mark: it was not exported or
+    HISTORY rows since export may be archived already."""
+    exported = report['EXPORTED_DATE']
+    if not exported or report['EXPORTED_ROWS'] is None:
+      return True
+
+    before = datetime.utcnow() - timedelta(days=config.HISTORY_RETENTION_DAYS)
+    return exported < utils.dbdate(before)
+
+  @classmethod
+  def flush_history(cls):
+    """ Wait until HISTORY rows of previous calls are stored."""
+    raise NotImplementedError
+
+  @classmethod
+  def compact_history(cls, retention_days=None, archive=None,
+                      archive_months=None, batch_size=None):
+    """ Apply HISTORY retention policy.
+    @return: (archived rows count, dropped archives names).
+    """
+    raise NotImplementedError
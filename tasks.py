@@ -1,46 +1,210 @@
 __author__ = 'okoneshnikov'
-from celery import Celery
-from celery.utils.log import get_task_logger
-import csv
+from datetime import datetime
+import os
+import logging
 
-from comments import DbManager as dbm
-from scheme import comments_meta
+import storage
+import reports
+import executors
+import utils
 import sqlite3
 import config
 
-app = Celery('tasks', backend='rpc://', broker='amqp://')
-app.config_from_object('celeryconfig')
+try:
+  from celery import Celery
+  from celery.utils.log import get_task_logger
+  from billiard import Pool
+except ImportError:
+  # TASK_EXECUTOR = 'local' runs tasks without Celery
+  Celery = None
+  from multiprocessing import Pool
 
-log = get_task_logger('__name__')
+dbm = storage.backend()
 
-@app.task
+if Celery is not None:
+  app = Celery('tasks', backend='rpc://', broker='amqp://')
+  app.config_from_object('celeryconfig')
+  task = app.task
+  log = get_task_logger('__name__')
+else:
+  app = None
+  task = lambda func: func
+  log = logging.getLogger(__name__)
+
+@task
 def add(x, y):
     return x + y
 
-@app.task
-def create_report(report_id):
-  dbm.connect(config.DB_NAME)
+@task
+def create_report(report_id, incremental=False):
+  """ Write report file. Incremental run (report restart) appends comments
+  created after the file high-water mark, the file is rebuilt if comments up
+  to the mark were changed. Report sharing file of the same report (see
+  StorageBackend.create_report) gets it when that one is completed, restart
+  writes its own file. A file given to other reports is never changed, the
+  restart of its report writes a new one. Written rows are stored to report progress, export
+  stops when report and reports sharing its file are cancelled. Failed export
+  sets status 'failed' of all of them.
+  @return: report file name, None if report was cancelled.
+  """
+  open_storage()
+  try:
+    return write_report_file(report_id, incremental)
+  finally:
+    close_storage()
 
-  data = dbm.get_report_data(report_id)
-  file_name = dbm.get_report_file_name(report_id)
+def write_report_file(report_id, incremental=False):
+  report = dbm.get_report(report_id)
+  if report['SOURCE_ID'] and not incremental:
+    log.info('Report %s: shares report %s', report_id, report['SOURCE_ID'])
+    return dbm.get_report_file_name(report['SOURCE_ID'], report['FILE_TYPE'])
 
-  with open(file_name, 'wb') as csvfile:
-    fieldnames = [item[0] for item in comments_meta]
-    writer = csv.writer(csvfile, delimiter=',', quoting=csv.QUOTE_ALL)
+  file_type = report['FILE_TYPE']
+  # changes made while the file is written are newer than export date,
+  # so the next restart sees them
+  now = datetime.utcnow()
+  exported = utils.dbdate(now)
+  file_name = report['FILE_NAME'] or dbm.get_report_file_name(report_id, file_type)
+  if dbm.report_file_shared(report_id, file_name):
+    # file of other reports is not changed or removed by restart
+    file_name = dbm.get_report_file_name(report_id, file_type,
+                                         now.strftime('%Y%m%d%H%M%S%f'))
 
-    writer.writerow(fieldnames)
-    for r in data:
-      row = []
-      for val in r:
-        if isinstance(val, int):
-          row.append(val)
-        else:
-          row.append((val or '').encode('utf-8'))
+  append = (incremental and os.path.isfile(file_name) and
+            not dbm.report_changed(report_id))
+  mark = dbm.report_mark(report) if append else None
+  if not dbm.start_report(report_id, dbm.count_report_data(report_id, after=mark)):
+    log.info('Report %s: cancelled', report_id)
+    return None
 
-      writer.writerow(row)
+  try:
+    if append:
+      rows = reports.track_progress(dbm.iter_report_data(report_id, after=mark),
+                                    progress(report_id))
+      count, last = reports.write_report(rows, file_name, file_type,
+                                         header=False, append=True)
+      log.info('Report %s: %d rows appended', report_id, count)
+      count += report['EXPORTED_ROWS']
+      last = last or mark
+    else:
+      count, last = export_report(report_id, file_name, file_type)
+  except reports.ReportCancelled:
+    # partly written file is not used by the next restart
+    log.info('Report %s: cancelled', report_id)
+    if os.path.isfile(file_name):
+      os.remove(file_name)
+    dbm.update_report(report_id, '', file_type, status='cancelled')
+    return None
+  except Exception as e:
+    # reports sharing the file fail too
+    log.exception('Report %s: failed', report_id)
+    if os.path.isfile(file_name):
+      os.remove(file_name)
+    dbm.update_report(report_id, '', file_type, status='failed', description=str(e))
+    raise
 
   # update report row
-  dbm.update_report(report_id, file_name)
-  dbm.connection.close()
+  dbm.update_report(report_id, file_name, file_type)
+  dbm.update_report_mark(report_id, last and last[0], last and last[1],
+                         count, exported)
+  return file_name
+
+def open_storage():
+  """ Connect storage in worker process. Tasks run by LocalExecutor threads
+  use connections of the application."""
+  if not executors.in_process():
+    dbm.connect(config.DB_NAME)
+
+def close_storage():
+  if executors.in_process():
+    dbm.release()
+  else:
+    dbm.close()
+
+def recover_reports(executor=None):
+  """ Run again exports of reports left working by stopped process, files
+  are rebuilt. Called on start of application with LocalExecutor, queue of
+  Celery is kept by its broker.
+  @return: ids of restarted reports.
+  """
+  executor = executor or executors.executor()
+  ids = [r['ID'] for r in dbm.get_working_reports()]
+  for report_id in ids:
+    log.info('Report %s: restarted after stop', report_id)
+    try:
+      executor.submit(create_report, (report_id,), priority=executors.PRIORITY_LOW)
+    except executors.QueueFull:
+      # it stays working and is recovered by the next start
+      log.warning('Report %s: queue is full', report_id)
+  return ids
+
+def progress(report_id):
+  """ Return update function of reports.track_progress for report."""
+  return lambda rows: dbm.update_report_progress(report_id, rows)
+
+def export_report(report_id, file_name, file_type='csv'):
+  """ Write all comments of report to file of file_type (reports.FILE_TYPES).
+  @return: (number of rows, (CREATED_DATE, ID) of the last row or None).
+  """
+  slices = reports.date_slices(*dbm.get_report_dates(report_id))
+  # application process with LocalExecutor threads is not forked
+  if len(slices) == 1 or executors.in_process():
+    # rows are read by batches and written as they come
+    rows = reports.track_progress(dbm.iter_report_data(report_id),
+                                  progress(report_id))
+    count, last = reports.write_report(rows, file_name, file_type)
+  else:
+    count, last = export_slices(report_id, slices, file_name, file_type)
+  log.info('Report %s: %d rows in %d slices', report_id, count, len(slices))
+  return count, last
+
+def export_slices(report_id, slices, file_name, file_type='csv'):
+  """ Write date slices of report to part files in REPORT_WORKERS processes
+  and join them to report file.
+  @return: see export_report.
+  """
+  parts = [reports.part_file_name(file_name, i) for i in range(len(slices))]
+  args = [(report_id, since, until, part, file_type)
+          for (since, until), part in zip(slices, parts)]
+
+  # connections are not shared with forked workers, they open their own
+  dbm.close()
+  pool = Pool(min(config.REPORT_WORKERS, len(slices)),
+              initializer=dbm.connect, initargs=(config.DB_NAME,))
+  try:
+    results = pool.map(export_slice, args)
+    pool.close()
+  except:
+    pool.terminate()
+    for part in parts:
+      if os.path.isfile(part):
+        os.remove(part)
+    raise
+  finally:
+    pool.join()
+    dbm.connect(config.DB_NAME)
+
+  reports.concat_files(parts, file_name, file_type)
+  marks = [last for count, last in results if last]
+  return sum(count for count, last in results), marks[-1] if marks else None
+
+def export_slice(args):
+  """ Write comments of report created in [since, until) to part file."""
+  report_id, since, until, part, file_type = args
+  rows = reports.track_progress(
+    dbm.iter_report_data(report_id, since=since, until=until), progress(report_id))
+  result = reports.write_report(rows, part, file_type, header=False)
+  dbm.release()
+  return result
+
+@task
+def compact_history():
+  """ Archive old HISTORY rows and drop expired archives."""
+  open_storage()
+  try:
+    archived, dropped = dbm.compact_history()
+  finally:
+    close_storage()
 
-  return file_name
\ No newline at end of file
+  log.info('Archived %d HISTORY rows, dropped archives: %s', archived, dropped)
+  return archived
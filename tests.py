@@ -11,6 +11,28 @@ from comments import DbManager as db
 from datetime import datetime
 import utils
 import tasks
+import threading
+import json
+import migrations
+import sharding
+import glob
+import gzip
+import sys
+import subprocess
+import storage
+import reports
+import executors
+import time
+import types
+import webapp2
+import webob
+import main
+import base_handler
+from StringIO import StringIO
+from wsgiref.util import FileWrapper
+import config
+from cache import LRUCache
+from history import HistoryWriter
 
 path = os.path.dirname(__file__)
 TEMP_DIR = 'testfiles'
@@ -67,7 +89,7 @@ class SomeTestCase(unittest.TestCase):
       (11, 4, 1)
     )
 
-    c = db.connection.cursor()
+    c = db.cursor()
 
     for id, parent_id, level in tree_data:
       db.insert('COMMENTSTREE', dict(id=id, parent_id=parent_id, level=level), cursor=c)
@@ -119,16 +141,16 @@ class SomeTestCase(unittest.TestCase):
     self.assertEqual(row['USER_ID'], 'u2')
     self.assertEqual(row['COMMENT'], 'test 3')
 
-    rows = db.get_comments('Post', 'id1')
+    rows, cursor = db.get_comments('Post', 'id1')
     self.assertEqual(set(r['ID'] for r in rows), set([comment_id1]))
 
-    rows = db.get_comments('Post', 'id2')
+    rows, cursor = db.get_comments('Post', 'id2')
     self.assertEqual(set(r['ID'] for r in rows), set([comment_id2, comment_id3]))
 
-    rows = db.get_comments('Post', 'id2', 'u1')
+    rows, cursor = db.get_comments('Post', 'id2', 'u1')
     self.assertEqual(set(r['ID'] for r in rows), set([comment_id2]))
 
-    rows = db.get_comments('Post', 'id2', 'u2')
+    rows, cursor = db.get_comments('Post', 'id2', 'u2')
     self.assertEqual(set(r['ID'] for r in rows), set([comment_id3]))
 
     # comment_id1 - c11
@@ -178,6 +200,219 @@ class SomeTestCase(unittest.TestCase):
 
     self.assertTrue(db.delete_comment(c12, 'u2'))
 
+  def test_create_comments_bulk(self):
+    db.clear_comments()
+    root = db.create_comment('Post', 'id1', 'u1', 'root')
+
+    # r1 - r11 - r111
+    #      r12
+    # root - r2 - r21
+    data = [
+      dict(id=1001, obj_type='Post', obj_id='id1', user_id='u1', comment='r1'),
+      dict(id=1002, obj_type='Post', obj_id='id1', user_id='u2', comment='r11', parent_id=1001),
+      dict(id=1003, obj_type='Post', obj_id='id1', user_id='u1', comment='r111', parent_id=1002),
+      dict(id=1004, obj_type='Post', obj_id='id1', user_id='u2', comment='r12', parent_id=1001),
+      dict(obj_type='Post', obj_id='id1', user_id='u1', comment='r2', parent_id=root,
+           created='2016-01-01 00:00:00'),
+    ]
+    self.assertEqual(db.create_comments_bulk(iter(data), chunk_size=2), 5)
+
+    self.assertEqual(db.get_parents(1003), [1001, 1002])
+    self.assertEqual(db.get_parents(1004), [1001])
+    rows = db.get_comments_tree(1001)
+    self.assertEqual(set(r['ID'] for r in rows), set([1002, 1003, 1004]))
+
+    r2 = db.get_comments_tree(root)[0]
+    self.assertEqual(r2['ID'], 1005)
+    self.assertEqual(r2['CREATED_DATE'], '2016-01-01 00:00:00')
+
+    r21 = db.create_comment('Post', 'id1', 'u1', 'r21', parent_id=r2['ID'])
+    self.assertEqual(r21, 1006)
+    self.assertEqual(db.get_parents(r21), [root, 1005])
+
+    c = db.cursor()
+    c.execute("SELECT count(*) FROM HISTORY WHERE ACTION='add' AND COMMENT_ID IN (1001, 1005)")
+    self.assertEqual(c.fetchone()[0], 2)
+
+  def test_get_comments_pages(self):
+    db.clear_comments()
+
+    ids = [db.create_comment('Post', 'id3', 'u1', 'c%d' % i,
+                             created=datetime(2016, 1, 1 + i // 2))
+           for i in range(7)]
+
+    pages = []
+    cursor = None
+    while True:
+      rows, cursor = db.get_comments('Post', 'id3', limit=3, cursor=cursor)
+      pages.append([r['ID'] for r in rows])
+      if not cursor:
+        break
+
+    self.assertEqual(pages, [ids[0:3], ids[3:6], ids[6:7]])
+    self.assertRaises(ValueError, db.get_comments, 'Post', 'id3', cursor='bad')
+
+  def test_get_comments_multi(self):
+    db.clear_comments()
+    ids = [db.create_comment('Post', 'id1', 'u1', 'c%d' % i,
+                             created=datetime(2016, 1, 5 - i))
+           for i in range(4)]
+    other = db.create_comment('Post', 'id2', 'u1', 'other')
+    db.create_comment('Post', 'id1', 'u1', 'reply', parent_id=ids[0])
+
+    result = db.get_comments_multi([('Post', 'id1'), ('Post', 'id2'),
+                                    ('Post', 'none')], limit=2)
+    rows, cursor, total = result[('Post', 'id1')]
+    self.assertEqual([r['ID'] for r in rows], [ids[3], ids[2]])
+    self.assertEqual(total, 4)
+    rows, cursor = db.get_comments('Post', 'id1', limit=2, cursor=cursor)
+    self.assertEqual([r['ID'] for r in rows], [ids[1], ids[0]])
+
+    rows, cursor, total = result[('Post', 'id2')]
+    self.assertEqual(([r['ID'] for r in rows], cursor, total), ([other], None, 1))
+    self.assertEqual(result[('Post', 'none')], ([], None, 0))
+
+  def test_get_reports_pages(self):
+    db.clear('REPORTS')
+    ids = [db.create_report('admin', 'u1') for i in range(5)]
+    db.create_report('other', 'u1')
+
+    rows, cursor = db.get_reports('admin', limit=2)
+    self.assertEqual([r['ID'] for r in rows], [ids[4], ids[3]])
+    rows, cursor = db.get_reports('admin', limit=2, cursor=cursor)
+    self.assertEqual([r['ID'] for r in rows], [ids[2], ids[1]])
+    rows, cursor = db.get_reports('admin', limit=2, cursor=cursor)
+    self.assertEqual([r['ID'] for r in rows], [ids[0]])
+    self.assertEqual(cursor, None)
+
+    rows, cursor = db.get_reports(None, limit=10)
+    self.assertEqual(len(rows), 6)
+
+  def test_delete_subtree(self):
+    db.clear_comments()
+    db.clear('HISTORY')
+    root = db.create_comment('Post', 'id1', 'u1', 'root')
+    other = db.create_comment('Post', 'id1', 'u1', 'other')
+    c1 = db.create_comment('Post', 'id1', 'u1', 'c1', parent_id=root)
+    c11 = db.create_comment('Post', 'id1', 'u1', 'c11', parent_id=c1)
+    c12 = db.create_comment('Post', 'id1', 'u1', 'c12', parent_id=c1)
+    c111 = db.create_comment('Post', 'id1', 'u1', 'c111', parent_id=c11)
+    o1 = db.create_comment('Post', 'id1', 'u1', 'o1', parent_id=other)
+    db.get_comment(c11)
+
+    self.assertEqual(db.delete_subtree(c1, 'u2', batch_size=2), 4)
+    for comment_id in (c1, c11, c12, c111):
+      self.assertEqual(db.get_comment(comment_id), None)
+    self.assertEqual([r['ID'] for r in db.get_comments_tree(root)], [])
+    self.assertEqual([r['ID'] for r in db.get_comments_tree(other)], [o1])
+
+    c = db.cursor()
+    c.execute("SELECT COMMENT_ID FROM HISTORY WHERE ACTION='delete' AND USER_ID='u2'")
+    self.assertEqual(sorted(r[0] for r in c.fetchall()), sorted([c1, c11, c12, c111]))
+
+    self.assertEqual(db.delete_subtree(root, 'u1'), 1)
+    rows, cursor = db.get_comments('Post', 'id1')
+    self.assertEqual([r['ID'] for r in rows], [other])
+    self.assertEqual(db.delete_subtree(root, 'u1'), 0)
+    db.cursor().execute("INSERT INTO COMMENTS_FTS(COMMENTS_FTS) VALUES('integrity-check')")
+
+  def test_get_subtree(self):
+    db.clear_comments()
+    root = db.create_comment('Post', 'id1', 'u1', 'root')
+    # root - a - a1 - a11
+    #          - a2
+    #          - a3
+    #      - b
+    #      - c - c1
+    a = db.create_comment('Post', 'id1', 'u1', 'a', parent_id=root)
+    a1 = db.create_comment('Post', 'id1', 'u1', 'a1', parent_id=a)
+    a11 = db.create_comment('Post', 'id1', 'u1', 'a11', parent_id=a1)
+    a2 = db.create_comment('Post', 'id1', 'u1', 'a2', parent_id=a)
+    a3 = db.create_comment('Post', 'id1', 'u1', 'a3', parent_id=a)
+    b = db.create_comment('Post', 'id1', 'u1', 'b', parent_id=root)
+    c = db.create_comment('Post', 'id1', 'u1', 'c', parent_id=root)
+    c1 = db.create_comment('Post', 'id1', 'u1', 'c1', parent_id=c)
+
+    rows, cursors = db.get_subtree(root, max_depth=10, child_limit=10)
+    self.assertEqual([(r['ID'], r['DEPTH']) for r in rows],
+                     [(a, 1), (a1, 2), (a11, 3), (a2, 2), (a3, 2), (b, 1), (c, 1), (c1, 2)])
+    self.assertEqual(cursors, {})
+
+    rows, cursors = db.get_subtree(root, max_depth=2, child_limit=2)
+    self.assertEqual([r['ID'] for r in rows], [a, a1, a2, b])
+    self.assertEqual(rows[0]['CHILDREN'], 3)
+    self.assertEqual(set(cursors), set([root, a, a1]))
+
+    comment_id, rows, more = db.get_subtree_page(cursors[a], max_depth=2, child_limit=2)
+    self.assertEqual(comment_id, a)
+    self.assertEqual([r['ID'] for r in rows], [a3])
+    self.assertEqual(more, {})
+
+    comment_id, rows, more = db.get_subtree_page(cursors[root], max_depth=2, child_limit=2)
+    self.assertEqual([(r['ID'], r['DEPTH']) for r in rows], [(c, 1), (c1, 2)])
+    self.assertEqual(more, {})
+
+    comment_id, rows, more = db.get_subtree_page(cursors[a1], max_depth=1)
+    self.assertEqual([r['ID'] for r in rows], [a11])
+
+    events = db.iter_subtree(root, max_depth=2, child_limit=2)
+    # first node is given before the rest of the tree is read
+    self.assertEqual(next(events)[1].id, a)
+    self.assertEqual([(e, n.id) for e, n in events],
+                     [('open', a1), ('close', a1), ('open', a2), ('close', a2),
+                      ('close', a), ('open', b), ('close', b), ('close', root)])
+
+  def test_search_comments(self):
+    db.clear_comments()
+    c1 = db.create_comment('Post', 'id1', 'u1', 'red apple and green pear')
+    c2 = db.create_comment('Post', 'id2', 'u2', 'apple apple apple')
+    c3 = db.create_comment('Post', 'id1', 'u2', 'green "grapes"', parent_id=c1)
+    c4 = db.create_comment('Post', 'id1', 'u1', 'plum')
+
+    rows, cursor = db.search_comments('apple')
+    self.assertEqual([r['ID'] for r in rows], [c2, c1])
+    self.assertTrue(rows[0]['RANK'] <= rows[1]['RANK'])
+
+    rows, cursor = db.search_comments('apple', limit=1)
+    self.assertEqual([r['ID'] for r in rows], [c2])
+    rows, cursor = db.search_comments('apple', limit=1, cursor=cursor)
+    self.assertEqual([r['ID'] for r in rows], [c1])
+    self.assertEqual(cursor, None)
+
+    rows, cursor = db.search_comments('green', obj_type='Post', obj_id='id1', user_id='u2')
+    self.assertEqual([r['ID'] for r in rows], [c3])
+    rows, cursor = db.search_comments('"grapes" AND')
+    self.assertEqual([r['ID'] for r in rows], [])
+
+    db.update_comment(c4, 'u1', 'apple pie')
+    db.delete_comment(c3, 'u1')
+    db.update_comment(c1, 'u1', 'green pear')
+    rows, cursor = db.search_comments('apple')
+    self.assertEqual(set(r['ID'] for r in rows), set([c2, c4]))
+    rows, cursor = db.search_comments('green')
+    self.assertEqual([r['ID'] for r in rows], [c1])
+
+    # raises if index doesn't match COMMENTS table
+    db.cursor().execute("INSERT INTO COMMENTS_FTS(COMMENTS_FTS) VALUES('integrity-check')")
+
+    db.rebuild_search_index()
+    rows, cursor = db.search_comments('pie')
+    self.assertEqual([r['ID'] for r in rows], [c4])
+
+  def test_quoted_comment(self):
+    text = "it's a \"quoted\" comment; DROP TABLE COMMENTS; --"
+    comment_id = db.create_comment('Post', "id'1", 'u1', text)
+
+    row = db.get_comment(comment_id)
+    self.assertEqual(row['COMMENT'], text)
+    self.assertEqual(row['PARENT_ID'], None)
+
+    db.update_comment(comment_id, 'u1', text + "'")
+    self.assertEqual(db.get_comment(comment_id)['COMMENT'], text + "'")
+
+    rows, cursor = db.get_comments('Post', "id'1")
+    self.assertEqual([r['ID'] for r in rows], [comment_id])
+
   def test_get_report_data(self):
     db.clear_comments()
     db.clear('REPORTS')
@@ -220,6 +455,1248 @@ class SomeTestCase(unittest.TestCase):
     data = db.get_report_data(r7)
     self.assertEqual([r['id'] for r in data], [c2, c3, c4, c5])
 
+class ConnectionPoolTestCase(unittest.TestCase):
+
+  def test_thread_connections(self):
+    pool = comments.ConnectionPool(TEST_DB, 2)
+    conn = pool.connection()
+    self.assertTrue(pool.connection() is conn)
+
+    other = []
+    t = threading.Thread(target=lambda: other.append(pool.connection()))
+    t.start()
+    t.join()
+    self.assertFalse(other[0] is conn)
+
+    mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+    self.assertEqual(mode, 'wal')
+    pool.close()
+
+  def test_wait_for_connection(self):
+    pool = comments.ConnectionPool(TEST_DB, 1, timeout=0.1)
+    pool.connection()
+
+    errors = []
+    def checkout():
+      try:
+        pool.connection()
+      except comments.CommentAPIError, e:
+        errors.append(e.code)
+
+    t = threading.Thread(target=checkout)
+    t.start()
+    t.join()
+    self.assertEqual(errors, [3])
+
+    stats = pool.stats()
+    self.assertEqual(stats['waits'], 1)
+    self.assertEqual(stats['timeouts'], 1)
+    self.assertTrue(stats['max_wait'] >= 0.1)
+
+    pool.release()
+    t = threading.Thread(target=checkout)
+    t.start()
+    t.join()
+    self.assertEqual(errors, [3])
+    pool.close()
+
+  def test_readonly_connection(self):
+    pool = comments.ConnectionPool(TEST_DB, 1, readonly=True)
+    c = pool.connection().cursor()
+    self.assertRaises(sqlite3.OperationalError, c.execute,
+                      "DELETE FROM COMMENTS")
+    pool.close()
+
+class CacheTestCase(unittest.TestCase):
+
+  def test_lru(self):
+    cache = LRUCache(2, ttl=0.05)
+    cache.set(1, 'a')
+    cache.set(2, 'b')
+    self.assertEqual(cache.get(1), 'a')
+    cache.set(3, 'c')
+    self.assertEqual(cache.get(2), None)
+    self.assertEqual(cache.get(3), 'c')
+
+    token = cache.token()
+    cache.delete(1)
+    cache.set(1, 'stale', token)
+    self.assertEqual(cache.get(1), None)
+
+    time.sleep(0.06)
+    self.assertEqual(cache.get(3), None)
+    self.assertEqual(cache.stats(), dict(hits=2, misses=3, evictions=1, expirations=1,
+                                         entries=0, size=2, bytes=0))
+
+  def test_max_bytes(self):
+    cache = LRUCache(10, max_bytes=10)
+    cache.set(1, 'aaaa')
+    cache.set(2, 'bbbb')
+    self.assertEqual(cache.get(1), 'aaaa')
+    # the least recently used entry is evicted to fit
+    cache.set(3, 'cccc')
+    self.assertEqual((cache.get(2), cache.bytes), (None, 8))
+    cache.set(4, 'x' * 11)
+    self.assertEqual(cache.get(4), None)
+    cache.delete(1)
+    self.assertEqual(cache.stats()['bytes'], 4)
+
+  def test_invalidation(self):
+    db.clear_comments()
+    c1 = db.create_comment('Post', 'id5', 'u1', 'c1')
+    rows, cursor = db.get_comments('Post', 'id5')
+    self.assertEqual([r['COMMENT'] for r in rows], ['c1'])
+    self.assertEqual(db.get_comment(c1)['COMMENT'], 'c1')
+
+    hits = db.cache_stats()['pages']['hits']
+    self.assertTrue(db.get_comments('Post', 'id5')[0] is rows)
+    self.assertEqual(db.cache_stats()['pages']['hits'], hits + 1)
+
+    db.update_comment(c1, 'u1', 'c1 modified')
+    self.assertEqual(db.get_comment(c1)['COMMENT'], 'c1 modified')
+    rows, cursor = db.get_comments('Post', 'id5')
+    self.assertEqual([r['COMMENT'] for r in rows], ['c1 modified'])
+
+    c2 = db.create_comment('Post', 'id5', 'u1', 'c2')
+    c21 = db.create_comment('Post', 'id5', 'u1', 'c21', parent_id=c2)
+    rows, cursor = db.get_comments('Post', 'id5')
+    self.assertEqual([r['ID'] for r in rows], [c1, c2])
+
+    db.delete_comment(c21, 'u1')
+    self.assertEqual(db.get_comment(c21), None)
+    db.delete_comment(c1, 'u1')
+    self.assertEqual(db.get_comment(c1), None)
+    rows, cursor = db.get_comments('Post', 'id5')
+    self.assertEqual([r['ID'] for r in rows], [c2])
+
+
+class HistoryTestCase(unittest.TestCase):
+
+  def setUp(self):
+    db.clear('HISTORY')
+
+  def tearDown(self):
+    config.HISTORY_MODE = 'sync'
+    db.stop_history()
+
+  def history_count(self):
+    c = db.cursor()
+    c.execute('SELECT count(*) FROM HISTORY')
+    return c.fetchone()[0]
+
+  def test_async_log(self):
+    config.HISTORY_MODE = 'async'
+    comment_id = db.create_comment('Post', 'id1', 'u1', 'c1')
+    db.update_comment(comment_id, 'u1', 'c2')
+    db.delete_comment(comment_id, 'u1')
+
+    db.flush_history()
+    c = db.cursor()
+    c.execute('SELECT ACTION, COMMENT FROM HISTORY WHERE COMMENT_ID=? ORDER BY rowid',
+              (comment_id,))
+    self.assertEqual([tuple(r) for r in c.fetchall()],
+                     [('add', 'c1'), ('modified', 'c2'), ('delete', '')])
+
+  def test_async_log_rollback(self):
+    config.HISTORY_MODE = 'async'
+    commit = db.__dict__['commit']
+
+    def fail(cls, shard=None):
+      raise sqlite3.OperationalError('database is locked')
+
+    db.commit = classmethod(fail)
+    try:
+      with self.assertRaises(sqlite3.OperationalError):
+        db.create_comments_bulk([dict(obj_type='Post', obj_id='id2', user_id='u1',
+                                      comment='c1')])
+    finally:
+      db.commit = commit
+
+    comment_id = db.create_comment('Post', 'id2', 'u1', 'c2')
+    db.flush_history()
+    c = db.cursor()
+    c.execute('SELECT COMMENT_ID, COMMENT FROM HISTORY')
+    self.assertEqual([tuple(r) for r in c.fetchall()], [(comment_id, 'c2')])
+
+  def test_batches(self):
+    writer = HistoryWriter(TEST_DB, db.insert_sql('HISTORY')[0],
+                           batch_size=3, flush_interval=0.05)
+    rows = [db.insert_values('HISTORY', db.history_params(i, 'u1', 'add'))
+            for i in range(7)]
+    for values in rows:
+      self.assertTrue(writer.add(values))
+
+    writer.flush()
+    self.assertEqual(self.history_count(), 7)
+
+    writer.add(rows[0])
+    writer.stop()
+    self.assertEqual(self.history_count(), 8)
+
+  def test_backpressure(self):
+    writer = HistoryWriter(TEST_DB, db.insert_sql('HISTORY')[0],
+                           queue_size=1, put_timeout=0.01)
+    # writer thread is not started, so nothing leaves the queue
+    writer.start = lambda: None
+    values = db.insert_values('HISTORY', db.history_params(1, 'u1', 'add'))
+    self.assertTrue(writer.add(values))
+    self.assertFalse(writer.add(values))
+
+
+class HistoryCompactionTestCase(unittest.TestCase):
+  ARCHIVE_DIR = 'testarchive'
+
+  def setUp(self):
+    db.clear('HISTORY')
+    db.drop_history_archives('9999_99')
+
+    self.archive_dir = config.HISTORY_ARCHIVE_DIR
+    config.HISTORY_ARCHIVE_DIR = self.ARCHIVE_DIR
+
+    c = db.cursor()
+    for i, date in enumerate(['2016-01-05 00:00:00', '2016-01-20 00:00:00',
+                              '2016-02-01 00:00:00', '2016-03-01 00:00:00',
+                              '2016-03-02 00:00:00']):
+      params = db.history_params(i, 'u1', 'modified', 'text %d' % i)
+      params['created_date'] = date
+      db.insert('HISTORY', params, cursor=c)
+    db.commit()
+
+  def tearDown(self):
+    config.HISTORY_ARCHIVE_DIR = self.archive_dir
+    shutil.rmtree(self.ARCHIVE_DIR, ignore_errors=True)
+
+  def count(self, table_name):
+    c = db.cursor()
+    c.execute('SELECT count(*) FROM %s' % table_name)
+    return c.fetchone()[0]
+
+  def test_archive_tables(self):
+    self.assertEqual(db.archive_history('2016-03-01 00:00:00', 'table', batch_size=2), 3)
+    self.assertEqual(self.count('HISTORY'), 2)
+    self.assertEqual(self.count('HISTORY_2016_01'), 2)
+    self.assertEqual(self.count('HISTORY_2016_02'), 1)
+    self.assertEqual([m for m, name in db.history_archives()], ['2016_01', '2016_02'])
+
+    self.assertEqual(db.drop_history_archives('2016_02'), ['HISTORY_2016_01'])
+    self.assertEqual([m for m, name in db.history_archives()], ['2016_02'])
+
+  def test_archive_files(self):
+    self.assertEqual(db.archive_history('2016-02-15 00:00:00', 'file'), 3)
+    self.assertEqual(self.count('HISTORY'), 2)
+
+    with open(db.history_file_name('2016_01')) as f:
+      rows = [json.loads(line) for line in f]
+    self.assertEqual([r['COMMENT'] for r in rows], ['text 0', 'text 1'])
+
+  def test_compact_history(self):
+    archived, dropped = db.compact_history(retention_days=0, archive='table',
+                                           archive_months=1)
+    self.assertEqual(archived, 5)
+    self.assertEqual(self.count('HISTORY'), 0)
+    self.assertEqual(sorted(dropped), ['HISTORY_2016_01', 'HISTORY_2016_02',
+                                       'HISTORY_2016_03'])
+
+
+class MigrationsTestCase(unittest.TestCase):
+  LEGACY_DB = 'testlegacy.db'
+
+  def tearDown(self):
+    if os.path.isfile(self.LEGACY_DB):
+      os.remove(self.LEGACY_DB)
+
+  def indexes(self, conn):
+    return set(r[0] for r in conn.execute(
+      "SELECT name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL"))
+
+  def test_migrate(self):
+    scheme.create_scheme(self.LEGACY_DB, migrate=False)
+    conn = sqlite3.connect(self.LEGACY_DB)
+    conn.execute("INSERT INTO COMMENTS VALUES (NULL, '2016-01-01 00:00:00', "
+                 "'2016-01-01 00:00:00', 'Post', 'id1', 'u1', NULL, 'c1')")
+    conn.commit()
+    self.assertTrue('object_index' in self.indexes(conn))
+
+    self.assertEqual(migrations.migrate(self.LEGACY_DB, target=0), [])
+    self.assertEqual(migrations.migrate(self.LEGACY_DB),
+                     [m[0] for m in migrations.MIGRATIONS])
+    self.assertEqual(migrations.migrate(self.LEGACY_DB), [])
+    self.assertEqual(migrations.current_version(conn), migrations.latest_version())
+
+    indexes = self.indexes(conn)
+    self.assertFalse('object_index' in indexes)
+    self.assertTrue('comments_object_date_index' in indexes)
+    self.assertEqual(conn.execute('SELECT count(*) FROM COMMENTS').fetchone()[0], 1)
+    conn.close()
+
+  def test_migrate_all(self):
+    # schema of the shipped database, tables added by migrations are missing
+    scheme.create_scheme(self.LEGACY_DB, migrate=False)
+    conn = sqlite3.connect(self.LEGACY_DB)
+    conn.execute('DROP TABLE OBJECT_VERSIONS')
+    conn.close()
+
+    self.assertEqual(migrations.migrate_all(self.LEGACY_DB, 1),
+                     [(self.LEGACY_DB, [m[0] for m in migrations.MIGRATIONS])])
+    self.assertEqual(migrations.migrate_all(self.LEGACY_DB, 1), [(self.LEGACY_DB, [])])
+    conn = sqlite3.connect(self.LEGACY_DB)
+    self.assertEqual(conn.execute('SELECT count(*) FROM OBJECT_VERSIONS').fetchone()[0], 0)
+    conn.close()
+
+  def query_plan(self, query):
+    sql, params = query
+    c = db.cursor()
+    return ' '.join(r[-1] for r in c.execute('EXPLAIN QUERY PLAN ' + sql, params))
+
+  def assertUsesIndex(self, query, index):
+    plan = self.query_plan(query)
+    self.assertTrue('USING INDEX %s ' % index in plan, plan)
+    self.assertFalse('TEMP B-TREE' in plan, plan)
+
+  def test_query_plans(self):
+    cursor = utils.encode_cursor('2016-01-01 00:00:00', 10)
+
+    self.assertUsesIndex(db.comments_query('Post', 'id1', None, 10, None),
+                         'comments_object_date_index')
+    self.assertUsesIndex(db.comments_query('Post', 'id1', None, 10, cursor),
+                         'comments_object_date_index')
+    self.assertUsesIndex(db.reports_query('admin', 10, cursor),
+                         'reports_owner_date_index')
+    self.assertUsesIndex(db.reports_query(None, 10, cursor),
+                         'reports_date_index')
+
+    report = dict(user_id='u1', obj_type='Post', obj_id='id1',
+                  start_date='2016-01-01 00:00:00', end_date='2016-02-01 00:00:00')
+    self.assertUsesIndex(db.report_data_query(report), 'comments_user_date_index')
+    report = dict(user_id='u1', obj_type='', obj_id='', start_date='', end_date='')
+    self.assertUsesIndex(db.report_data_query(report), 'comments_user_date_index')
+
+
+class ShardingTestCase(unittest.TestCase):
+  SHARDED_DB = 'testsharded.db'
+
+  def setUp(self):
+    self.tearDown()
+    scheme.create_scheme(self.SHARDED_DB, shards=3)
+    db.connect(self.SHARDED_DB, shards=3)
+
+  def tearDown(self):
+    db.connect(TEST_DB, shards=1)
+    for name in glob.glob('testsharded*.db'):
+      os.remove(name)
+
+  def test_shards(self):
+    objects = [('Post', 'id%d' % i) for i in range(6)]
+    ids = {}
+    for obj in objects:
+      parent = db.create_comment(obj[0], obj[1], 'u1', 'first of %s' % obj[1],
+                                 created=datetime(2016, 1, 1))
+      child = db.create_comment(obj[0], obj[1], 'u2', 'reply', parent_id=parent,
+                                created=datetime(2016, 1, 2))
+      ids[obj] = (parent, child)
+      self.assertEqual(db.get_parents(child), [parent])
+
+    self.assertEqual(len(set(db.object_shard(*obj) for obj in objects)), 3)
+    all_ids = [id for pair in ids.values() for id in pair]
+    self.assertEqual(len(set(all_ids)), len(all_ids))
+
+    parent, child = ids[('Post', 'id4')]
+    shard = db.object_shard('Post', 'id4')
+    self.assertEqual(db.comment_shard(child), shard)
+    self.assertEqual(sharding.id_range(child), shard)
+    self.assertEqual(db.get_comment(child)['COMMENT'], 'reply')
+    self.assertEqual([r['ID'] for r in db.get_comments('Post', 'id4')[0]], [parent])
+
+    report_id = db.create_report('admin', 'u1')
+    rows = db.get_report_data(report_id)
+    self.assertEqual(sorted(r['ID'] for r in rows),
+                     sorted(pair[0] for pair in ids.values()))
+    self.assertEqual(len(db.search_comments('first')[0]), 6)
+
+    db.update_comment(child, 'u2', 'edited')
+    self.assertEqual(db.search_comments('edited')[0][0]['ID'], child)
+    self.assertEqual(db.delete_subtree(parent, 'u1'), 2)
+    self.assertEqual(db.get_comment(parent), None)
+
+    targets = db.reshard(2)
+    self.assertEqual(db.shards, 2)
+    self.assertEqual(db.get_comment(child), None)
+    parent, child = ids[('Post', 'id1')]
+    self.assertEqual(db.get_comments_tree(parent)[0]['ID'], child)
+    self.assertEqual(len(db.get_report_data(report_id)), 5)
+
+    new_id = db.create_comment('Post', 'id1', 'u1', 'after reshard')
+    shard = db.object_shard('Post', 'id1')
+    self.assertEqual(db.comment_shard(new_id), shard)
+    self.assertTrue(new_id > shard * sharding.ID_RANGE)
+    self.assertFalse(new_id in all_ids)
+
+    db.reshard(1)
+    self.assertEqual(db.get_comment(new_id)['COMMENT'], 'after reshard')
+    self.assertEqual(len(db.search_comments('first')[0]), 5)
+
+class ReportExportTestCase(unittest.TestCase):
+  EXPORT_DB = 'testexport.db'
+  ROWS = 1000000
+
+  # export in a fresh process, prints rows count and max RSS growth (KB)
+  script = """
+import resource
+import config
+config.DB_NAME = %r
+config.REPORTS_DIR = %r
+import tasks
+tasks.dbm.connect(config.DB_NAME)
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+file_name = tasks.create_report(%d)
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print file_name, after - before
+"""
+
+  def setUp(self):
+    self.settings = (config.DB_NAME, config.REPORTS_DIR, config.REPORT_SLICE_DAYS,
+                     config.HISTORY_MODE)
+    self.tearDown()
+    os.mkdir(TEMP_DIR)
+    scheme.create_scheme(self.EXPORT_DB)
+    conn = sqlite3.connect(self.EXPORT_DB)
+    conn.execute("INSERT INTO REPORTS (CREATED_DATE, UPDATED_DATE, OWNER, USER_ID, STATUS, FILE_TYPE) "
+                 "VALUES ('2016-01-01', '2016-01-01', 'admin', 'u1', 'working', 'csv')")
+    self.report_id = conn.execute('SELECT max(ID) FROM REPORTS').fetchone()[0]
+    conn.commit()
+    conn.close()
+
+  def tearDown(self):
+    (config.DB_NAME, config.REPORTS_DIR, config.REPORT_SLICE_DAYS,
+     config.HISTORY_MODE) = self.settings
+    db.connect(TEST_DB)
+    shutil.rmtree(TEMP_DIR, ignore_errors=True)
+    for name in glob.glob(self.EXPORT_DB + '*'):
+      os.remove(name)
+
+  def fill(self, rows, step):
+    """ Add rows comments of u1 created every `step` seconds."""
+    conn = sqlite3.connect(self.EXPORT_DB)
+    conn.execute('''WITH RECURSIVE N(I) AS (SELECT 1 UNION ALL SELECT I + 1 FROM N WHERE I < ?)
+      INSERT INTO COMMENTS (CREATED_DATE, UPDATED_DATE, OBJ_TYPE, OBJ_ID, USER_ID, COMMENT)
+      SELECT datetime('2016-01-01', '+' || (I * ?) || ' seconds'), '2016-01-01',
+             'Post', 'id' || (I % 100), 'u1', 'comment text ' || I FROM N''', (rows, step))
+    conn.commit()
+    conn.close()
+
+  def test_bounded_memory(self):
+    self.fill(self.ROWS, 1)
+    script = self.script % (self.EXPORT_DB, TEMP_DIR, self.report_id)
+    output = subprocess.check_output([sys.executable, '-c', script])
+    file_name, growth = output.split()
+
+    # whole report would take hundreds of MB as a list of rows
+    self.assertTrue(int(growth) < 30 * 1024, growth)
+    with open(file_name, 'rb') as f:
+      self.assertEqual(f.readline().strip(), ','.join(
+        '"%s"' % item[0] for item in scheme.comments_meta))
+      self.assertEqual(f.readline().split(',')[-1].strip(), '"comment text 1"')
+      self.assertEqual(sum(1 for line in f), self.ROWS - 1)
+
+    conn = sqlite3.connect(self.EXPORT_DB)
+    self.assertEqual(conn.execute('SELECT STATUS FROM REPORTS').fetchone()[0], 'completed')
+    conn.close()
+
+  def test_slices(self):
+    # a comment every 6 hours during 100 days
+    self.fill(400, 6 * 3600)
+    config.DB_NAME = self.EXPORT_DB
+    config.REPORTS_DIR = TEMP_DIR
+    db.connect(self.EXPORT_DB)
+
+    first, last = tasks.dbm.get_report_dates(self.report_id)
+    self.assertEqual((first, last), ('2016-01-01 06:00:00', '2016-04-10 00:00:00'))
+    slices = reports.date_slices(first, last, 30)
+    self.assertEqual(slices, [(None, '2016-01-31 06:00:00'),
+                              ('2016-01-31 06:00:00', '2016-03-01 06:00:00'),
+                              ('2016-03-01 06:00:00', '2016-03-31 06:00:00'),
+                              ('2016-03-31 06:00:00', None)])
+    self.assertEqual(reports.date_slices(first, first, 30), [(None, None)])
+
+    config.REPORT_SLICE_DAYS = 1000
+    with open(tasks.create_report(self.report_id), 'rb') as f:
+      expected = f.read()
+
+    config.REPORT_SLICE_DAYS = 7
+    file_name = tasks.create_report(self.report_id)
+    with open(file_name, 'rb') as f:
+      self.assertEqual(f.read(), expected)
+    self.assertEqual(expected.count('\n'), 401)
+    self.assertEqual(os.listdir(TEMP_DIR), [os.path.basename(file_name)])
+
+  def test_file_types(self):
+    self.fill(400, 6 * 3600)
+    config.DB_NAME = self.EXPORT_DB
+    config.REPORTS_DIR = TEMP_DIR
+    config.REPORT_SLICE_DAYS = 7
+    db.connect(self.EXPORT_DB)
+
+    with open(tasks.create_report(self.report_id), 'rb') as f:
+      expected = f.read()
+
+    gz_id = db.create_report('admin', 'u1', file_type='csv.gz')
+    file_name = tasks.create_report(gz_id)
+    self.assertEqual(db.get_report(gz_id)['FILE_NAME'], file_name)
+    self.assertTrue(file_name.endswith('.csv.gz'))
+    self.assertEqual(gzip.open(file_name).read(), expected)
+
+    json_id = db.create_report('admin', 'u1', file_type='ndjson.gz')
+    with gzip.open(tasks.create_report(json_id)) as f:
+      rows = [json.loads(line) for line in f]
+    self.assertEqual(len(rows), 400)
+    self.assertEqual((rows[0]['ID'], rows[0]['COMMENT'], rows[0]['PARENT_ID']),
+                     (1, 'comment text 1', None))
+
+    # appended rows are a new gzip member
+    db.create_comment('Post', 'id1', 'u1', u'\u043d\u043e\u0432\u044b\u0439',
+                      created=datetime(2016, 5, 1))
+    tasks.create_report(json_id, incremental=True)
+    with gzip.open(db.get_report(json_id)['FILE_NAME']) as f:
+      rows = [json.loads(line) for line in f]
+    self.assertEqual(rows[-1]['COMMENT'], u'\u043d\u043e\u0432\u044b\u0439')
+    self.assertEqual(db.get_report(json_id)['EXPORTED_ROWS'], 401)
+
+  def test_cancel(self):
+    self.fill(10, 3600)
+    config.DB_NAME = self.EXPORT_DB
+    config.REPORTS_DIR = TEMP_DIR
+    db.connect(self.EXPORT_DB)
+
+    updates = []
+    def update(rows):
+      updates.append(rows)
+      return len(updates) < 3
+
+    rows = reports.track_progress(db.iter_report_data(self.report_id), update, 1e-9)
+    self.assertRaises(reports.ReportCancelled, reports.write_report,
+                      rows, os.path.join(TEMP_DIR, 'part'))
+    self.assertEqual(updates, [1, 1, 1])
+
+    # cancelled while waiting for export
+    self.assertTrue(db.cancel_report(self.report_id))
+    self.assertEqual(tasks.create_report(self.report_id), None)
+
+    db.update_report_status(self.report_id, 'working')
+    self.assertTrue(tasks.create_report(self.report_id))
+    report = db.get_report(self.report_id)
+    self.assertEqual((report['STATUS'], report['PROGRESS_ROWS'], report['TOTAL_ROWS']),
+                     ('completed', 10, 10))
+
+  def test_shared_report(self):
+    self.fill(10, 3600)
+    config.DB_NAME = self.EXPORT_DB
+    config.REPORTS_DIR = TEMP_DIR
+    db.connect(self.EXPORT_DB)
+
+    # cancelled source is exported while reports sharing its file work
+    source = db.create_report('admin', 'u1')
+    shared = db.create_report('other', 'u1')
+    self.assertEqual(db.get_report(shared)['SOURCE_ID'], source)
+    self.assertTrue(db.cancel_report(source))
+    self.assertEqual([r['ID'] for r in db.get_working_reports()], [self.report_id, source])
+    file_name = tasks.create_report(source)
+    self.assertTrue(file_name)
+    self.assertEqual(db.get_report(source)['STATUS'], 'cancelled')
+    report = db.get_report(shared)
+    self.assertEqual((report['SOURCE_ID'], report['STATUS'], report['FILE_NAME']),
+                     (None, 'completed', file_name))
+    with open(file_name, 'rb') as f:
+      content = f.read()
+
+    # cancelled restart of the source does not touch file of the other report
+    progress = tasks.progress
+    def cancelled(report_id):
+      db.cancel_report(report_id)
+      return progress(report_id)
+    db.update_report_status(source, 'working')
+    tasks.progress = cancelled
+    try:
+      self.assertEqual(tasks.create_report(source, incremental=True), None)
+    finally:
+      tasks.progress = progress
+    self.assertEqual(db.get_report(source)['STATUS'], 'cancelled')
+    report = db.get_report(shared)
+    self.assertEqual((report['STATUS'], report['FILE_NAME']), ('completed', file_name))
+    with open(file_name, 'rb') as f:
+      self.assertEqual(f.read(), content)
+
+    # completed restart writes a new file
+    db.update_report_status(source, 'working')
+    new_name = tasks.create_report(source, incremental=True)
+    self.assertNotEqual(new_name, file_name)
+    self.assertEqual(db.get_report(shared)['FILE_NAME'], file_name)
+    self.assertTrue(os.path.isfile(file_name))
+
+    # failed source fails reports sharing its file
+    db.create_comment('Post', 'id1', 'u1', 'new one', created=datetime(2016, 1, 1))
+    source = db.create_report('admin', 'u1')
+    shared = db.create_report('other', 'u1')
+    config.REPORTS_DIR = os.path.join(TEMP_DIR, 'missing')
+    self.assertRaises(IOError, tasks.create_report, source)
+    self.assertEqual([db.get_report(id)['STATUS'] for id in (source, shared)],
+                     ['failed', 'failed'])
+    self.assertTrue(db.get_report(shared)['DESCRIPTION'])
+
+  def test_restart(self):
+    self.fill(10, 3600)
+    conn = sqlite3.connect(self.EXPORT_DB)
+    conn.execute("INSERT INTO COMMENTS_FTS(COMMENTS_FTS) VALUES('rebuild')")
+    conn.commit()
+    conn.close()
+    config.DB_NAME = self.EXPORT_DB
+    config.REPORTS_DIR = TEMP_DIR
+    db.connect(self.EXPORT_DB)
+    db.clear('HISTORY')
+
+    file_name = tasks.create_report(self.report_id)
+    self.assertEqual(db.get_report(self.report_id)['EXPORTED_ROWS'], 10)
+    comment_id = db.create_comment('Post', 'id1', 'u1', 'new one', created=datetime(2016, 2, 1))
+    self.assertFalse(db.report_changed(self.report_id))
+    # rows of HISTORY writers of other processes may be queued
+    config.HISTORY_MODE = 'async'
+    self.assertTrue(db.report_changed(self.report_id))
+    config.HISTORY_MODE = 'sync'
+
+    tasks.create_report(self.report_id, incremental=True)
+    report = db.get_report(self.report_id)
+    self.assertEqual((report['LAST_ID'], report['EXPORTED_ROWS']), (comment_id, 11))
+    with open(file_name, 'rb') as f:
+      appended = f.read()
+    self.assertTrue(appended.endswith('"new one"\r\n'))
+
+    tasks.create_report(self.report_id)
+    with open(file_name, 'rb') as f:
+      self.assertEqual(f.read(), appended)
+
+    # edited comment is rewritten by full rebuild
+    db.update_comment(comment_id - 5, 'u1', 'edited')
+    tasks.create_report(self.report_id, incremental=True)
+    with open(file_name, 'rb') as f:
+      content = f.read()
+    self.assertEqual(content.count('\n'), 12)
+    self.assertTrue('"edited"' in content)
+
+  def test_recover(self):
+    self.fill(10, 3600)
+    config.DB_NAME = self.EXPORT_DB
+    config.REPORTS_DIR = TEMP_DIR
+    db.connect(self.EXPORT_DB)
+    shared = db.create_report('admin', 'u1')
+    db.update_report_status(shared, 'completed')
+    pool = db.pool
+
+    executor = executors.LocalExecutor(workers=2)
+    self.assertEqual(tasks.recover_reports(executor), [self.report_id])
+    executor.join()
+    self.assertEqual(executor.stats()['completed'], 1)
+    report = db.get_report(self.report_id)
+    self.assertEqual((report['STATUS'], report['EXPORTED_ROWS']), ('completed', 10))
+    # task threads use pools of the application
+    self.assertTrue(db.pool is pool)
+    self.assertEqual(db.get_working_reports(), [])
+
+
+class ExecutorTestCase(unittest.TestCase):
+
+  def test_celery_priority(self):
+    class Task(object):
+      sent = []
+      def apply_async(self, args, kwargs, priority):
+        self.sent.append(priority)
+
+    executor = executors.CeleryExecutor()
+    for priority in (executors.PRIORITY_LOW, executors.PRIORITY_NORMAL,
+                     executors.PRIORITY_HIGH, 5):
+      executor.submit(Task(), (1,), priority=priority)
+    # lower priority of the broker runs first
+    self.assertEqual(Task.sent, [6, 3, 0, 0])
+
+  def test_priority(self):
+    done = []
+    executor = executors.LocalExecutor(workers=1, queue_size=3)
+    # the worker is busy until event is set
+    event = threading.Event()
+    executor.submit(event.wait)
+    time.sleep(0.1)
+    executor.submit(done.append, ('low',), priority=executors.PRIORITY_LOW)
+    executor.submit(done.append, ('normal',))
+    executor.submit(done.append, ('high',), priority=executors.PRIORITY_HIGH)
+    self.assertRaises(executors.QueueFull, executor.submit, done.append, ('more',))
+
+    event.set()
+    executor.join()
+    self.assertEqual(done, ['high', 'normal', 'low'])
+    stats = executor.stats()
+    self.assertEqual((stats['completed'], stats['rejected'], stats['waiting']), (4, 1, 0))
+
+  def test_owner_limit(self):
+    lock = threading.Lock()
+    running = {}
+    top = {}
+    def work(owner):
+      with lock:
+        running[owner] = running.get(owner, 0) + 1
+        top[owner] = max(top.get(owner, 0), running[owner])
+      time.sleep(0.02)
+      with lock:
+        running[owner] -= 1
+      if owner == 'b':
+        raise ValueError(owner)
+
+    executor = executors.LocalExecutor(workers=4, owner_limit=1)
+    for i in range(4):
+      for owner in ('a', 'b'):
+        executor.submit(work, (owner,), owner=owner)
+    executor.join()
+    self.assertEqual(top, {'a': 1, 'b': 1})
+    stats = executor.stats()
+    self.assertEqual((stats['completed'], stats['failed']), (4, 4))
+
+
+class HandlersTestCase(unittest.TestCase):
+  """ Handlers of main.application called with webapp2.Request.blank."""
+
+  STATIC_DIR = os.path.join(config.STATIC_ROOT_URL, TEMP_DIR)
+
+  def setUp(self):
+    db.clear_comments()
+    db.clear('REPORTS')
+    # object versions start again after clear
+    main.CommentsHandler.fragment_cache.clear()
+    self.reports_dir = config.REPORTS_DIR
+
+  def tearDown(self):
+    config.REPORTS_DIR = self.reports_dir
+    shutil.rmtree(self.STATIC_DIR, ignore_errors=True)
+    base_handler._stat_cache.clear()
+
+  def request(self, url, method='GET', headers=None, **post):
+    # webapp2.Response made of the result would set Cache-Control: no-cache
+    request = webob.Request.blank(url, headers=headers or {}, POST=post or None)
+    request.method = method
+    return request.get_response(main.application)
+
+  def static_file(self, name, data):
+    """ Write file to STATIC_DIR, return its url."""
+    path = os.path.join(self.STATIC_DIR, name)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+      f.write(data)
+    return '/' + path.replace(os.sep, '/')
+
+  def test_static_file(self):
+    data = ''.join(chr(i % 256) for i in range(1000))
+    url = self.static_file('file.bin', data)
+    response = self.request(url)
+    self.assertEqual((response.status_int, response.body), (200, data))
+    self.assertEqual(response.content_length, 1000)
+    self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+    self.assertEqual(response.headers['Cache-Control'],
+                     'public, max-age=%d' % config.STATIC_MAX_AGE)
+    mtime = int(os.stat(url[1:]).st_mtime)
+    self.assertEqual(response.etag, '%x-%x' % (mtime, 1000))
+    etag, modified = response.headers['ETag'], response.headers['Last-Modified']
+
+    for headers in ({'If-None-Match': etag}, {'If-Modified-Since': modified}):
+      response = self.request(url, headers=headers)
+      self.assertEqual((response.status_int, response.body), (304, ''))
+    response = self.request(url, headers={'If-None-Match': '"other"',
+                                          'If-Modified-Since': modified})
+    self.assertEqual(response.status_int, 200)
+
+    response = self.request(url, headers={'Range': 'bytes=10-19'})
+    self.assertEqual((response.status_int, response.body), (206, data[10:20]))
+    self.assertEqual(response.headers['Content-Range'], 'bytes 10-19/1000')
+    self.assertEqual(response.content_length, 10)
+    response = self.request(url, headers={'Range': 'bytes=2000-'})
+    self.assertEqual(response.status_int, 416)
+    self.assertEqual(response.headers['Content-Range'], 'bytes */1000')
+
+    # resumed download of the same version only
+    response = self.request(url, headers={'Range': 'bytes=990-', 'If-Range': etag})
+    self.assertEqual((response.status_int, response.body), (206, data[990:]))
+    response = self.request(url, headers={'Range': 'bytes=990-', 'If-Range': '"old"'})
+    self.assertEqual((response.status_int, response.body), (200, data))
+
+    # HEAD does not leave the file open
+    fds = len(os.listdir('/proc/self/fd'))
+    for headers in ({}, {'Range': 'bytes=0-99'}):
+      request = webapp2.Request.blank(url, headers=headers)
+      request.method = 'HEAD'
+      status, headers, app_iter = request.call_application(main.application)
+      self.assertEqual(dict(headers)['Content-Length'],
+                       '100' if 'Range' in request.headers else '1000')
+      self.assertEqual(list(app_iter), [])
+    self.assertEqual(len(os.listdir('/proc/self/fd')), fds)
+
+    request = webapp2.Request.blank(url, environ={'wsgi.file_wrapper': FileWrapper})
+    status, headers, app_iter = request.call_application(main.application)
+    self.assertTrue(isinstance(app_iter, FileWrapper))
+    self.assertEqual(''.join(app_iter), data)
+    app_iter.close()
+
+    # replaced file is described by its opened copy, not by cached stat
+    self.static_file('file.bin', data[:500])
+    response = self.request(url)
+    self.assertEqual((response.content_length, response.body), (500, data[:500]))
+    self.assertTrue(response.etag.endswith('-1f4'), response.etag)
+
+  def test_static_gzip(self):
+    def compress(data):
+      buf = StringIO()
+      with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+      return buf.getvalue()
+
+    script = 'var x = 1;\n' * 100
+    url = self.static_file('app.js.gz', compress(script))[:-3]
+    response = self.request(url, headers={'Accept-Encoding': 'gzip, deflate'})
+    self.assertEqual(response.status_int, 200)
+    self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+    self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+    self.assertEqual(gzip.GzipFile(fileobj=StringIO(response.body)).read(), script)
+    etag = response.etag
+
+    # decompressed on the fly, the other variant has other ETag
+    response = self.request(url)
+    self.assertEqual(response.status_int, 200)
+    self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+    self.assertFalse('Content-Encoding' in response.headers)
+    self.assertEqual(response.body, script)
+    self.assertNotEqual(response.etag, etag)
+
+    # report of several gzip members is never sent with Content-Encoding
+    config.REPORTS_DIR = os.path.join(self.STATIC_DIR, 'reports')
+    data = compress('"ID"\r\n"1"\r\n') + compress('"2"\r\n')
+    url = self.static_file('reports/report_1.csv.gz', data)
+    for headers in ({'Accept-Encoding': 'gzip'}, {}):
+      response = self.request(url[:-3], headers=headers)
+      self.assertEqual(response.status_int, 200)
+      self.assertFalse('Content-Encoding' in response.headers)
+      self.assertFalse('Vary' in response.headers)
+      self.assertEqual(response.body, '"ID"\r\n"1"\r\n"2"\r\n')
+
+      # download of compressed file
+      response = self.request(url, headers=headers)
+      self.assertEqual(response.content_type, 'application/gzip')
+      self.assertFalse('Content-Encoding' in response.headers)
+      self.assertEqual(response.body, data)
+
+  def test_bad_cursor(self):
+    db.create_comment('Post', 'id1', 'uid1', 'comment')
+    self.assertEqual(utils.decode_cursor(utils.encode_cursor('2016-01-01', 5)),
+                     ['2016-01-01', 5])
+    for cursor in ('NQ==', utils.encode_cursor(5, 5), utils.encode_cursor('a', 5, 5),
+                   utils.encode_cursor('a', True), 'bad'):
+      self.assertRaises(ValueError, utils.decode_cursor, cursor)
+
+    # NQ== is 5 in json
+    for url, status in [('/?obj_type=Post&obj_id=id1&cursor=NQ==', 200),
+                        ('/comment/reports?viewer_id=admin&cursor=NQ==', 400),
+                        ('/comment/search?q=comment&cursor=NQ==', 406),
+                        ('/api/comments?obj_type=Post&obj_id=id1&cursor=NQ==', 406),
+                        ('/api/comments/1/tree?cursor=NQ==', 406)]:
+      self.assertEqual(self.request(url).status_int, status, url)
+
+  def test_bad_comment_id(self):
+    comment_id = db.create_comment('Post', 'id1', 'uid1', 'comment')
+    for comment_id_param in ('abc', ''):
+      for cascade in ('', '1'):
+        response = self.request('/comment/delete?viewer_id=uid1', 'POST',
+                                comment_id=comment_id_param, cascade=cascade)
+        self.assertEqual((response.status_int, json.loads(response.body)['code']),
+                         (406, 100))
+
+    response = self.request('/comment/edit?viewer_id=uid1', 'POST',
+                            comment_id='abc', comment='text')
+    self.assertEqual(response.status_int, 200)
+    self.assertTrue('(103). Comment abc.' in response.body, response.body)
+    self.assertEqual(self.request('/comment/tree?comment_id=abc').status_int, 404)
+    self.assertEqual(self.request('/comment/tree/more?tree=abc').status_int, 404)
+    self.assertEqual(db.get_comment(comment_id, cached=False)['COMMENT'], 'comment')
+
+  def test_stream_response(self):
+    root = db.create_comment('Post', 'id1', 'uid1', 'root')
+    for i in range(50):
+      db.create_comment('Post', 'id1', 'uid1', 'child %d' % i, parent_id=root)
+
+    url = '/comment/tree?comment_id=%d&limit=100&viewer_id=uid1' % root
+    chunk_size = config.STREAM_CHUNK_SIZE
+    config.STREAM_CHUNK_SIZE = 1024
+    try:
+      status, headers, app_iter = webapp2.Request.blank(url).call_application(main.application)
+      # rows are read while the page is sent, after the handler returned
+      self.assertEqual(getattr(db.read_pool._local, 'connection', None), None)
+      chunks = list(app_iter)
+      self.assertEqual(getattr(db.read_pool._local, 'connection', None), None)
+
+      # client disconnects in the middle of the page
+      status, headers, app_iter = webapp2.Request.blank(url).call_application(main.application)
+      next(app_iter)
+      next(app_iter)
+      self.assertTrue(db.read_pool._local.connection is not None)
+      app_iter.close()
+      self.assertEqual(db.read_pool._local.connection, None)
+    finally:
+      config.STREAM_CHUNK_SIZE = chunk_size
+
+    self.assertTrue(len(chunks) > 10)
+    # template parts are joined up to the chunk size
+    for chunk in chunks[:-1]:
+      self.assertTrue(1024 <= len(chunk) < 2048, len(chunk))
+    page = ''.join(chunks)
+    self.assertTrue('child 0' in page and 'child 49' in page)
+
+  def test_feed(self):
+    ids = [db.create_comment('Post', 'id1', 'uid1', 'comment %d' % i,
+                             created=datetime(2016, 1, 1 + i))
+           for i in range(5)]
+    db.create_comment('Post', 'id1', 'uid1', 'reply', parent_id=ids[0])
+    db.create_comment('Post', 'id2', 'uid2', 'other')
+
+    response = self.request('/comment/feed?obj_type=Post&obj_id=id1&obj_type=Post&obj_id=id2'
+                            '&obj_type=Post&obj_id=id3&limit=2')
+    self.assertEqual(response.content_type, 'application/json')
+    feed = json.loads(response.body)['objects']
+    self.assertEqual([(f['obj_id'], f['total'], len(f['comments'])) for f in feed],
+                     [('id1', 5, 2), ('id2', 1, 1), ('id3', 0, 0)])
+    self.assertEqual([c['ID'] for c in feed[0]['comments']], ids[:2])
+    self.assertFalse('TOTAL' in feed[0]['comments'][0])
+    self.assertEqual((feed[1]['next_cursor'], feed[2]['next_cursor']), (None, None))
+
+    # the rest of top level comments by the feed cursor
+    response = self.request('/api/comments?obj_type=Post&obj_id=id1&cursor=%s' %
+                            feed[0]['next_cursor'])
+    self.assertEqual([c['ID'] for c in json.loads(response.body)['comments']], ids[2:])
+
+    for url, code in [('/comment/feed', 101),
+                      ('/comment/feed?obj_type=Post&obj_id=id1&obj_type=Post', 100),
+                      ('/comment/feed?' + '&'.join(['obj_type=Post&obj_id=id1'] *
+                                                   (config.FEED_MAX_OBJECTS + 1)), 100)]:
+      self.assertEqual(json.loads(self.request(url).body)['code'], code)
+
+  def test_comments_table(self):
+    db.create_comment('Post', 'id1', 'uid1', 'first one')
+    db.get_comments('Post', 'id1', limit=main.COMMENTS_PAGE_SIZE)
+    page = db.page_cache.get(('Post', 'id1'))
+    db.create_comment('Post', 'id1', 'uid1', 'second one')
+    # page cached by other process before the change
+    db.page_cache.set(('Post', 'id1'), page)
+
+    response = self.request('/?obj_type=Post&obj_id=id1&viewer_id=uid2')
+    self.assertEqual(response.status_int, 200)
+    self.assertTrue('first one' in response.body and 'second one' in response.body)
+    self.assertFalse(str(main.VIEWER_PLACEHOLDER) in response.body)
+
+  def test_restart_report(self):
+    report_id = db.create_report('admin', 'u1')
+    url = '/comment/reports?viewer_id=admin'
+    response = self.request(url, 'POST', report_id=str(report_id), action='restart')
+    self.assertEqual(json.loads(response.body)['code'], 100)
+
+    # busy queue keeps completed report
+    db.update_report(report_id, 'report.csv')
+    submit = executors.submit
+    def queue_full(*args, **kwargs):
+      raise executors.QueueFull()
+    executors.submit = queue_full
+    try:
+      response = self.request(url, 'POST', report_id=str(report_id), action='restart')
+    finally:
+      executors.submit = submit
+    self.assertEqual(json.loads(response.body)['code'], 106)
+    report = db.get_report(report_id)
+    self.assertEqual((report['STATUS'], report['FILE_NAME']), ('completed', 'report.csv'))
+
+    for report_id, code in (('abc', 100), ('999', 103)):
+      response = self.request(url, 'POST', report_id=report_id, action='restart')
+      self.assertEqual(json.loads(response.body)['code'], code)
+
+  def test_api_cache(self):
+    comment_id = db.create_comment('Post', 'id1', 'uid1', 'first')
+    db.get_comments('Post', 'id1', limit=main.COMMENTS_PAGE_SIZE)
+    db.get_comment(comment_id)
+    page, comment = db.page_cache.get(('Post', 'id1')), db.comment_cache.get(comment_id)
+    db.update_comment(comment_id, 'uid1', 'edited')
+    # rows cached by other process before the change
+    db.page_cache.set(('Post', 'id1'), page)
+    db.comment_cache.set(comment_id, comment)
+
+    for url in ('/api/comments?obj_type=Post&obj_id=id1', '/api/comments/%d' % comment_id,
+                '/api/comments/%d/tree' % comment_id):
+      response = self.request(url)
+      self.assertTrue('edited' in response.body and not 'first' in response.body, url)
+
+  def test_api_etag(self):
+    root = db.create_comment('Post', 'id1', 'uid1', 'root')
+    child = db.create_comment('Post', 'id1', 'uid1', 'child', parent_id=root)
+    other = db.create_comment('Post', 'id1', 'uid1', 'other')
+
+    for url in ('/api/comments/%d' % root, '/api/comments/%d/tree' % root):
+      response = self.request(url)
+      self.assertEqual(response.status_int, 200)
+      self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+      self.assertEqual(response.etag, str(json.loads(response.body)['version']))
+      self.assertTrue(response.last_modified)
+      etag = response.headers['ETag']
+
+      response = self.request(url, headers={'If-None-Match': etag})
+      self.assertEqual((response.status_int, response.body), (304, ''))
+      self.assertEqual(response.headers['ETag'], etag)
+      response = self.request(url, headers={
+        'If-Modified-Since': response.headers['Last-Modified']})
+      self.assertEqual(response.status_int, 304)
+
+      # new version after change of the subtree
+      db.update_comment(child, 'uid1', 'edited')
+      response = self.request(url, headers={'If-None-Match': etag})
+      self.assertEqual(response.status_int, 200)
+      self.assertNotEqual(response.headers['ETag'], etag)
+
+    # missing comment is not "not modified" with version 0
+    for url in ('/api/comments/999', '/api/comments/999/tree'):
+      response = self.request(url, headers={'If-None-Match': '"0"'})
+      self.assertEqual(response.status_int, 406)
+      self.assertEqual(json.loads(response.body)['code'], 103)
+
+    # cursor of comment out of the subtree
+    url = '/api/comments/%d/tree?cursor=%s'
+    response = self.request(url % (root, utils.encode_cursor(other, 0)))
+    self.assertEqual(json.loads(response.body)['code'], 100)
+    response = self.request(url % (root, utils.encode_cursor(child, 0)))
+    self.assertEqual(json.loads(response.body)['comment']['ID'], child)
+
+
+class BackendTests(object):
+  """ Checks of StorageBackend contract, run for every backend."""
+  storage = None
+
+  def setUp(self):
+    self.storage.clear_comments()
+    self.storage.clear('REPORTS')
+
+  def test_comments(self):
+    st = self.storage
+    ids = [st.create_comment('Post', 'id1', 'u%d' % (i % 2), 'comment %d' % i,
+                             created=datetime(2016, 1, 1 + i))
+           for i in range(3)]
+    child = st.create_comment('Post', 'id1', 'u1', 'red reply', parent_id=ids[0])
+    grandchild = st.create_comment('Post', 'id1', 'u1', 'red red', parent_id=child)
+
+    self.assertEqual(st.get_comment(child)['COMMENT'], 'red reply')
+    self.assertEqual(st.get_comment('bad'), None)
+    self.assertEqual(st.get_parents(grandchild), [ids[0], child])
+
+    rows, cursor = st.get_comments('Post', 'id1', limit=2)
+    self.assertEqual([r['ID'] for r in rows], ids[:2])
+    rows, cursor = st.get_comments('Post', 'id1', limit=2, cursor=cursor)
+    self.assertEqual(([r['ID'] for r in rows], cursor), ([ids[2]], None))
+    rows, cursor = st.get_comments('Post', 'id1', user_id='u1')
+    self.assertEqual([r['ID'] for r in rows], [ids[1]])
+    self.assertEqual(st.get_comments_multi([('Post', 'id1')], 1)[('Post', 'id1')][2], 3)
+
+    rows, cursors = st.get_subtree(ids[0], max_depth=1)
+    self.assertEqual([(r['ID'], r['DEPTH'], r['CHILDREN']) for r in rows], [(child, 1, 1)])
+    self.assertEqual([r['ID'] for r in st.get_comments_tree(ids[0])], [child, grandchild])
+    # rows are read while events are consumed
+    self.assertTrue(isinstance(st.iter_subtree(ids[0]), types.GeneratorType))
+
+    rows, cursor = st.search_comments('red')
+    self.assertEqual([r['ID'] for r in rows], [grandchild, child])
+
+    st.update_comment(ids[1], 'u1', 'blue')
+    self.assertEqual(st.search_comments('blue')[0][0]['ID'], ids[1])
+    self.assertEqual(st.search_comments('comment', obj_type='Post', obj_id='id1')[0][0]['ID'],
+                     ids[0])
+
+    self.assertRaises(comments.CommentAPIError, st.delete_comment, child, 'u1')
+    self.assertEqual(st.delete_subtree(ids[0], 'u1'), 3)
+    self.assertEqual(st.get_comment(grandchild), None)
+    self.assertTrue(st.delete_comment(ids[2], 'u1'))
+    self.assertEqual([r['ID'] for r in st.get_comments('Post', 'id1')[0]], [ids[1]])
+
+  def test_versions(self):
+    st = self.storage
+    self.assertEqual(st.get_object_version('Post', 'id7'), (0, None))
+    root = st.create_comment('Post', 'id7', 'u1', 'root')
+    child = st.create_comment('Post', 'id7', 'u1', 'child', parent_id=root)
+    version, updated = st.get_object_version('Post', 'id7')
+    self.assertTrue(version >= 2 and updated)
+    self.assertEqual(st.get_subtree_version(root)[0], 1)
+    self.assertEqual(st.get_subtree_version(child), (0, None))
+
+    reply = st.create_comment('Post', 'id7', 'u1', 'reply', parent_id=child)
+    st.update_comment(reply, 'u1', 'edited')
+    self.assertEqual(st.get_subtree_version(root)[0], 3)
+    self.assertEqual(st.get_subtree_version(child)[0], 2)
+    self.assertEqual(st.get_subtree_version(reply)[0], 1)
+    self.assertEqual(st.get_object_version('Post', 'id8'), (0, None))
+
+    st.delete_comment(reply, 'u1')
+    self.assertEqual(st.get_subtree_version(root)[0], 4)
+    st.delete_subtree(child, 'u1')
+    self.assertEqual(st.get_subtree_version(root)[0], 5)
+    self.assertEqual(st.get_object_version('Post', 'id7')[0], version + 4)
+
+    st.create_comments_bulk([dict(obj_type='Post', obj_id='id7', user_id='u1',
+                                  comment='bulk', parent_id=root)])
+    self.assertEqual(st.get_subtree_version(root)[0], 6)
+
+  def test_reports(self):
+    st = self.storage
+    st.create_comment('Post', 'id1', 'u1', 'c1', created=datetime(2016, 1, 2))
+    c2 = st.create_comment('Post', 'id2', 'u1', 'c2', created=datetime(2016, 1, 1))
+    st.create_comment('Post', 'id1', 'u2', 'c3')
+
+    report_id = st.create_report('admin', 'u1', obj_type='Post')
+    self.assertEqual([r['COMMENT'] for r in st.get_report_data(report_id)], ['c2', 'c1'])
+    report_id = st.create_report('admin', 'u1', end_date='2016-01-01 23:59:59')
+    self.assertEqual([r['ID'] for r in st.get_report_data(report_id)], [c2])
+
+    st.update_report(report_id, 'report.csv')
+    rows, cursor = st.get_reports('admin', limit=1)
+    self.assertEqual((rows[0]['ID'], rows[0]['STATUS']), (report_id, 'completed'))
+    self.assertEqual(len(st.get_reports('admin', cursor=cursor)[0]), 1)
+
+  def test_report_mark(self):
+    st = self.storage
+    st.clear('HISTORY')
+    c1 = st.create_comment('Post', 'id1', 'u1', 'c1', created=datetime(2016, 1, 1))
+    c2 = st.create_comment('Post', 'id1', 'u1', 'c2', created=datetime(2016, 1, 2))
+    report_id = st.create_report('admin', 'u1')
+    self.assertTrue(st.report_changed(report_id))
+
+    def mark(count):
+      rows = list(st.iter_report_data(report_id))
+      key = (rows[-1]['CREATED_DATE'], rows[-1]['ID'])
+      st.update_report_mark(report_id, key[0], key[1], count,
+                            utils.dbdate(datetime.utcnow()))
+      return key
+
+    key = mark(2)
+    self.assertEqual(st.report_mark(st.get_report(report_id)), key)
+    c3 = st.create_comment('Post', 'id1', 'u1', 'c3', created=datetime(2016, 1, 3))
+    self.assertFalse(st.report_changed(report_id))
+    self.assertEqual([r['ID'] for r in st.iter_report_data(report_id, after=key)], [c3])
+
+    # created before the mark
+    st.create_comment('Post', 'id1', 'u1', 'c0', created=datetime(2015, 12, 31))
+    self.assertTrue(st.report_changed(report_id))
+    mark(4)
+    self.assertFalse(st.report_changed(report_id))
+    st.update_comment(c1, 'u1', 'edited')
+    self.assertTrue(st.report_changed(report_id))
+
+    st.clear('HISTORY')
+    mark(4)
+    st.delete_comment(c2, 'u1')
+    self.assertTrue(st.report_changed(report_id))
+
+  def test_report_cache(self):
+    st = self.storage
+    st.create_comment('Post', 'id1', 'u1', 'c1', created=datetime(2016, 1, 1))
+    r1 = st.create_report('admin', 'u1', 'Post', 'id1')
+    r2 = st.create_report('other', 'u1', 'Post', 'id1')
+    self.assertEqual(st.get_report(r1)['SOURCE_ID'], None)
+    self.assertEqual(st.get_report(r2)['SOURCE_ID'], r1)
+
+    # object id without type is not a filter
+    r3 = st.create_report('admin', 'u1', None, 'id1')
+    self.assertEqual(st.get_report(st.create_report('admin', 'u1'))['SOURCE_ID'], r3)
+
+    st.update_report(r1, 'report.csv')
+    report = st.get_report(r2)
+    self.assertEqual((report['SOURCE_ID'], report['STATUS'], report['FILE_NAME']),
+                     (None, 'completed', 'report.csv'))
+    report = st.get_report(st.create_report('admin', 'u1', 'Post', 'id1'))
+    self.assertEqual((report['SOURCE_ID'], report['STATUS'], report['FILE_NAME']),
+                     (None, 'completed', 'report.csv'))
+    self.assertTrue(st.report_file_shared(r1, 'report.csv'))
+    self.assertFalse(st.report_file_shared(r1, 'none.csv'))
+
+    # new data, new version
+    comment_id = st.create_comment('Post', 'id1', 'u1', 'c2')
+    r4 = st.create_report('admin', 'u1', 'Post', 'id1')
+    self.assertEqual(st.get_report(r4)['SOURCE_ID'], None)
+    version = st.data_version('Post', 'id1')
+    st.update_comment(comment_id, 'u1', 'edited')
+    self.assertNotEqual(st.data_version('Post', 'id1'), version)
+
+    # versions do not wait for asynchronous HISTORY
+    version = st.data_version()
+    st.create_comment('Post', 'id2', 'u1', 'c3')
+    self.assertNotEqual(st.data_version(), version)
+    self.assertNotEqual(st.data_version('Post', 'id1'), '0')
+    self.assertEqual(st.data_version('Post', 'missing'), '0')
+
+    # restarted report has its own file
+    st.update_report(r2, 'other.csv')
+    st.update_report(r1, 'new.csv')
+    report = st.get_report(r2)
+    self.assertEqual((report['SOURCE_ID'], report['FILE_NAME']), (None, 'other.csv'))
+
+  def test_report_progress(self):
+    st = self.storage
+    report_id = st.create_report('admin', 'u1')
+    self.assertTrue(st.start_report(report_id, 10))
+    self.assertTrue(st.update_report_progress(report_id, 4))
+    self.assertTrue(st.update_report_progress(report_id, 3))
+    report = st.get_report(report_id)
+    self.assertEqual((report['PROGRESS_ROWS'], report['TOTAL_ROWS']), (7, 10))
+    self.assertTrue(report['ROWS_PER_SEC'] > 0)
+
+    self.assertTrue(st.cancel_report(report_id))
+    self.assertFalse(st.cancel_report(report_id))
+    self.assertFalse(st.update_report_progress(report_id, 1))
+    self.assertFalse(st.start_report(report_id, 10))
+
+    self.assertTrue(st.restart_report(report_id))
+    self.assertFalse(st.restart_report(report_id))
+    self.assertTrue(st.start_report(report_id, 5))
+    self.assertEqual(st.get_report(report_id)['PROGRESS_ROWS'], 0)
+    self.assertEqual([r['ID'] for r in st.get_working_reports()], [report_id])
+
+  def test_cancel_shared_report(self):
+    st = self.storage
+    source = st.create_report('admin', 'u1')
+    shared = st.create_report('other', 'u1')
+    self.assertTrue(st.start_report(source, 10))
+
+    # the export goes on for the report sharing its file
+    self.assertTrue(st.cancel_report(source))
+    self.assertTrue(st.update_report_progress(source, 1))
+    self.assertEqual(st.get_report(shared)['STATUS'], 'working')
+    self.assertTrue(st.start_report(source, 10))
+    self.assertEqual(st.get_report(source)['STATUS'], 'cancelled')
+    self.assertEqual([r['ID'] for r in st.get_working_reports()], [source])
+
+    self.assertTrue(st.cancel_report(shared))
+    self.assertFalse(st.update_report_progress(source, 1))
+    self.assertEqual(st.get_working_reports(), [])
+
+    # completed source does not overwrite cancelled report sharing its file
+    other = st.create_report('other', 'u2')
+    cancelled = st.create_report('admin', 'u2')
+    self.assertEqual(st.get_report(cancelled)['SOURCE_ID'], other)
+    self.assertTrue(st.cancel_report(cancelled))
+    st.update_report(other, 'report.csv')
+    report = st.get_report(cancelled)
+    self.assertEqual((report['STATUS'], report['FILE_NAME']), ('cancelled', ''))
+    self.assertEqual(st.get_report(other)['STATUS'], 'completed')
+
+
+class SqliteBackendTestCase(BackendTests, unittest.TestCase):
+  storage = db
+
+
+class MemoryBackendTestCase(BackendTests, unittest.TestCase):
+  storage = storage.backend('memory')
 
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
@@ -1,4 +1,55 @@
 __author__ = 'okoneshnikov'
+import base64
+import json
+from datetime import datetime
+
+DBDATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 def dbdate(dt):
-  return dt.strftime("%Y-%m-%d %H:%M:%S")
\ No newline at end of file
+  return dt.strftime(DBDATE_FORMAT)
+
+def parse_dbdate(value):
+  return datetime.strptime(value, DBDATE_FORMAT)
+
+def chunks(iterable, size):
+  """ Split iterable to lists of `size` items. The last list may be shorter."""
+  chunk = []
+  for item in iterable:
+    chunk.append(item)
+    if len(chunk) == size:
+      yield chunk
+      chunk = []
+
+  if chunk:
+    yield chunk
+
+def encode_cursor(*values):
+  """ Pack page position to opaque url safe string."""
+  return base64.urlsafe_b64encode(json.dumps(values))
+
+# value types of cursors
+TEXT = basestring
+INTEGER = (int, long)
+NUMBER = (int, long, float)
+
+def decode_cursor(cursor, types=(TEXT, INTEGER)):
+  """ Unpack values packed by encode_cursor.
+  @param types: type (tuple of types) of every value, e.g. (TEXT, INTEGER)
+    for (CREATED_DATE, ID) cursors.
+  @return: list of values.
+  @raise ValueError: cursor is invalid or has other values.
+  """
+  try:
+    values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+  except TypeError:
+    raise ValueError('Invalid cursor %r' % cursor)
+
+  if not (isinstance(values, list) and len(values) == len(types) and
+          all(isinstance(value, value_type) and not isinstance(value, bool)
+              for value, value_type in zip(values, types))):
+    raise ValueError('Invalid cursor %r' % cursor)
+  return values
+
+def row_to_dict(row):
+  """ Convert sqlite3.Row to dict, e.g. for json."""
+  return dict(zip(row.keys(), row))
\ No newline at end of file